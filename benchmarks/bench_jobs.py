@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+'''
+Benchmarks for jobs.py, reported as JSON, so that changes to the Lua scripts
+(and the Python around them) can be compared before a release.
+
+Usage::
+
+    # against a Redis server you already have (uses keys under a unique prefix,
+    # which are deleted afterwards)
+    $ python benchmarks/bench_jobs.py --redis redis://localhost:6379/15
+
+    # start a throwaway redis-server on a free port (must be on your PATH)
+    $ python benchmarks/bench_jobs.py --spawn
+
+    # use fakeredis' in-process TCP server instead (pip install fakeredis);
+    # much slower than Redis, only useful for comparing jobs.py changes
+    $ python benchmarks/bench_jobs.py --fake
+
+    # fewer iterations, results to a file
+    $ python benchmarks/bench_jobs.py --spawn --quick --output results.json
+
+Benchmarks:
+ * import - time to import jobs.py in a fresh interpreter
+ * acquire_finish - ResourceManager start/stop with one input and one output
+ * refresh - refresh (lease renewal) and full refresh cost, by number of keys
+ * wakeup - time from one job finishing until a job waiting on its output
+   starts
+ * get_jobs - get_jobs() with N running jobs
+ * traverse - --downstream traversal time by graph history size
+
+Latencies are in milliseconds, throughputs in operations/second. To load a
+server with traffic shaped like your own, see load_jobs.py.
+'''
+
+from __future__ import print_function
+
+import argparse
+import binascii
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import redis
+
+import jobs
+
+
+def _summary(samples, ops=None):
+    '''
+    Returns the count, mean, median, 99th percentile, and max of the provided
+    samples (in seconds) as milliseconds.
+    '''
+    samples = sorted(samples)
+    n = len(samples)
+    result = {
+        'n': n,
+        'mean_ms': 1000 * sum(samples) / n,
+        'p50_ms': 1000 * samples[n // 2],
+        'p99_ms': 1000 * samples[min(int(n * .99), n - 1)],
+        'max_ms': 1000 * samples[-1],
+    }
+    if ops:
+        result['ops_per_sec'] = ops * n / sum(samples)
+    return result
+
+def _timed(fcn, iterations):
+    samples = []
+    for i in range(iterations):
+        t = time.time()
+        fcn(i)
+        samples.append(time.time() - t)
+    return samples
+
+
+def bench_import(client, quick):
+    samples = []
+    for i in range(3 if quick else 10):
+        out = subprocess.check_output([sys.executable, '-c',
+            'import time; t = time.time(); import jobs; print(repr(time.time() - t))'],
+            cwd=ROOT)
+        samples.append(float(out.decode('latin-1')))
+    return _summary(samples)
+
+def bench_acquire_finish(client, quick):
+    client.conn.set(client.prefix + 'bench.input', '')
+    def run(i):
+        with jobs.ResourceManager(['bench.input'], ['bench.output.%i'%(i,)], 30, conn=client):
+            pass
+    return _summary(_timed(run, 200 if quick else 2000), ops=1)
+
+def bench_refresh(client, quick):
+    results = {}
+    for count in ([1, 10, 100] if quick else [1, 10, 100, 1000]):
+        inputs = ['bench.refresh_in.%i'%(i,) for i in range(count)]
+        outputs = ['bench.refresh_out.%i'%(i,) for i in range(count)]
+        client.conn.mset(dict((client.prefix + k, '') for k in inputs))
+        job = jobs.ResourceManager(inputs, outputs, 60, conn=client)
+        job.start()
+        try:
+            iterations = 20 if quick else 200
+            results[str(count)] = {
+                'renew': _summary(_timed(lambda i: jobs._renew_job(
+                    client, job.identifier, inputs, outputs), iterations)),
+                'full': _summary(_timed(lambda i: jobs._refresh_job(
+                    client, inputs, outputs, job.identifier, 60, True,
+                    cache=job._io_cache), iterations)),
+            }
+        finally:
+            job.stop(failed=True)
+    return results
+
+def bench_wakeup(client, quick):
+    samples = []
+    for i in range(10 if quick else 50):
+        output = 'bench.wakeup.%i'%(i,)
+        holder = jobs.ResourceManager([], [output], 30, conn=client)
+        holder.start()
+        started = []
+        errors = []
+        def wait():
+            try:
+                with jobs.ResourceManager([], [output], 30, 10, conn=client):
+                    started.append(time.time())
+            except Exception as err:
+                errors.append(err)
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        # let the waiter block on the lock
+        time.sleep(.05)
+        finished = time.time()
+        holder.stop()
+        waiter.join()
+        if errors:
+            # report why the waiter didn't start, not an IndexError
+            raise errors[0]
+        samples.append(started[0] - finished)
+    return _summary(samples)
+
+def bench_get_jobs(client, quick):
+    results = {}
+    for count in ([10, 100] if quick else [10, 100, 1000]):
+        managers = [jobs.ResourceManager([], ['bench.running.%i.%i'%(count, i)], 60, conn=client)
+            for i in range(count)]
+        jobs.start_many(managers)
+        try:
+            results[str(count)] = _summary(_timed(
+                lambda i: jobs.get_jobs(client), 10 if quick else 50))
+        finally:
+            jobs.finish_many(managers, failed=True)
+    return results
+
+def bench_traverse(client, quick):
+    results = {}
+    jprefix = client.prefix + 'jobs:'
+    for size in ([100, 1000] if quick else [100, 1000, 10000]):
+        # a tree of jobs, each reading the previous level's output
+        conn = client.conn
+        conn.delete(jprefix + 'graph:input', jprefix + 'graph:output')
+        pipe = conn.pipeline(False)
+        now = time.time()
+        for i in range(size // 2):
+            parent = 'bench.data_%i'%((i - 1) // 2,) if i else 'bench.root'
+            job = 'bench.job_%i'%(i,)
+            pipe.execute_command('ZADD', jprefix + 'graph:input', now, parent + ' -> ' + job)
+            pipe.execute_command('ZADD', jprefix + 'graph:output', now, job + ' -> bench.data_%i'%(i,))
+        pipe.execute()
+        jobs.index_graph(client)
+        results[str(size)] = _summary(_timed(
+            lambda i: jobs._traverse_edges(True, 'bench.root', client), 5 if quick else 20))
+    return results
+
+BENCHMARKS = [
+    ('import', bench_import),
+    ('acquire_finish', bench_acquire_finish),
+    ('refresh', bench_refresh),
+    ('wakeup', bench_wakeup),
+    ('get_jobs', bench_get_jobs),
+    ('traverse', bench_traverse),
+]
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def _connect(url, tries=50):
+    conn = redis.Redis.from_url(url)
+    for i in range(tries):
+        try:
+            conn.ping()
+            return conn
+        except redis.exceptions.ConnectionError:
+            if i == tries - 1:
+                raise
+            time.sleep(.1)
+
+def _server_version(conn):
+    try:
+        return conn.info().get('redis_version')
+    except redis.exceptions.ResponseError:
+        # fakeredis doesn't have INFO
+        return None
+
+def _server(args):
+    '''
+    Returns (url, description, cleanup) for the Redis server to benchmark
+    against.
+    '''
+    if args.spawn:
+        port = _free_port()
+        proc = subprocess.Popen(['redis-server', '--port', str(port), '--save', '',
+            '--appendonly', 'no'], stdout=open(os.devnull, 'w'))
+        return 'redis://127.0.0.1:%i/0'%(port,), 'redis-server', proc.terminate
+    if args.fake:
+        from fakeredis import TcpFakeServer
+        port = _free_port()
+        server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'redis://127.0.0.1:%i/0'%(port,), 'fakeredis', server.shutdown
+    return args.redis, 'external', lambda: None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for jobs.py")
+    parser.add_argument('--redis', default='redis://localhost:6379/15',
+        help="The Redis server to use, unless --spawn or --fake")
+    parser.add_argument('--spawn', action='store_true',
+        help="Start a throwaway redis-server to benchmark against")
+    parser.add_argument('--fake', action='store_true',
+        help="Benchmark against fakeredis' in-process TCP server")
+    parser.add_argument('--quick', action='store_true',
+        help="Fewer iterations and smaller sizes")
+    parser.add_argument('--only', action='append',
+        help="Only run this benchmark (can be repeated): " +
+            ', '.join(name for name, _ in BENCHMARKS))
+    parser.add_argument('--output', help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    url, server, cleanup = _server(args)
+    try:
+        conn = _connect(url)
+        prefix = 'jobsbench%s:'%(binascii.hexlify(os.urandom(4)).decode('latin-1'),)
+        client = jobs.JobsClient(conn, prefix)
+        jobs.DEFAULT_LOGGER = jobs.NullLog()
+        report = {
+            'meta': {
+                'jobs_version': jobs.VERSION,
+                'python': platform.python_version(),
+                'redis_py': getattr(redis, '__version__', None),
+                'redis_server': _server_version(conn),
+                'server': server,
+                'quick': args.quick,
+                'time': time.time(),
+            },
+            'results': {},
+        }
+        try:
+            for name, bench in BENCHMARKS:
+                if args.only and name not in args.only:
+                    continue
+                print("running", name, file=sys.stderr)
+                report['results'][name] = bench(client, args.quick)
+        finally:
+            keys = conn.keys(prefix + '*')
+            for i in range(0, len(keys), 1000):
+                conn.delete(*keys[i:i+1000])
+    finally:
+        cleanup()
+
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+if __name__ == '__main__':
+    main()
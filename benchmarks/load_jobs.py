@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+'''
+Generates (or replays) lock traffic against a Redis server from a pool of
+processes running ResourceManager jobs, to see how Redis and jobs.py hold up
+under contention like your own. Reports throughput, wait time percentiles,
+and failure rates as JSON.
+
+Usage::
+
+    # run the workload described in spec.json for 60 seconds on 16 processes,
+    # recording a trace of what happened
+    $ python benchmarks/load_jobs.py --spec spec.json --seconds 60 \\
+        --processes 16 --record trace.jsonl --redis redis://localhost:6379/15
+
+    # replay the trace (same jobs, same start times, hold times, and refreshes)
+    $ python benchmarks/load_jobs.py --replay trace.jsonl --spawn
+
+The server options (--redis, --spawn, --fake) are the same as for
+bench_jobs.py. All keys are created under a random prefix, and deleted
+afterwards unless --keep is passed.
+
+Workload spec
+=============
+
+A JSON document describing the jobs each process runs, back to back, picking a
+job at random (by weight) each time::
+
+    {
+        "seed": 1,
+        "jobs": [
+            {
+                "name": "hourly_rollup",
+                "weight": 5,
+                "partitions": 24,
+                "inputs": ["events.hour_{p}"],
+                "outputs": ["rollup.hour_{p}"],
+                "duration": 5,
+                "wait": 1,
+                "overwrite": true,
+                "hold": [0.01, 0.1],
+                "refresh_every": 0
+            },
+            {
+                "name": "daily_report",
+                "weight": 1,
+                "inputs": ["rollup.hour_1", "rollup.hour_2", "rollup.hour_3"],
+                "outputs": ["report.daily"],
+                "hold": [0.1, 0.5],
+                "refresh_every": 0.2
+            }
+        ]
+    }
+
+``{p}`` in input and output names is replaced by a partition picked at random
+from ``range(partitions)`` (the same one for every name in the job), and
+``{worker}`` by the process number. ``hold`` is how long (in seconds, picked
+uniformly from the range) the job keeps its locks once started, refreshing
+every ``refresh_every`` seconds (if non-zero). Inputs are created before the
+run starts. Defaults: weight 1, partitions 1, duration 5, wait 1, overwrite
+true, hold [0, 0], refresh_every 0.
+
+Traces
+======
+
+One JSON object per line, with the time ``t`` in seconds since the start of the
+run, the ``worker`` (process) that ran the job, and an ``event``:
+
+* ``start`` - also has ``job`` (a unique id), ``inputs``, ``outputs``,
+  ``duration``, ``wait``, ``overwrite``, and ``waited`` (seconds until the
+  locks were acquired)
+* ``fail`` - like ``start``, for a job that couldn't be started, with the
+  failure ``reasons`` instead of ``waited``
+* ``refresh`` - ``job`` refreshed its locks
+* ``stop`` - ``job`` finished
+
+You can also produce traces from your own logs, to replay production traffic.
+'''
+
+from __future__ import print_function
+
+import argparse
+import binascii
+import json
+import multiprocessing
+import os
+import random
+import time
+from collections import defaultdict
+
+# also puts the repository on sys.path for jobs
+from bench_jobs import _connect, _server, _summary
+
+import jobs
+
+JOB_DEFAULTS = {
+    'weight': 1,
+    'partitions': 1,
+    'duration': 5,
+    'wait': 1,
+    'overwrite': True,
+    'hold': [0, 0],
+    'refresh_every': 0,
+}
+
+
+class Worker(object):
+    '''
+    Runs jobs in one process, keeping statistics and the trace of events.
+    '''
+    def __init__(self, url, prefix, worker, base):
+        self.client = jobs.JobsClient(_connect(url), prefix)
+        self.worker = worker
+        self.base = base
+        self.waits = []
+        self.failures = defaultdict(int)
+        self.attempts = 0
+        self.refreshes = 0
+        self.lost = 0
+        self.events = []
+        self.seq = 0
+
+    def _event(self, event, **kwargs):
+        kwargs.update(t=time.time() - self.base, worker=self.worker, event=event)
+        self.events.append(kwargs)
+
+    def run_job(self, inputs, outputs, duration, wait, overwrite, hold, refreshes):
+        '''
+        Runs one job, holding its locks for ``hold`` seconds after starting,
+        and refreshing at the provided offsets from when it started.
+        '''
+        self.seq += 1
+        job_id = '%s.%s'%(self.worker, self.seq)
+        self.attempts += 1
+        called = time.time()
+        args = {'t': called - self.base, 'worker': self.worker, 'job': job_id,
+            'inputs': list(inputs), 'outputs': list(outputs), 'duration': duration,
+            'wait': wait, 'overwrite': overwrite}
+        job = jobs.ResourceManager(inputs, outputs, duration, wait, overwrite,
+            conn=self.client)
+        try:
+            job.start()
+        except jobs.ResourceUnavailable as err:
+            reasons = sorted(err.args[0] or {})
+            for why in reasons:
+                self.failures[why] += 1
+            self.events.append(dict(args, event='fail', reasons=reasons))
+            return
+        started = time.time()
+        self.waits.append(started - called)
+        self.events.append(dict(args, event='start', waited=started - called))
+        try:
+            for offset in refreshes:
+                if offset >= hold:
+                    break
+                time.sleep(max(started + offset - time.time(), 0))
+                # refreshes are otherwise limited to one per second
+                job.last_refreshed = 0
+                result = job.refresh()
+                self.refreshes += 1
+                if result and (result.get('err') or result.get('temp')):
+                    self.lost += 1
+                self._event('refresh', job=job_id)
+            time.sleep(max(started + hold - time.time(), 0))
+        finally:
+            job.stop()
+            self._event('stop', job=job_id)
+
+    def stats(self):
+        return {
+            'worker': self.worker,
+            'waits': self.waits,
+            'failures': dict(self.failures),
+            'attempts': self.attempts,
+            'refreshes': self.refreshes,
+            'lost': self.lost,
+            'events': self.events,
+        }
+
+
+def _generate(args):
+    '''
+    Runs randomly picked jobs from the spec until the deadline.
+    '''
+    url, prefix, worker, base, deadline, spec = args
+    jobs.DEFAULT_LOGGER = jobs.NullLog()
+    w = Worker(url, prefix, worker, base)
+    time.sleep(max(base - time.time(), 0))
+    rng = random.Random((spec.get('seed') or 0) * 1000003 + worker)
+    templates = [dict(JOB_DEFAULTS, **t) for t in spec['jobs']]
+    weights = [t['weight'] for t in templates]
+    while time.time() < deadline:
+        pick = rng.uniform(0, sum(weights))
+        for t in templates:
+            pick -= t['weight']
+            if pick <= 0:
+                break
+        p = rng.randrange(t['partitions'])
+        names = lambda n: [x.format(p=p, worker=worker) for x in n]
+        hold = rng.uniform(*t['hold'])
+        every = t['refresh_every']
+        refreshes = [every * (i + 1) for i in range(int(hold / every))] if every else []
+        w.run_job(names(t.get('inputs', [])), names(t.get('outputs', [])),
+            t['duration'], t['wait'], t['overwrite'], hold, refreshes)
+    return w.stats()
+
+def _replay(args):
+    '''
+    Replays one worker's jobs from a trace, at the same times.
+    '''
+    url, prefix, worker, base, plan = args
+    jobs.DEFAULT_LOGGER = jobs.NullLog()
+    w = Worker(url, prefix, worker, base)
+    time.sleep(max(base - time.time(), 0))
+    for job in plan:
+        time.sleep(max(base + job['t'] - time.time(), 0))
+        w.run_job(job['inputs'], job['outputs'], job['duration'], job['wait'],
+            job['overwrite'], job['hold'], job['refreshes'])
+    return w.stats()
+
+def load_trace(path):
+    '''
+    Turns a trace into ``{worker: [job, ...]}``, each job with its start
+    arguments, ``hold`` (seconds from acquiring the locks to stopping), and
+    ``refreshes`` (offsets from acquiring the locks).
+    '''
+    started = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            kind = event['event']
+            if kind == 'start':
+                started[event['job']] = dict(event, hold=0, refreshes=[],
+                    acquired=event['t'] + event.get('waited', 0))
+            elif kind == 'fail':
+                # attempted, but never acquired; replay the attempt
+                started[event['job']] = dict(event, hold=0, refreshes=[],
+                    acquired=event['t'])
+            elif event['job'] in started:
+                job = started[event['job']]
+                offset = event['t'] - job['acquired']
+                if kind == 'refresh':
+                    job['refreshes'].append(offset)
+                elif kind == 'stop':
+                    job['hold'] = offset
+    plans = defaultdict(list)
+    for job in started.values():
+        plans[job['worker']].append(job)
+    for plan in plans.values():
+        plan.sort(key=lambda job: job['t'])
+    return plans
+
+def _report(results, elapsed):
+    waits = [t for r in results for t in r['waits']]
+    failures = defaultdict(int)
+    for r in results:
+        for why, count in r['failures'].items():
+            failures[why] += count
+    attempts = sum(r['attempts'] for r in results)
+    report = {
+        'seconds': elapsed,
+        'processes': len(results),
+        'attempts': attempts,
+        'started': len(waits),
+        'jobs_per_sec': len(waits) / elapsed,
+        'failure_rate': (attempts - len(waits)) / float(attempts or 1),
+        'failures': dict(failures),
+        'refreshes': sum(r['refreshes'] for r in results),
+        'locks_lost': sum(r['lost'] for r in results),
+    }
+    if waits:
+        report['wait'] = _summary(waits)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Lock traffic generator for jobs.py")
+    parser.add_argument('--spec', help="The workload spec to generate traffic from")
+    parser.add_argument('--replay', help="A trace to replay instead of a spec")
+    parser.add_argument('--seconds', type=float, default=30,
+        help="How long to generate traffic for (default 30)")
+    parser.add_argument('--processes', type=int, default=4,
+        help="How many processes to generate traffic from (default 4)")
+    parser.add_argument('--record', help="Write a trace of the run to this file")
+    parser.add_argument('--redis', default='redis://localhost:6379/15',
+        help="The Redis server to use, unless --spawn or --fake")
+    parser.add_argument('--spawn', action='store_true',
+        help="Start a throwaway redis-server to run against")
+    parser.add_argument('--fake', action='store_true',
+        help="Run against fakeredis' in-process TCP server")
+    parser.add_argument('--keep', action='store_true',
+        help="Don't delete the keys created by the run")
+    parser.add_argument('--output', help="Write the JSON results to this file")
+    args = parser.parse_args()
+    if bool(args.spec) == bool(args.replay):
+        parser.error("Pass exactly one of --spec or --replay")
+
+    url, server, cleanup = _server(args)
+    try:
+        conn = _connect(url)
+        prefix = 'jobsload%s:'%(binascii.hexlify(os.urandom(4)).decode('latin-1'),)
+        if args.spec:
+            with open(args.spec) as f:
+                spec = json.load(f)
+            plans = None
+            inputs = set(
+                name.format(p=p, worker=w)
+                for t in spec['jobs']
+                for p in range(t.get('partitions', 1))
+                for w in range(args.processes)
+                for name in t.get('inputs', []))
+        else:
+            plans = load_trace(args.replay)
+            inputs = set(name for plan in plans.values() for job in plan
+                for name in job['inputs'])
+        if inputs:
+            conn.mset(dict((prefix + name, '') for name in inputs))
+
+        # give the processes a moment to connect before the clock starts
+        base = time.time() + 1
+        pool = multiprocessing.Pool(args.processes if plans is None else len(plans))
+        try:
+            if plans is None:
+                work = [(url, prefix, w, base, base + args.seconds, spec)
+                    for w in range(args.processes)]
+                results = pool.map(_generate, work)
+            else:
+                work = [(url, prefix, w, base, plan) for w, plan in sorted(plans.items())]
+                results = pool.map(_replay, work)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - base
+
+        if args.record:
+            events = sorted((e for r in results for e in r['events']), key=lambda e: e['t'])
+            with open(args.record, 'w') as f:
+                for event in events:
+                    f.write(json.dumps(event, sort_keys=True) + '\n')
+
+        report = _report(results, elapsed)
+        report['server'] = server
+        report['mode'] = 'spec' if plans is None else 'replay'
+        if not args.keep:
+            keys = conn.keys(prefix + '*')
+            for i in range(0, len(keys), 1000):
+                conn.delete(*keys[i:i+1000])
+    finally:
+        cleanup()
+
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+if __name__ == '__main__':
+    main()
@@ -109,6 +109,18 @@ How to use
         # cleanly.
         return
 
+* Pass ``fair=True`` (to the decorator or the ResourceManager) to wait in line
+  for contended inputs and outputs. Fair jobs are started in the order they
+  started waiting, relative to other fair jobs (jobs not using ``fair=True``
+  don't wait in line). Readers only wait in line behind writers, and don't get
+  in line for inputs that don't exist yet (so the writer creating them isn't
+  stuck behind them). Jobs that give up waiting leave the line, and jobs that
+  die lose their place after
+  ``3 * POLL_FALLBACK`` seconds (1 second minimum)::
+
+    with jobs.ResourceManager([arg2], ['output.x'], duration=60, wait=900, fair=True):
+        pass
+
 More examples
 -------------
 
@@ -171,6 +183,61 @@ More examples
                     # generate the recommendations for the partner
                     pass
 
+* If one process needs to work with several Redis servers, or with several
+  tenants sharing a Redis server (each with its own key prefix), use a
+  ``JobsClient`` anywhere you would pass a Redis connection. Each client carries
+  its connection, key prefix, default graph history setting, and loaded
+  scripts::
+
+        tenant1 = jobs.JobsClient(conn, prefix='tenant1:')
+        tenant2 = jobs.JobsClient(conn, prefix='tenant2:', graph_history=False)
+
+        with jobs.ResourceManager(['input1'], ['output1'], 300, 900, conn=tenant1):
+            pass
+        running = jobs.get_jobs(tenant2)
+
+* Or when you have a lot of independent jobs to start, you can start (and stop)
+  them together with far fewer round trips to Redis::
+
+        def make_recommendations(partners):
+            yf = yesterday()
+            managers = [jobs.ResourceManager([jobs.NG.reporting.report_by_partner[yf]],
+                    [jobs.NG.reporting.recommendations_by_partner[yf][partner]], 300, 900)
+                for partner in partners]
+            results = jobs.start_many(managers)
+            started = [m for m, result in zip(managers, results) if result['ok']]
+            # generate the recommendations for started partners
+            jobs.finish_many(started)
+
+* With asyncio (Python 3.7+, using a ``redis.asyncio`` connection), use
+  ``AsyncResourceManager`` with ``async with``, or the
+  ``async_resource_manager`` decorator on an ``async def`` function. Waiting
+  jobs don't block the event loop, and ``async with`` refreshes the locks from
+  an asyncio task until the job is stopped::
+
+        import redis.asyncio
+
+        ACONN = redis.asyncio.Redis(...)
+
+        async def make_recommendation(partner):
+            yf = yesterday()
+            async with jobs.AsyncResourceManager([jobs.NG.reporting.report_by_partner[yf]],
+                    [jobs.NG.reporting.recommendations_by_partner[yf][partner]], 300, 900, conn=ACONN):
+                # job is already started
+                pass
+
+        @jobs.async_resource_manager((), (), 300, 900, conn=ACONN)
+        async def fetch_daily_revenue(job):
+            await job.start(auto_refresh=True)
+            # actually fetch daily revenue
+
+  Two differences from ``with jobs.ResourceManager(...)``: ``async with``
+  always starts the job with ``auto_refresh=True`` (a plain ``with`` doesn't
+  refresh unless you do), and async jobs are never added to ``jobs.LOCKED``, so
+  they are not stopped by the atexit/signal handlers (which can't run
+  coroutines), and their locks are left to expire. The asyncio API is only
+  imported when first used, and ``from jobs import *`` leaves it out (use
+  ``jobs.AsyncResourceManager``, or import it by name).
 
 Configuration options
 =====================
@@ -182,7 +249,8 @@ though you *can* override the connection explicitly on a per-job basis. See the
     # The Redis connection, REQUIRED!
     jobs.CONN = redis.Redis()
 
-    # Sets a prefix to be used on all keys stored in Redis (optional)
+    # Sets a prefix to be used on all keys stored in Redis (optional), for
+    # connections not wrapped in a JobsClient with its own prefix (see above)
     jobs.GLOBAL_PREFIX = ''
 
     # Keep a sanitized ZSET of inputs and outputs, available for traversal
@@ -194,9 +262,134 @@ though you *can* override the connection explicitly on a per-job basis. See the
 
     # To use a logger that doesn't print to standard output, set the logging
     # object at the module level (see below). By default, the built-in "default
-    # logger" prints to standard output.
+    # logger" prints to standard output. Messages are only formatted if they
+    # pass the logger's level, and jobs.NullLog() drops everything.
     jobs.DEFAULT_LOGGER = logging.getLogger(...)
 
+    # Jobs waiting for locks will block on release notifications (published
+    # via Redis pub/sub when jobs finish) instead of polling Redis every 10
+    # milliseconds. Lock expiration is also handled, as waiters are told when
+    # the locks they are waiting on will expire. Each process uses one pub/sub
+    # connection (per connection pool) for all of its waiting jobs. Note: a
+    # release wakes up *every* job waiting on that key, and each of them tries
+    # to get its locks again.
+    jobs.PUSH_WAKEUPS = True
+
+    # When using push wakeups, waiting jobs will still check their locks at
+    # least this often (in seconds), in case a notification was missed, or
+    # an input was created outside of jobs.py.
+    jobs.POLL_FALLBACK = 1.0
+
+    # Use a Redis Cluster friendly key layout, see 'Redis Cluster' below.
+    jobs.CLUSTER_TAGS = False
+
+    # On Redis 7+, call the locking scripts as a Redis Functions library with
+    # FCALL, instead of sending them with EVAL/EVALSHA. New processes then
+    # don't need to upload and compile any scripts. The library is loaded by
+    # the first process that needs it (or by calling jobs.load_functions()
+    # when deploying), and older servers fall back to EVALSHA automatically.
+    jobs.USE_FUNCTIONS = False
+
+    # Expired entries are cleaned out of jobs:running a few at a time (at most
+    # this many per started or finished job), instead of on every lock check,
+    # so waiting jobs don't write to any shared keys. Expired input locks are
+    # ignored when checking, and cleaned out when the lock key is next written.
+    jobs.SWEEP_LIMIT = 100
+
+    # --upstream and --downstream traversals run inside Redis, one call per
+    # query, and stop after this many edges so that a large graph doesn't
+    # block Redis for other clients. Pass ``limit`` (or ``--limit``)
+    # explicitly to change it, 0 for no limit.
+    jobs.TRAVERSE_LIMIT = 10000
+
+    # Graph history retention: edges not seen for this many seconds, and/or
+    # the least recently seen edges past this many (each for inputs and
+    # outputs), are removed a few at a time by jobs that record history (see
+    # SWEEP_LIMIT), or all at once by ``python -m jobs --compact-graph``.
+    jobs.GRAPH_MAX_AGE = None
+    jobs.GRAPH_MAX_EDGES = None
+
+    # Instead of forgetting the edges removed by retention, roll them into
+    # per-day summaries (by the day they were last seen), available with
+    # jobs.daily_edges(). Summaries aren't read by --upstream, --downstream,
+    # or --all, and each day's summary expires this many days after that day.
+    jobs.GRAPH_SUMMARY = False
+    jobs.GRAPH_SUMMARY_DAYS = 90
+
+    # Store graph history compactly: node names are interned (once) in the
+    # jobs:graph:names and jobs:graph:ids HASHes, and edges are stored as pairs
+    # of integer ids, which are translated back to names by readers with a
+    # per-process cache. Note: older versions of jobs.py can't read history
+    # recorded this way, and --upstream and --downstream only follow edges
+    # recorded with this enabled (edges() and --all read both).
+    jobs.GRAPH_INTERN = False
+
+    # Keep a snapshot of the graph history in this directory, and run
+    # --upstream and --downstream against it. Each run only fetches the edges
+    # seen since the snapshot was last updated (see jobs.GraphSnapshot).
+    jobs.GRAPH_CACHE_DIR = None
+
+    # Graph node names are sanitized (digits are replaced by '*') for each
+    # job, and the most recently used this many are remembered per process.
+    jobs.FIXED_EDGES_SIZE = 10000
+
+    # Only update the last-seen time of a graph history edge when it was last
+    # recorded at least this many seconds ago, so jobs that run often (or for
+    # many partitions of the same data) don't rewrite the same edges. Edge
+    # times are then only accurate to this many seconds.
+    jobs.GRAPH_GRANULARITY = 0
+
+    # Report lock metrics to this sink: jobs.MemoryMetrics(),
+    # jobs.PrometheusMetrics() (call .render() from your /metrics endpoint), or
+    # jobs.StatsdMetrics(host, port). Any object with ``incr(name, value,
+    # tags)``, ``observe(name, seconds, tags)``, and (optionally)
+    # ``histogram(name, count, tags)`` methods works. Reported:
+    #   start.wait (seconds, tagged result=started/failed), start.attempts
+    #   (a count, tagged the same way), refresh.latency and finish.latency
+    #   (seconds), and lock.failures
+    #   (counted per attempt, tagged by failure reason and namespace).
+    jobs.METRICS = None
+
+    # Count jobs that couldn't start right away in Redis, per failure reason
+    # and sanitized (see EDGE_RE) input or output name, in buckets of
+    # CONTENTION_BUCKET seconds kept for CONTENTION_MAX_AGE seconds, so the
+    # contention of every process using the server can be reported with
+    # jobs.hot_keys() or ``python -m jobs --hot-keys``. Counts are per start
+    # (the reasons from its first attempt), not per retry while waiting.
+    jobs.CONTENTION_STATS = False
+    jobs.CONTENTION_BUCKET = 3600
+    jobs.CONTENTION_MAX_AGE = 7 * 86400
+
+Redis Cluster
+=============
+
+With ``jobs.CLUSTER_TAGS = True`` (and a cluster-aware connection, like
+``redis.cluster.RedisCluster``), every key is hash-tagged by the *namespace* of
+the input or output it belongs to, which is the part of the name before the
+first '.' (the first attribute of an ``NG`` name). For example, the input
+``reporting.events.2016-01-01`` is stored as ``{reporting}.events.2016-01-01``,
+and locked with ``ilock:{reporting}.events.2016-01-01``. The ``jobs:*``
+bookkeeping keys (running jobs, leases, fair queues, graph history) are kept per
+namespace too, as ``{reporting}jobs:running``, etc.
+
+* Jobs whose inputs and outputs share a namespace are locked atomically, with
+  one call to one shard, exactly as without a cluster.
+* Jobs spanning namespaces lock one namespace at a time, in sorted order. If any
+  namespace can't be locked, the namespaces that were already locked are
+  released before waiting, so a job never holds some of its locks while waiting
+  for others. Fair ordering (``fair=True``) only applies within a namespace.
+* Locking throughput scales with the number of shards, as long as your
+  namespaces are spread across them.
+* ``get_jobs()``, ``get_job_io()``, and ``edges()`` take a ``namespace``
+  argument, and the command-line tools only see the non-cluster layout.
+* Refreshes (including ``auto_refresh``) only send a job's lease and running
+  record keys, and read its lock keys from that record, so they rely on all of
+  a namespace's keys sharing one hash slot, which the tags guarantee. Don't
+  hand-tag names into another namespace's slot.
+
+Switching an existing deployment to (or from) ``CLUSTER_TAGS`` changes every
+key name, so do it while no jobs are running, and migrate your outputs.
+
 Using jobs.py with a custom Redis configuration
 ===============================================
 
@@ -237,13 +430,14 @@ configuration handled.::
 
 from __future__ import print_function
 
-import argparse
 import atexit
 import binascii
-from collections import defaultdict, deque
+from collections import defaultdict, OrderedDict
 from datetime import datetime, date
 import functools
 from hashlib import sha1
+import heapq
+import itertools
 import json
 import logging
 import os
@@ -265,16 +459,39 @@ CONN = None
 GLOBAL_PREFIX = ''
 GRAPH_HISTORY = True
 DEFAULT_LOGGER = None # actually set below, see BullshitLog()
+PUSH_WAKEUPS = True
+POLL_FALLBACK = 1.0
+CLUSTER_TAGS = False
+USE_FUNCTIONS = False
+SWEEP_LIMIT = 100
+TRAVERSE_LIMIT = 10000
+GRAPH_MAX_AGE = None
+GRAPH_MAX_EDGES = None
+GRAPH_SUMMARY = False
+GRAPH_SUMMARY_DAYS = 90
+GRAPH_INTERN = False
+GRAPH_CACHE_DIR = None
+FIXED_EDGES_SIZE = 10000
+GRAPH_GRANULARITY = 0
+METRICS = None
+CONTENTION_STATS = False
+CONTENTION_BUCKET = 3600
+CONTENTION_MAX_AGE = 7 * 86400
 # end user-settable configuration
 
 EDGE_RE = re.compile('[0-9][0-9-]*')
+FIXED_EDGES = OrderedDict()
 TS_RE = re.compile('^(\d{9,}(?:[.]\d*)?)$')
 DT_RE = re.compile('^(\d{4})-(\d{2})-(\d{2})(?: (\d{2}):(\d{2})(?::(\d{2})(?:[.](?:\d+)?)?)?)?$')
 EPOCH = datetime(1970, 1, 1)
 PY3K = sys.version_info >= (3, 0, 0)
 TEXT_TYPE = str if PY3K else unicode
 LOCKED = set()
-AUTO_REFRESH = set()
+# auto-refreshed jobs -> sequence number of their entry in REFRESH_HEAP
+AUTO_REFRESH = {}
+REFRESH_HEAP = []
+REFRESH_SEQ = itertools.count()
+REFRESH_COND = threading.Condition()
 REFRESH_THREAD = None
 _GHD = object()
 
@@ -312,33 +529,75 @@ class NG(object):
 TYPE_NG = NG
 NG = NG()
 
-@atexit.register
 def _signal_handler(*args, **kwargs):
     for m in list(LOCKED):
         m.stop(failed=True, shutting_down=True)
     if args:
         # call the old handler, as necessary
-        if OLD_SIGNAL:
+        if callable(OLD_SIGNAL):
             OLD_SIGNAL(*args, **kwargs)
         raise SystemExit()
 
-# register new signal handler, and keep reference to the old one (if any)
-OLD_SIGNAL = signal.signal(signal.SIGTERM, _signal_handler)
-
 ATEXIT_SET = False
 SIGNAL_SET = False
 OLD_SIGNAL = None
 
 def handle_auto_shutdown():
+    '''
+    Registers the atexit and SIGTERM handlers that stop any running jobs
+    (failed) on shutdown, keeping a reference to the old SIGTERM handler (if
+    any). Called when the first job is started, so importing jobs.py has no
+    side effects; the SIGTERM handler can only be installed from the main
+    thread.
+    '''
     global ATEXIT_SET, SIGNAL_SET, OLD_SIGNAL
     if not ATEXIT_SET:
         ATEXIT_SET = atexit.register(_signal_handler)
 
-    if not SIGNAL_SET and isinstance(threading.currentThread(), threading._MainThread):
+    if not SIGNAL_SET and isinstance(threading.current_thread(), threading._MainThread):
         SIGNAL_SET, OLD_SIGNAL = True, signal.signal(signal.SIGTERM, _signal_handler)
 
+class JobsClient(object):
+    '''
+    Carries the Redis connection and settings to use for jobs, so that one
+    process can serve several Redis servers, or several tenants (key prefixes)
+    on one server, at once. Anywhere jobs.py accepts a Redis connection
+    (including ``jobs.CONN``), you can pass a JobsClient instead.
+
+    Arguments:
+        * conn - the Redis connection to use
+        * prefix=None - the prefix for all keys stored in Redis (defaults to
+            GLOBAL_PREFIX when the client is created)
+        * graph_history=None - whether jobs keep history of graph edges
+            unless told otherwise (defaults to GRAPH_HISTORY when the client
+            is created)
+    '''
+    def __init__(self, conn, prefix=None, graph_history=None):
+        self.conn = conn
+        self.prefix = GLOBAL_PREFIX if prefix is None else prefix
+        self.graph_history = GRAPH_HISTORY if graph_history is None else graph_history
+        # scripts known to be loaded on this connection
+        self.scripts = set()
+
+    def __repr__(self):
+        return "JobsClient(%r, prefix=%r)"%(self.conn, self.prefix)
+
+def _client(conn=None):
+    '''
+    Returns the JobsClient for the provided connection or JobsClient, using
+    jobs.CONN and the module-level settings by default.
+    '''
+    conn = conn or CONN
+    if isinstance(conn, JobsClient):
+        return conn
+    client = JobsClient(conn)
+    # share what we know about the server with other calls on the same pool
+    client.scripts = LOADED_SCRIPTS.setdefault(getattr(conn, 'connection_pool', conn), set())
+    return client
+
+
 def resource_manager(inputs, outputs, duration, wait=None, overwrite=True,
-        conn=None, graph_history=_GHD, suffix=None):
+        conn=None, graph_history=_GHD, suffix=None, fair=False):
     '''
     Arguments:
         * inputs - the list of inputs that need to exist to start the job
@@ -350,15 +609,17 @@ def resource_manager(inputs, outputs, duration, wait=None, overwrite=True,
             finish writing
         * overwrite=False - whether to overwrite a pre-existing output if it
             already exists
-        * conn=None - a Redis connection to use (provide here, or when
-            calling .start())
+        * conn=None - a Redis connection or JobsClient to use (provide here,
+            or when calling .start())
         * graph_history=True - whether to keep history of graph edges
+        * fair=False - whether to wait in line (first come, first served) with
+            other jobs using fair=True for contended inputs and outputs
     '''
     def wrap(fcn):
         @functools.wraps(fcn)
         def call(*args, **kwargs):
             manager = ResourceManager(inputs, outputs, duration, wait,
-                overwrite, conn, graph_history, _caller_name(fcn), suffix)
+                overwrite, conn, graph_history, _caller_name(fcn), suffix, fair)
             ex = False
             try:
                 return fcn(manager, *args, **kwargs)
@@ -373,7 +634,8 @@ def resource_manager(inputs, outputs, duration, wait=None, overwrite=True,
 
 class ResourceManager(object):
     def __init__(self, inputs, outputs, duration, wait=None, overwrite=True,
-            conn=None, graph_history=_GHD, identifier=None, suffix=None):
+            conn=None, graph_history=_GHD, identifier=None, suffix=None,
+            fair=False):
         '''
         Arguments:
             * inputs - the list of inputs that need to exist to start the job
@@ -385,9 +647,12 @@ class ResourceManager(object):
                 finish writing
             * overwrite=False - whether to overwrite a pre-existing output if it
                 already exists
-            * conn=None - a Redis connection to use (provide here, or when
-                calling .start())
+            * conn=None - a Redis connection or JobsClient to use (provide
+                here, or when calling .start())
             * graph_history=True - whether to keep history of graph edges
+            * fair=False - whether to wait in line (first come, first served)
+                with other jobs using fair=True for contended inputs and
+                outputs; jobs not using fair=True don't wait in line
         '''
         assert isinstance(inputs, (list, tuple, set)), inputs
         assert isinstance(outputs, (list, tuple, set)), outputs
@@ -397,10 +662,13 @@ class ResourceManager(object):
         self.wait = max(wait or 0, 0)
         self.overwrite = overwrite
         self.last_refreshed = None
+        # script arguments for our inputs and outputs, see _prepare_io()
+        self._io_cache = _IOCache()
         self.prefix_identifier(identifier or _caller_name(_get_caller()))
         self.conn = conn
-        self.graph_history = GRAPH_HISTORY if graph_history is _GHD else graph_history
+        self.graph_history = _client(conn).graph_history if graph_history is _GHD else graph_history
         self.auto_refresh = None
+        self.fair = fair
         self._lock = threading.RLock()
 
         # This is a symptom of bad design. But it exists because I need the
@@ -414,6 +682,7 @@ class ResourceManager(object):
         if self.is_running:
             raise RuntimeError("Can't add inputs after starting")
         self.inputs.extend(inputs)
+        self._io_cache.changed()
 
     def add_outputs(self, *outputs):
         '''
@@ -422,6 +691,7 @@ class ResourceManager(object):
         if self.is_running:
             raise RuntimeError("Can't add outputs after starting")
         self.outputs.extend(outputs)
+        self._io_cache.changed()
 
     @property
     def identifier(self):
@@ -447,6 +717,7 @@ class ResourceManager(object):
 
         # generate a 48 bit identifier using os.urandom, use decimal not hex
         self._identifier = NG(base_identifier)[int(binascii.hexlify(os.urandom(6)), 16)]
+        self._io_cache.changed()
 
     def can_run(self, conn=None):
         '''
@@ -458,7 +729,8 @@ class ResourceManager(object):
             raise RuntimeError("Cannot start a job without a connection to Redis!")
         if self.is_running:
             raise RuntimeError("Already started!")
-        return _run_if_possible(conn, self.inputs, self.outputs, self.identifier, 0, self.overwrite)
+        return _run_if_possible(conn, self.inputs, self.outputs, self.identifier, 0,
+            self.overwrite, cache=self._io_cache)
 
     def refresh(self, lost_lock_fail=False, **kwargs):
         '''
@@ -476,8 +748,14 @@ class ResourceManager(object):
         with self._lock:
             if self.is_running and time.time() - self.last_refreshed > 1:
                 DEFAULT_LOGGER.debug("Refreshing job locks")
-                lost = _refresh_job(self.conn, self.inputs, self.outputs,
-                    self.identifier, self.duration, self.overwrite)
+                refreshed_at = time.time()
+                lost = _renew_job(self.conn, self.identifier, self.inputs, self.outputs)
+                if lost.get('missing'):
+                    # our lease expired, check (and reacquire) everything
+                    lost = _refresh_job(self.conn, self.inputs, self.outputs,
+                        self.identifier, self.duration, self.overwrite, cache=self._io_cache)
+                _metric('observe', 'refresh.latency', time.time() - refreshed_at)
+                _failure_metrics(lost)
 
                 if lost.get('err') or lost.get('temp'):
                     if lost_lock_fail:
@@ -502,9 +780,9 @@ class ResourceManager(object):
         showing the bad/missing resources.
 
         If ``auto_refresh`` is provided, and can be considered boolean ``True``,
-        a background thread will try to call ``job.refresh()`` on this lock
-        once per second, until the job is explicitly stopped with ``.stop()``
-        or the process exits, whichever comes first.
+        a background thread will refresh this lock every third of its
+        ``duration`` (at most once per second), until the job is explicitly
+        stopped with ``.stop()`` or the process exits, whichever comes first.
         '''
         try:
             with self._lock:
@@ -535,52 +813,76 @@ class ResourceManager(object):
         DEFAULT_LOGGER.info("Trying to start job with inputs: %r and outputs: %r",
             self.inputs, self.outputs)
 
+        waiter = _ReleaseWaiter(self.conn) if PUSH_WAKEUPS and self.wait else None
+        # identifies our place in line for fair=True, unique to this .start()
+        token = binascii.hexlify(os.urandom(8)).decode('latin-1') if self.fair else None
+
+        started_at = time.time()
+        attempts = [0]
         def tr():
             DEFAULT_LOGGER.debug("Trying to start job")
+            attempts[0] += 1
             result = _run_if_possible(self.conn, self.inputs, self.outputs,
                 self.identifier, self.duration, self.overwrite,
-                history=self.graph_history)
+                history=self.graph_history, wake=bool(waiter), token=token,
+                count=attempts[0] == 1, cache=self._io_cache)
 
             if result['ok']:
-                DEFAULT_LOGGER.info("Starting job")
-                self.last_refreshed = time.time()
-                self.auto_refresh = bool(auto_refresh)
-                LOCKED.add(self)
+                self._started(auto_refresh)
+                _start_metrics(started_at, attempts[0], 'started')
                 return result, True
             else:
                 DEFAULT_LOGGER.debug("Failed to start job: %r", result)
+                _failure_metrics(result)
             return result, False
 
         # Report that we are still waiting after waiting for 1 second, the first
         # time.
         last_reported = time.time() - 29
         stop_waiting = time.time() + max(self.wait or 0, 0)
-        while time.time() < stop_waiting:
-            result, s = tr()
-            if s:
-                return self
+        try:
+            while time.time() < stop_waiting:
+                result, s = tr()
+                if s:
+                    return self
+
+                if 'output_exists' in result['err']:
+                    # We can't recover from "output exists" errors without
+                    # overwriting the output, and we only get the error when we
+                    # can't overwrite the output. Don't bother waiting any longer.
+                    break
 
-            if 'output_exists' in result['err']:
-                # We can't recover from "output exists" errors without
-                # overwriting the output, and we only get the error when we
-                # can't overwrite the output. Don't bother waiting any longer.
-                break
+                # Only print a message reporting the waiting status once every 30
+                # seconds
+                if time.time() - last_reported >= 30:
+                    DEFAULT_LOGGER.info("Still waiting to start job... %r", result['err'])
+                    last_reported = time.time()
 
-            # Only print a message reporting the waiting status once every 30
-            # seconds
-            if time.time() - last_reported >= 30:
-                DEFAULT_LOGGER.info("Still waiting to start job... %r", result['err'])
-                last_reported = time.time()
+                remaining = max(stop_waiting - time.time(), 0)
+                if waiter and waiter.wait(result, remaining):
+                    continue
 
-            # Wait up to 10ms between tests
-            time.sleep(min(max(stop_waiting - time.time(), 0), .01))
+                # Wait up to 10ms between tests
+                time.sleep(min(remaining, .01))
 
-        # try one more time before bailing out...
-        result, s = tr()
-        if s:
-            return self
+            # try one more time before bailing out...
+            result, s = tr()
+            if s:
+                return self
+        finally:
+            if waiter:
+                waiter.close()
+            if token and not self.is_running:
+                # give up our place in line
+                try:
+                    _leave_queues(self.conn, self.inputs, self.outputs, token,
+                        cache=self._io_cache)
+                except redis.exceptions.RedisError:
+                    DEFAULT_LOGGER.warning("Failed to leave the line for locks",
+                        exc_info=True)
 
         DEFAULT_LOGGER.info("Failed to start job: %r", result['err'])
+        _start_metrics(started_at, attempts[0], 'failed')
         raise ResourceUnavailable(result['err'])
 
     @property
@@ -605,13 +907,25 @@ class ResourceManager(object):
                 if shutting_down:
                     DEFAULT_LOGGER.warning("Stopping job as part of atexit/signal handler exit")
                 try:
+                    finished_at = time.time()
                     _finish_job(self.conn, self.inputs, self.outputs, self.identifier,
-                        failed=failed)
+                        failed=failed, cache=self._io_cache)
+                    _metric('observe', 'finish.latency', time.time() - finished_at)
                 finally:
-                    self.last_refreshed = None
-                    self.auto_refresh = None
-                    LOCKED.discard(self)
-                    AUTO_REFRESH.discard(self)
+                    self._stopped()
+
+    def _started(self, auto_refresh):
+        DEFAULT_LOGGER.info("Starting job")
+        self.last_refreshed = time.time()
+        self.auto_refresh = bool(auto_refresh)
+        LOCKED.add(self)
+        handle_auto_shutdown()
+
+    def _stopped(self):
+        self.last_refreshed = None
+        self.auto_refresh = None
+        LOCKED.discard(self)
+        AUTO_REFRESH.pop(self, None)
 
     def __enter__(self):
         return self.start(self.conn)
@@ -620,6 +934,384 @@ class ResourceManager(object):
         self.stop(bool(typ or value or tb))
 
 
+def start_many(managers, conn=None, auto_refresh=None):
+    '''
+    Starts many independent jobs together, using one round trip to Redis for
+    each attempt instead of one round trip per job. Jobs that can't be started
+    immediately are retried together until their own ``wait`` runs out, waking
+    up on release notifications (see PUSH_WAKEUPS) like .start() does, and
+    fair=True jobs wait in line like they do with .start(). Already-running
+    jobs are left alone.
+
+    Returns a list with one result per manager, in order: ``{'ok': True}`` for
+    started jobs, or ``{'ok': False, 'err': {...}}`` with the same errors that
+    ResourceUnavailable would have reported (which is *not* raised here).
+
+    If Redis fails part way through, the jobs that got their locks are still
+    marked as started (check ``.is_running``, and stop them with
+    finish_many()), and the error is raised.
+
+    Note: the usual "don't start more than one job in a process" warning
+    applies doubly.
+    '''
+    managers = list(managers)
+    results = [{'ok': True} for m in managers]
+    todo = []
+    for i, m in enumerate(managers):
+        m.conn = conn or m.conn or CONN
+        if not m.conn:
+            raise RuntimeError("Cannot start a job without a connection to Redis!")
+        if not m.identifier or not isinstance(m.identifier, (str, TYPE_NG)):
+            raise RuntimeError("Can't start job without a valid identifier")
+        if not m.is_running:
+            todo.append((time.time() + (m.wait or 0), i))
+
+    # any release wakes up the whole batch for another try
+    event = threading.Event()
+    waiters = {}
+    tokens = {}
+    for _, i in todo:
+        m = managers[i]
+        if PUSH_WAKEUPS and m.wait:
+            waiters[i] = _ReleaseWaiter(m.conn)
+            waiters[i].event = event
+        if m.fair:
+            tokens[i] = binascii.hexlify(os.urandom(8)).decode('latin-1')
+
+    DEFAULT_LOGGER.info("Trying to start %i jobs", len(todo))
+    first = True
+    try:
+        while todo:
+            calls = []
+            tried = {}
+            for _, i in todo:
+                m = managers[i]
+                kwargs = dict(history=m.graph_history, wake=i in waiters,
+                    token=tokens.get(i), count=first, cache=m._io_cache)
+                if len(_slot_groups(m.inputs, m.outputs)) > 1:
+                    # locked one slot group at a time
+                    try:
+                        tried[i] = _run_if_possible(m.conn, m.inputs, m.outputs,
+                            m.identifier, m.duration, m.overwrite, **kwargs)
+                    except redis.exceptions.RedisError as err:
+                        tried[i] = err
+                    continue
+                keys, args = _run_if_possible_args(m.conn, m.inputs, m.outputs,
+                    m.identifier, m.duration, m.overwrite, **kwargs)
+                calls.append((m.conn, (_run_if_possible_lua, keys, args)))
+
+            batch = iter(_script_pipeline_by_conn(calls, raise_on_error=False))
+            first = False
+            error = None
+            retry = []
+            block = None
+            for deadline, i in todo:
+                result = tried[i] if i in tried else next(batch)
+                if isinstance(result, Exception):
+                    error = error or result
+                    continue
+                if i not in tried:
+                    result = _lock_result(result)
+                results[i] = result
+                m = managers[i]
+                if result['ok']:
+                    with m._lock:
+                        m._started(auto_refresh)
+                    if m.auto_refresh:
+                        _start_auto_refresh(m)
+                    continue
+                remaining = deadline - time.time()
+                if 'output_exists' in result['err'] or remaining <= 0:
+                    result.pop('temp', None)
+                    result.pop('wake', None)
+                    continue
+                retry.append((deadline, i))
+                timeout = waiters[i].timeout(result, remaining) if i in waiters else None
+                if timeout is None:
+                    # Wait up to 10ms between tests
+                    timeout = min(remaining, .01)
+                block = timeout if block is None else min(block, timeout)
+
+            if error is not None:
+                # everyone that got their locks was marked as started above
+                raise error
+
+            todo = retry
+            if todo and block > 0:
+                event.wait(block)
+                event.clear()
+    finally:
+        for waiter in waiters.values():
+            waiter.close()
+        for i, token in tokens.items():
+            m = managers[i]
+            if not m.is_running:
+                # give up our place in line
+                try:
+                    _leave_queues(m.conn, m.inputs, m.outputs, token, cache=m._io_cache)
+                except redis.exceptions.RedisError:
+                    DEFAULT_LOGGER.warning("Failed to leave the line for locks",
+                        exc_info=True)
+
+    return results
+
+def finish_many(managers, failed=False):
+    '''
+    Stops many jobs together, using one round trip to Redis. If the optional
+    "failed" argument is true, outputs will not be set as available.
+
+    Returns a list with one boolean per manager, in order: whether that job
+    was running (and was stopped).
+    '''
+    managers = list(managers)
+    running = []
+    calls = []
+    try:
+        for m in managers:
+            m._lock.acquire()
+            if not m.is_running:
+                m._lock.release()
+                continue
+            running.append(m)
+            for group_inputs, group_outputs in _slot_groups(m.inputs, m.outputs):
+                keys, args = _finish_job_args(m.conn, group_inputs, group_outputs,
+                    m.identifier, failed, cache=m._io_cache)
+                calls.append((m.conn, (_finish_job_lua, keys, args)))
+    except:
+        # couldn't build the arguments, nothing was stopped
+        for m in running:
+            m._lock.release()
+        raise
+
+    DEFAULT_LOGGER.info("Stopping %i jobs failed = %r", len(running), bool(failed))
+    try:
+        _script_pipeline_by_conn(calls)
+    finally:
+        for m in running:
+            m._stopped()
+            m._lock.release()
+
+    running = set(running)
+    return [m in running for m in managers]
+
+def _script_pipeline_by_conn(calls, raise_on_error=True):
+    '''
+    Like _script_pipeline(), but for a list of ``(conn, (script, keys, args))``
+    pairs, with one round trip per distinct connection. With
+    ``raise_on_error=False``, errors (including a failed round trip, for every
+    call on that connection) are returned in place of their results.
+    '''
+    by_conn = defaultdict(list)
+    for i, (conn, call) in enumerate(calls):
+        by_conn[id(conn)].append((i, conn, call))
+    results = [None] * len(calls)
+    for group in by_conn.values():
+        try:
+            group_results = _script_pipeline(group[0][1], [c for _, _, c in group],
+                raise_on_error=raise_on_error)
+        except redis.exceptions.RedisError as err:
+            if raise_on_error:
+                raise
+            group_results = [err] * len(group)
+        for (i, _, _), result in zip(group, group_results):
+            results[i] = result
+    return results
+
+
+# Failure reasons that can be resolved by another job finishing (or by a lock
+# expiring), and which are worth waiting for a release notification on.
+WAIT_REASONS = ('input_missing', 'output_locked', 'output_used',
+    'input_queued', 'output_queued')
+LISTENERS = {}
+GRAPH_NAMES = {}
+ARROW = ' -> '
+_LISTENERS_LOCK = threading.Lock()
+
+def _release_channel(key, prefix=None):
+    return (GLOBAL_PREFIX if prefix is None else prefix) + 'jobs:release:' + _cluster_key(key)
+
+def _release_listener(conn):
+    '''
+    Returns the (shared, per connection pool) release listener for the
+    provided connection, or None if the connection can't do pub/sub.
+    '''
+    if not callable(getattr(conn, 'pubsub', None)):
+        return None
+    pool = getattr(conn, 'connection_pool', conn)
+    with _LISTENERS_LOCK:
+        listener = LISTENERS.get(pool)
+        if listener is None or listener.broken:
+            listener = LISTENERS[pool] = _ReleaseListener(conn)
+        return listener
+
+class _ReleaseListener(object):
+    '''
+    Internal implementation detail; one pub/sub connection and thread per
+    process (and connection pool) receives the release notifications
+    published by _finish_job_lua(), and wakes up the local waiters for the
+    released keys.
+
+    Note: every waiter on a released key is woken up and retries, and waiters
+    still re-check their locks every POLL_FALLBACK seconds, so Redis load
+    grows with the number of waiters (just much slower than polling).
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self.pubsub = None
+        self.thread = None
+        self.broken = False
+        self.waiters = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def subscribe(self, waiter, channels):
+        with self.lock:
+            if self.broken:
+                raise redis.exceptions.ConnectionError("release listener failed")
+            new = [ch for ch in channels if not self.waiters[ch]]
+            for ch in channels:
+                self.waiters[ch].add(waiter)
+            if new:
+                if self.pubsub is None:
+                    self.pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+                self.pubsub.subscribe(*new)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._listen)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unsubscribe(self, waiter, channels):
+        with self.lock:
+            old = []
+            for ch in channels:
+                self.waiters[ch].discard(waiter)
+                if not self.waiters[ch]:
+                    del self.waiters[ch]
+                    old.append(ch)
+            if old and self.pubsub is not None and not self.broken:
+                try:
+                    self.pubsub.unsubscribe(*old)
+                except redis.exceptions.RedisError:
+                    pass
+
+    def _listen(self):
+        try:
+            while True:
+                with self.lock:
+                    if not self.waiters:
+                        # the last waiter left, let go of our connection;
+                        # subscribe() starts over
+                        pubsub, self.pubsub, self.thread = self.pubsub, None, None
+                        if pubsub is not None:
+                            pubsub.close()
+                        return
+                    pubsub = self.pubsub
+                message = pubsub.get_message(timeout=1)
+                if not message:
+                    continue
+                channel = message['channel']
+                if not isinstance(channel, str):
+                    channel = channel.decode('latin-1')
+                with self.lock:
+                    waiters = list(self.waiters.get(channel, ()))
+                for waiter in waiters:
+                    waiter.event.set()
+        except Exception:
+            DEFAULT_LOGGER.warning("Release listener failed, polling for locks",
+                exc_info=True)
+            with self.lock:
+                self.broken = True
+                waiters = set(w for ws in self.waiters.values() for w in ws)
+            # let everyone fall back to polling
+            for waiter in waiters:
+                waiter.event.set()
+
+class _ReleaseWaiter(object):
+    '''
+    Internal implementation detail; used by ResourceManager.start() to block on
+    the release notifications published by _finish_job_lua() for the keys that
+    prevented a job from starting, instead of polling every 10ms.
+    '''
+    def __init__(self, conn):
+        client = _client(conn)
+        self.listener = _release_listener(client.conn)
+        self.prefix = client.prefix
+        self.event = threading.Event()
+        self.channels = set()
+
+    def wait(self, result, timeout):
+        '''
+        Waits up to ``timeout`` seconds for a key related to the failed
+        ``result`` to be released. Returns True if the caller should try again
+        immediately, or False if the caller should fall back to polling.
+        '''
+        timeout = self.timeout(result, timeout)
+        if timeout is None:
+            return False
+        if timeout > 0:
+            self.event.wait(timeout)
+            self.event.clear()
+        return True
+
+    def timeout(self, result, timeout):
+        '''
+        Subscribes to the keys related to the failed ``result``, and returns
+        how long (at most ``timeout`` seconds) to block on ``self.event`` before
+        trying again, 0 to try again immediately, or None if the caller should
+        fall back to polling.
+        '''
+        if self.listener is None or self.listener.broken:
+            return None
+
+        err = result.get('err') or {}
+        channels = set(_release_channel(key, self.prefix)
+            for why in WAIT_REASONS for key in err.get(why, ()))
+        if not channels:
+            return None
+
+        new = channels - self.channels
+        if new:
+            try:
+                self.listener.subscribe(self, new)
+            except redis.exceptions.RedisError:
+                DEFAULT_LOGGER.warning("Release notifications unavailable, polling for locks",
+                    exc_info=True)
+                self.close()
+                self.listener = None
+                return None
+            self.channels.update(new)
+            # A release may have happened before we subscribed, so check
+            # again before blocking.
+            return 0
+
+        # Locks that expire don't announce themselves, but the lock script
+        # tells us when the earliest blocking lock will expire.
+        timeout = min(timeout, POLL_FALLBACK)
+        if result.get('wake') is not None:
+            timeout = min(timeout, result['wake'] + .001)
+        return max(timeout, 0)
+
+    def close(self):
+        if self.listener is not None and self.channels:
+            self.listener.unsubscribe(self, self.channels)
+        self.channels.clear()
+
+
+def _publish_release(conn, keys, prefix=None):
+    '''
+    Wakes up jobs waiting on the provided keys.
+    '''
+    client = _client(conn)
+    prefix = client.prefix if prefix is None else prefix
+    pipe = client.conn.pipeline(False)
+    for key in keys:
+        pipe.publish(_release_channel(key, prefix), '')
+    pipe.execute()
+
+def _helper_prefix(conn):
+    # the helpers below work on the keys as given (like they always have),
+    # unless they are handed a JobsClient with its own prefix
+    return conn.prefix if isinstance(conn, JobsClient) else ''
+
 def _create_outputs(outputs, conn=None, identifier=None, suffix=None):
     '''
     Sometimes you just need outputs to exist. These creates outputs.
@@ -627,7 +1319,17 @@ def _create_outputs(outputs, conn=None, identifier=None, suffix=None):
     identifier = NG(identifier or _caller_name(_get_caller()))
     if suffix:
         identifier = identifier[suffix]
-    (conn or CONN).mset(**{o:identifier for o in outputs})
+    client = _client(conn)
+    prefix = _helper_prefix(conn)
+    if CLUSTER_TAGS:
+        # the outputs can be in different slots
+        pipe = client.conn.pipeline(False)
+        for o in outputs:
+            pipe.set(prefix + _cluster_key(o), identifier)
+        pipe.execute()
+    else:
+        client.conn.mset(**{prefix + o:identifier for o in outputs})
+    _publish_release(client, outputs, prefix)
 
 
 def _force_unlock(inputs, outputs, conn=None):
@@ -635,92 +1337,340 @@ def _force_unlock(inputs, outputs, conn=None):
     Sometimes you just need to unlock some inputs and outputs. This unlocks
     inputs and outputs.
     '''
-    inputs = [i if i.startswith('ilock:') else ('ilock:' + i) for i in inputs]
-    outputs = [o if o.startswith('olock:') else ('olock:' + o) for o in outputs]
-    io = inputs + outputs
+    inputs = [i[6:] if i.startswith('ilock:') else i for i in inputs]
+    outputs = [o[6:] if o.startswith('olock:') else o for o in outputs]
+    client = _client(conn)
+    prefix = _helper_prefix(conn)
+    io = [prefix + 'ilock:' + _cluster_key(i) for i in inputs] + \
+        [prefix + 'olock:' + _cluster_key(o) for o in outputs]
     if io:
-        return (conn or CONN).delete(*io)
+        try:
+            return client.conn.delete(*io)
+        finally:
+            _publish_release(client, inputs + outputs, prefix)
 
 
+def _namespace(name):
+    return str(name).partition('.')[0]
+
+def _cluster_key(name):
+    '''
+    Returns the name used in Redis keys for the provided input or output, which
+    is hash-tagged by its namespace when CLUSTER_TAGS is true:
+    ``reporting.events.2016-01-01`` -> ``{reporting}.events.2016-01-01``
+    '''
+    name = str(name)
+    if not CLUSTER_TAGS or name.startswith('{'):
+        return name
+    ns, dot, rest = name.partition('.')
+    return '{%s}%s%s'%(ns, dot, rest)
+
+def _uncluster_key(name):
+    if CLUSTER_TAGS and name.startswith('{'):
+        return name[1:].replace('}', '', 1)
+    return name
+
+def _jobs_prefix(locks=(), prefix=None):
+    '''
+    Returns the prefix for the ``jobs:*`` bookkeeping keys that go with the
+    provided (already hash-tagged) lock names.
+    '''
+    prefix = GLOBAL_PREFIX if prefix is None else prefix
+    if CLUSTER_TAGS:
+        for name in locks:
+            if name:
+                return prefix + name[:name.index('}') + 1] + 'jobs:'
+    return prefix + 'jobs:'
+
+def _namespace_jobs_prefix(namespace=None, prefix=None):
+    return _jobs_prefix([] if namespace is None else [_cluster_key(namespace)], prefix)
+
+def _slot_groups(inputs, outputs):
+    '''
+    Splits inputs and outputs into groups that can be locked together in one
+    call, in the order they should be locked. That's everything at once,
+    unless CLUSTER_TAGS is true, when there is one group per namespace.
+    '''
+    if not CLUSTER_TAGS:
+        return [(inputs, outputs)]
+    groups = defaultdict(lambda: ([], []))
+    for inp in inputs:
+        groups[_namespace(inp)][0].append(inp)
+    for out in outputs:
+        groups[_namespace(out)][1].append(out)
+    return [groups[ns] for ns in sorted(groups)] or [(inputs, outputs)]
+
+def _merge_results(results):
+    '''
+    Merges the _lock_result()s of the slot groups of one job.
+    '''
+    if len(results) == 1:
+        return results[0]
+    merged = {'ok': all(r['ok'] for r in results)}
+    for part in ('err', 'temp'):
+        combined = defaultdict(list)
+        for r in results:
+            for why, keys in (r.get(part) or {}).items():
+                combined[why].extend(keys)
+        if combined or not merged['ok']:
+            merged[part] = dict(combined)
+    wakes = [r['wake'] for r in results if r.get('wake') is not None]
+    if any('wake' in r for r in results):
+        merged['wake'] = min(wakes) if wakes else None
+    return merged
+
+def _prepare_io(inputs, outputs, identifier, history):
+    '''
+    Returns the (locks, input_count, graph, identifier) arguments for the
+    scripts, for the provided inputs and outputs of one slot group. The locks
+    are the inputs followed by the outputs, and are passed as KEYS, so that
+    they all hash to the same slot with CLUSTER_TAGS.
+    '''
+    assert isinstance(inputs, (list, tuple, set)), inputs
+    assert isinstance(outputs, (list, tuple, set)), outputs
+    assert '' not in inputs, inputs
+    assert '' not in outputs, outputs
+    # this is for actually locking inputs/outputs
+    inputs, outputs = list(map(str, inputs)), list(map(str, outputs))
+    locks = list(map(_cluster_key, inputs)) + list(map(_cluster_key, outputs))
+    assert len(_slot_groups(inputs, outputs)) == 1, (inputs, outputs)
+
+    if history:
+        igraph = [_fix_edge(inp) for inp in inputs]
+        ograph = [_fix_edge(out) for out in outputs]
+        graph_id = _fix_edge(str(identifier))
+        graph = igraph + [''] + ograph + ['', graph_id]
+        if all(x.startswith('test.') for x in igraph + ograph):
+            graph = ['', '']
+    else:
+        graph = ['', '']
+    return locks, len(inputs), graph, str(identifier)
+
+class _IOCache(dict):
+    '''
+    Internal implementation detail; ResourceManager._io_cache, whose
+    ``version`` is bumped by .changed() whenever the manager's inputs, outputs,
+    or identifier change, so _check_inputs_and_outputs() doesn't need to
+    compare them on every call.
+    '''
+    version = 0
+
+    def changed(self):
+        self.version += 1
+        self.clear()
+
 def _check_inputs_and_outputs(fcn):
+    '''
+    Translates the inputs, outputs, and identifier for the decorated function,
+    see _prepare_io(). Pass a dictionary as ``cache`` (like
+    ResourceManager._io_cache) to remember the results for the next call with
+    the same arguments.
+    '''
     @functools.wraps(fcn)
     def call(conn, inputs, outputs, identifier, *a, **kw):
-        assert isinstance(inputs, (list, tuple, set)), inputs
-        assert isinstance(outputs, (list, tuple, set)), outputs
-        assert '' not in inputs, inputs
-        assert '' not in outputs, outputs
-        # this is for actually locking inputs/outputs
-        inputs, outputs = list(map(str, inputs)), list(map(str, outputs))
-        locks = inputs + [''] + outputs
-
-        if kw.pop('history', None):
-            igraph = [EDGE_RE.sub('*', inp) for inp in inputs]
-            ograph = [EDGE_RE.sub('*', out) for out in outputs]
-            graph_id = EDGE_RE.sub('*', str(identifier))
-            graph = igraph + [''] + ograph + ['', graph_id]
-            if all(x.startswith('test.') for x in igraph + ograph):
-                graph = ['', '']
+        history = bool(kw.pop('history', None))
+        cache = kw.pop('cache', None)
+        if cache is None:
+            prepared = _prepare_io(inputs, outputs, identifier, history)
         else:
-            graph = ['', '']
+            if isinstance(cache, _IOCache):
+                # identifier too, as the manager's .suffix can change, and the
+                # namespace of the slot group with CLUSTER_TAGS
+                group = CLUSTER_TAGS and _namespace((list(inputs) or list(outputs) or [''])[0])
+                key = (cache.version, group, identifier, history, CLUSTER_TAGS)
+            else:
+                key = (tuple(inputs), tuple(outputs), identifier, history, CLUSTER_TAGS)
+            prepared = cache.get(key)
+            if prepared is None:
+                prepared = cache[key] = _prepare_io(inputs, outputs, identifier, history)
 
-        return fcn(conn, locks, graph, str(identifier), *a, **kw)
+        locks, input_count, graph, identifier = prepared
+        return fcn(conn, locks, input_count, graph, identifier, *a, **kw)
     return call
 
-def _fix_err(result):
-    # Translate list of error types to a dictionary of grouped errors.
-    def _fix(d):
-        err = defaultdict(list)
-        for why, key in d:
-            err[why].append(key)
-        return dict(err)
-
-    if result.get('err'):
-        result['err'] = _fix(result['err'])
-    if result.get('temp'):
-        result['temp'] = _fix(result['temp'])
-    return result
+def _fix_err(flat):
+    # Translate a flat list of error types and keys to a dictionary of grouped
+    # errors.
+    err = defaultdict(list)
+    for i in range(0, len(flat), 2):
+        why, key = flat[i:i+2]
+        if not isinstance(why, TEXT_TYPE):
+            why, key = why.decode('latin-1'), key.decode('latin-1')
+        err[why].append(_uncluster_key(key))
+    return dict(err)
+
+def _lock_result(result):
+    '''
+    Parses the result of a _run_if_possible_lua() or _renew_job_lua() call, see
+    _LOCK_REPLY_LUA.
+    '''
+    status, wake, err, temp = result
+    if status < 0:
+        return {'ok': False, 'missing': True}
+    parsed = {'ok': status == 1}
+    if not parsed['ok']:
+        parsed['err'] = _fix_err(err)
+        parsed['temp'] = _fix_err(temp)
+    elif temp:
+        parsed['temp'] = _fix_err(temp)
+    if wake is not None:
+        parsed['wake'] = float(wake)
+    return parsed
 
 @_check_inputs_and_outputs
-def _run_if_possible(conn, inputs_outputs, graph, identifier, duration, overwrite):
+def _run_if_possible_args(conn, inputs_outputs, input_count, graph, identifier,
+        duration, overwrite, wake=False, token=None, count=True):
+    '''
+    Internal call to build the KEYS and ARGV for _run_if_possible_lua() when
+    starting a job, see _run_if_possible().
+    '''
+    prefix = _client(conn).prefix
+    return inputs_outputs, [
+        prefix,
+        _jobs_prefix(inputs_outputs, prefix),
+        identifier,
+        repr(time.time()),
+        duration,
+        int(bool(overwrite)),
+        0, # refresh
+        int(bool(wake)),
+        token or '',
+        max(3 * POLL_FALLBACK, 1),
+        SWEEP_LIMIT,
+        GRAPH_MAX_AGE or 0,
+        GRAPH_MAX_EDGES or 0,
+        GRAPH_SUMMARY_DAYS if GRAPH_SUMMARY else 0,
+        int(bool(GRAPH_INTERN)),
+        GRAPH_GRANULARITY or 0,
+        CONTENTION_BUCKET if CONTENTION_STATS and count else 0,
+        CONTENTION_MAX_AGE,
+        input_count] + graph
+
+def _run_if_possible(conn, inputs, outputs, identifier, duration, overwrite, **kwargs):
     '''
     Internal call to run a job if possible, only acquiring the locks if all are
-    available.
-    '''
-    return _fix_err(json.loads(_run_if_possible_lua(conn, keys=inputs_outputs,
-        args=[json.dumps({
-            'prefix': GLOBAL_PREFIX,
-            'id': identifier,
-            'now': time.time(),
-            'duration': duration,
-            'overwrite': bool(overwrite),
-            'refresh': False,
-            'edges': graph})]
-    ).decode('latin-1')))
+    available. If ``wake`` is true and the job can't be started, the result will
+    include a 'wake' entry with the number of seconds until the earliest lock
+    blocking the job expires (if any).
+
+    If a ``token`` is provided, the job is started fairly: it won't jump ahead
+    of other fair jobs already waiting in line for the same keys, and will get
+    in line itself (identified by the token) if it can't be started.
+
+    With CONTENTION_STATS, failures are only counted if ``count`` is true (the
+    default), which callers that retry only pass for their first attempt.
+
+    With CLUSTER_TAGS, each slot group is locked in order, and if any group
+    can't be locked, the groups that were locked are released again.
+    '''
+    groups = _slot_groups(inputs, outputs)
+    results = []
+    for group_inputs, group_outputs in groups:
+        keys, args = _run_if_possible_args(conn, group_inputs, group_outputs,
+            identifier, duration, overwrite, **kwargs)
+        results.append(_lock_result(_run_if_possible_lua(conn, keys=keys, args=args)))
+        if not results[-1]['ok']:
+            if duration:
+                # don't hold some of our locks while waiting for the others
+                for group_inputs, group_outputs in groups[:len(results) - 1]:
+                    _finish_job(conn, group_inputs, group_outputs, identifier,
+                        failed=True, cache=kwargs.get('cache'))
+            break
+    return _merge_results(results)
 
 @_check_inputs_and_outputs
-def _refresh_job(conn, inputs_outputs, graph, identifier, duration, overwrite):
+def _refresh_job_args(conn, inputs_outputs, input_count, graph, identifier,
+        duration, overwrite):
+    '''
+    Internal call to build the KEYS and ARGV for _run_if_possible_lua() when
+    refreshing a job.
+    '''
+    prefix = _client(conn).prefix
+    return inputs_outputs, [
+        prefix,
+        _jobs_prefix(inputs_outputs, prefix),
+        identifier,
+        repr(time.time()),
+        duration,
+        int(bool(overwrite)),
+        1, # refresh
+        0, '', 0, SWEEP_LIMIT, 0, 0, 0, 0, 0, 0, 0, input_count]
+
+def _refresh_job(conn, inputs, outputs, identifier, duration, overwrite, cache=None):
     '''
     Internal call to refresh a job that already has a lock.
     '''
-    return _fix_err(json.loads(_run_if_possible_lua(conn, keys=inputs_outputs,
-        args=[json.dumps({
-            'prefix': GLOBAL_PREFIX,
-            'id': identifier,
-            'now': time.time(),
-            'duration': duration,
-            'overwrite': bool(overwrite),
-            'refresh': True,
-            'edges': []})]
-    ).decode('latin-1')))
+    results = []
+    for group_inputs, group_outputs in _slot_groups(inputs, outputs):
+        keys, args = _refresh_job_args(conn, group_inputs, group_outputs,
+            identifier, duration, overwrite, cache=cache)
+        results.append(_lock_result(_run_if_possible_lua(conn, keys=keys, args=args)))
+    return _merge_results(results)
+
+def _renew_job_args(conn, identifier, name=None):
+    '''
+    Internal call to build the KEYS and ARGV for _renew_job_lua(). With
+    CLUSTER_TAGS, pass one of the job's inputs or outputs as ``name`` to renew
+    the locks in its slot group.
+
+    Only the lease and running record are passed as KEYS; the script reads the
+    lock keys from the running record, which assumes they share its hash slot
+    (true of every key in a namespace with CLUSTER_TAGS).
+    '''
+    identifier = str(identifier)
+    prefix = _client(conn).prefix
+    jprefix = _namespace_jobs_prefix(name, prefix)
+    keys = [jprefix + 'lease:' + identifier, jprefix + 'running:' + identifier]
+    return keys, [identifier, repr(time.time()), prefix, jprefix, SWEEP_LIMIT]
+
+def _renew_job(conn, identifier, inputs=(), outputs=()):
+    '''
+    Internal call to refresh a job that already has a lock, by identifier
+    alone (the inputs and outputs are only needed with CLUSTER_TAGS). Returns
+    ``{'ok': False, 'missing': True}`` if the job's lease is gone, in which
+    case you should fall back to _refresh_job().
+    '''
+    results = []
+    for group_inputs, group_outputs in _slot_groups(list(inputs), list(outputs)):
+        keys, args = _renew_job_args(conn, identifier, (group_inputs + group_outputs + [None])[0])
+        results.append(_lock_result(_renew_job_lua(conn, keys=keys, args=args)))
+        if results[-1].get('missing'):
+            return results[-1]
+    return _merge_results(results)
 
 @_check_inputs_and_outputs
-def _finish_job(conn, inputs_outputs, graph, identifier, failed=False):
+def _leave_queues_args(conn, inputs_outputs, input_count, graph, token):
+    '''
+    Internal call to build the KEYS and ARGV for _leave_queues_lua().
+    '''
+    prefix = _client(conn).prefix
+    return inputs_outputs, [token, prefix, _jobs_prefix(inputs_outputs, prefix)]
+
+def _leave_queues(conn, inputs, outputs, token, cache=None):
+    '''
+    Internal call to remove a fair job that gave up waiting from the line.
+    '''
+    for group_inputs, group_outputs in _slot_groups(inputs, outputs):
+        keys, args = _leave_queues_args(conn, group_inputs, group_outputs, token, cache=cache)
+        _leave_queues_lua(conn, keys=keys, args=args)
+
+@_check_inputs_and_outputs
+def _finish_job_args(conn, inputs_outputs, input_count, graph, identifier, failed=False):
+    '''
+    Internal call to build the KEYS and ARGV for _finish_job_lua().
+    '''
+    prefix = _client(conn).prefix
+    return inputs_outputs, [identifier, repr(time.time()), int(not failed),
+        prefix, _jobs_prefix(inputs_outputs, prefix), SWEEP_LIMIT, input_count]
+
+def _finish_job(conn, inputs, outputs, identifier, failed=False, cache=None):
     '''
     Internal call to finish a job.
     '''
-    _finish_job_lua(conn, keys=inputs_outputs,
-        args=[json.dumps([identifier, time.time(), not failed, GLOBAL_PREFIX])]
-    )
+    for group_inputs, group_outputs in _slot_groups(inputs, outputs):
+        keys, args = _finish_job_args(conn, group_inputs, group_outputs, identifier,
+            failed, cache=cache)
+        _finish_job_lua(conn, keys=keys, args=args)
 
 def _caller_name(code):
     if callable(code):
@@ -731,29 +1681,53 @@ def _get_caller():
     return sys._getframe(2).f_code
 
 NO_SCRIPT_MESSAGES = ['NOSCRIPT', 'No matching script.']
-def _script_load(script):
+# {connection pool: scripts known to be loaded}, for connections that aren't
+# wrapped in a JobsClient, see _client()
+LOADED_SCRIPTS = {}
+SCRIPTS = []
+# in JobsClient.scripts when the server doesn't have Redis Functions
+NO_FUNCTIONS = 'no-functions'
+_FUNCTIONS = []
+
+def _script_load(script, name=None):
     '''
     Re-borrowed from:
     https://github.com/josiahcarlson/rom/blob/master/rom/util.py
+
+    Named scripts are also part of the Redis Functions library, see
+    load_functions().
     '''
     script = script.encode('utf-8') if isinstance(script, TEXT_TYPE) else script
-    sha = [None, sha1(script).hexdigest()]
     def call(conn, keys=[], args=[], force_eval=False):
+        sha = _script_sha(call)
+        client = _client(conn)
+        conn = client.conn
         keys = tuple(keys)
         args = tuple(args)
+        if USE_FUNCTIONS and name and not force_eval and NO_FUNCTIONS not in client.scripts:
+            for attempt in range(2):
+                try:
+                    return conn.execute_command(
+                        'FCALL', _functions()[0] + '_' + name, len(keys), *(keys + args))
+                except redis.exceptions.ResponseError as msg:
+                    if attempt or not _function_error(client, msg):
+                        raise
+                if NO_FUNCTIONS in client.scripts:
+                    break
+
         if not force_eval:
-            if not sha[0]:
+            if sha not in client.scripts:
                 try:
                     # executing the script implicitly loads it
                     return conn.execute_command(
                         'EVAL', script, len(keys), *(keys + args))
                 finally:
                     # thread safe by re-using the GIL ;)
-                    del sha[:-1]
+                    client.scripts.add(sha)
 
             try:
                 return conn.execute_command(
-                    "EVALSHA", sha[0], len(keys), *(keys+args))
+                    "EVALSHA", sha, len(keys), *(keys+args))
 
             except redis.exceptions.ResponseError as msg:
                 if not any(msg.args[0].startswith(nsm) for nsm in NO_SCRIPT_MESSAGES):
@@ -762,43 +1736,363 @@ def _script_load(script):
         return conn.execute_command(
             "EVAL", script, len(keys), *(keys+args))
 
+    # hashed on first use, see _script_sha()
+    call.sha = None
+    call.script = script
+    call.name = name
+    if name:
+        SCRIPTS.append(call)
     return call
 
-_run_if_possible_lua = _script_load('''
--- KEYS - list of inputs and outputs to lock, separated by an empty string:
---        {'input', '', 'output'}
--- ARGV - {json.dumps({
---     prefix: key_prefix,
---     id: identifier,
---     now: timestamp,
---     duration: lock_duration_in_seconds,
---     overwrite: overwrite_as_boolean,
---     refresh: refresh_as_boolean,
---       -- If there is a graph history, these edges represent them.
---     edges: [inputs, '', outputs, '', graph_id]
--- })}
+def _script_sha(script):
+    '''
+    Returns the SHA1 of a script from _script_load(), computing it the first
+    time it's needed.
+    '''
+    if script.sha is None:
+        script.sha = sha1(script.script).hexdigest()
+    return script.sha
 
-local args = cjson.decode(ARGV[1])
+def _functions():
+    '''
+    Returns the name of the Redis Functions library for the scripts in this
+    version of jobs.py, and its code. Function names are prefixed with the
+    library name, so different versions can be loaded side by side.
+    '''
+    if not _FUNCTIONS:
+        library = 'jobspy_' + sha1(b''.join(c.script for c in SCRIPTS)).hexdigest()[:12]
+        code = ['#!lua name=' + library]
+        for c in SCRIPTS:
+            # the script bodies already use KEYS and ARGV
+            code.append("redis.register_function('%s_%s', function(KEYS, ARGV)\n%s\nend)"%(
+                library, c.name, c.script.decode('utf-8')))
+        _FUNCTIONS[:] = [library, '\n'.join(code)]
+    return _FUNCTIONS
+
+def load_functions(conn=None):
+    '''
+    Registers jobs.py's Lua scripts with Redis as a Functions library (Redis
+    7+), so that processes with ``jobs.USE_FUNCTIONS = True`` call them with
+    FCALL, without sending or compiling any scripts. Processes load the library
+    themselves when it is missing, but you can call this once when deploying.
+    Safe to call repeatedly, and from several processes.
+
+    Returns whether the server supports Redis Functions.
+    '''
+    client = _client(conn)
+    library, code = _functions()
+    try:
+        client.conn.execute_command('FUNCTION', 'LOAD', code)
+    except redis.exceptions.ResponseError as msg:
+        if _unknown_command(msg):
+            client.scripts.add(NO_FUNCTIONS)
+            return False
+        if 'already exists' not in msg.args[0]:
+            raise
+    client.scripts.add(library)
+    return True
+
+def _unknown_command(msg):
+    return 'unknown command' in msg.args[0].lower()
+
+def _function_error(client, msg):
+    '''
+    Handles an FCALL error by loading the library, or by falling back to
+    EVALSHA on servers without Redis Functions. Returns whether to retry.
+    '''
+    if _unknown_command(msg):
+        client.scripts.add(NO_FUNCTIONS)
+        return True
+    if 'function not found' in msg.args[0].lower():
+        client.scripts.discard(_functions()[0])
+        load_functions(client)
+        return True
+    return False
+
+def _use_functions(client):
+    '''
+    Returns whether to use FCALL with the provided client, checking for (and
+    loading) the library once per JobsClient (or connection pool).
+    '''
+    if not USE_FUNCTIONS or NO_FUNCTIONS in client.scripts:
+        return False
+    library = _functions()[0]
+    if library in client.scripts:
+        return True
+    try:
+        found = client.conn.execute_command('FUNCTION', 'LIST', 'LIBRARYNAME', library)
+    except redis.exceptions.ResponseError as msg:
+        if not _unknown_command(msg):
+            raise
+        client.scripts.add(NO_FUNCTIONS)
+        return False
+    if found:
+        client.scripts.add(library)
+        return True
+    return load_functions(client)
+
+def _script_pipeline(conn, calls, raise_on_error=True):
+    '''
+    Executes many script calls in one round trip to Redis. ``calls`` is a
+    list of ``(script, keys, args)`` tuples, where ``script`` was returned by
+    _script_load(). Returns the list of results, in order (with errors in
+    place of their results if ``raise_on_error`` is false).
+    '''
+    client = _client(conn)
+    def run(todo):
+        pipe = client.conn.pipeline(False)
+        if _use_functions(client):
+            library = _functions()[0]
+            for i in todo:
+                script, keys, args = calls[i]
+                keys = tuple(keys)
+                pipe.execute_command('FCALL', library + '_' + script.name,
+                    len(keys), *(keys + tuple(args)))
+            return pipe.execute(raise_on_error=False)
+
+        # load scripts on first use with this connection, in the same round trip
+        for script in set(calls[i][0] for i in todo):
+            if _script_sha(script) not in client.scripts:
+                pipe.execute_command('SCRIPT', 'LOAD', script.script)
+                client.scripts.add(script.sha)
+        for i in todo:
+            script, keys, args = calls[i]
+            keys = tuple(keys)
+            pipe.execute_command('EVALSHA', script.sha, len(keys), *(keys + tuple(args)))
+        return pipe.execute(raise_on_error=False)
+
+    results = [None] * len(calls)
+    todo = list(range(len(calls)))
+    for attempt in range(2):
+        if not todo:
+            break
+        missing = []
+        for i, result in zip(todo, run(todo)[-len(todo):]):
+            if isinstance(result, redis.exceptions.ResponseError) and (
+                    any(result.args[0].startswith(nsm) for nsm in NO_SCRIPT_MESSAGES) or
+                    'function not found' in result.args[0].lower()):
+                missing.append(i)
+            results[i] = result
+        if missing:
+            # the scripts (or functions) were flushed, load them again with
+            # our next try
+            client.scripts.difference_update(calls[i][0].sha for i in missing)
+            client.scripts.discard(_functions()[0])
+        todo = missing
+
+    for result in results:
+        if raise_on_error and isinstance(result, Exception):
+            raise result
+    return results
+
+_GRAPH_TRIM_LUA = '''
+-- Removes at most `limit` edges from graph:input and graph:output that were
+-- last seen more than `max_age` seconds ago, or are past the `max_edges` most
+-- recently seen, along with their adjacency set entries. With `summary` > 0,
+-- the edges are moved to the graph:daily:<input or output>:<day> ZSETs
+-- instead, by days since the epoch, which expire `summary` days after their
+-- day. Zero means no limit (or no summary). Bumps graph:generation when
+-- edges are removed, see GraphSnapshot. Returns the number of edges removed.
+local function trim_graph(jprefix, now, max_age, max_edges, summary, limit)
+    local removed = 0
+    -- don't drop an adjacency entry for the same edge seen more recently
+    local function unlink(key, member, score)
+        local seen = redis.call('zscore', key, member)
+        if seen and tonumber(seen) <= score then
+            redis.call('zrem', key, member)
+        end
+    end
+    for _, kind in ipairs({'input', 'output'}) do
+        local key = jprefix .. 'graph:' .. kind
+        local count = 0
+        if max_age > 0 then
+            count = redis.call('zcount', key, '-inf', '(' .. (now - max_age))
+        end
+        if max_edges > 0 then
+            count = math.max(count, redis.call('zcard', key) - max_edges)
+        end
+        count = math.min(count, limit - removed)
+        if count > 0 then
+            local old = redis.call('zrange', key, 0, count - 1, 'withscores')
+            for i = 1, #old, 2 do
+                local edge = old[i]
+                local score = tonumber(old[i + 1])
+                local at, stop = string.find(edge, ' -> ', 1, true)
+                if not at then
+                    -- interned, see GRAPH_INTERN
+                    at, stop = string.find(edge, ':', 1, true)
+                end
+                if at then
+                    local left = string.sub(edge, 1, at - 1)
+                    local right = string.sub(edge, stop + 1)
+                    unlink(jprefix .. 'graph:next:' .. left, right, score)
+                    unlink(jprefix .. 'graph:prev:' .. right, left, score)
+                end
+                if summary > 0 then
+                    local day = math.floor(score / 86400)
+                    local daily = jprefix .. 'graph:daily:' .. kind .. ':' .. day
+                    redis.call('zadd', daily, score, edge)
+                    redis.call('expireat', daily, (day + 1 + summary) * 86400)
+                end
+            end
+            redis.call('zremrangebyrank', key, 0, count - 1)
+            removed = removed + count
+        end
+    end
+    if removed > 0 then
+        redis.call('incr', jprefix .. 'graph:generation')
+    end
+    return removed
+end
+'''
+
+_LOCK_REPLY_LUA = '''
+-- The result of a lock call, parsed by _lock_result(): {status, wake, err,
+-- temp}, where status is 1 (ok), 0 (failed), or -1 (missing lease), wake is
+-- the number of seconds until the earliest blocking lock expires (or nil),
+-- and err and temp are flattened {reason, key, reason, key, ...} lists.
+local function lock_reply(status, failures, temp_failures, wake)
+    local flat = {{}, {}}
+    for i, list in ipairs({failures or {}, temp_failures or {}}) do
+        for _, failure in ipairs(list) do
+            table.insert(flat[i], failure[1])
+            table.insert(flat[i], failure[2])
+        end
+    end
+    return {status, wake and tostring(wake) or false, flat[1], flat[2]}
+end
+'''
+
+_run_if_possible_lua = _script_load(_LOCK_REPLY_LUA + _GRAPH_TRIM_LUA + '''
+-- KEYS - list of inputs to lock, followed by the outputs to lock (all in one
+--        slot with CLUSTER_TAGS): {'input', 'output'}
+-- ARGV - {
+--     key_prefix,
+--     prefix_for_jobs_keys,
+--     identifier,
+--     timestamp,
+--     lock_duration_in_seconds,
+--     overwrite_as_0_or_1,
+--     refresh_as_0_or_1,
+--       -- If 1, on failure report when the earliest blocking lock expires
+--     wake_as_0_or_1,
+--       -- If not empty, wait in line behind other fair jobs
+--     unique_waiter_token_or_empty,
+--     seconds_before_a_silent_waiter_loses_its_place,
+--     max_expired_jobs_to_clean_out_of_jobs_running,
+--       -- Graph history retention, see trim_graph()
+--     graph_max_age_seconds_or_0, graph_max_edges_or_0, graph_summary_days_or_0,
+--     intern_graph_names_as_0_or_1,
+--     graph_granularity_seconds_or_0,
+--       -- Count failures per reason and sanitized key, see CONTENTION_STATS
+--     contention_bucket_seconds_or_0, contention_max_age_seconds,
+--       -- How many of the KEYS are inputs
+--     input_count,
+--       -- If there is a graph history, the rest of the arguments are its edges:
+--     inputs..., '', outputs..., '', graph_id
+-- }
+
+local args = {
+    prefix = ARGV[1],
+    jprefix = ARGV[2],
+    id = ARGV[3],
+    now = tonumber(ARGV[4]),
+    duration = tonumber(ARGV[5]),
+    overwrite = ARGV[6] == '1',
+    refresh = ARGV[7] == '1',
+    wake = ARGV[8] == '1',
+    token = ARGV[9] ~= '' and ARGV[9],
+    queue_ttl = tonumber(ARGV[10]),
+    sweep = tonumber(ARGV[11]),
+    graph_max_age = tonumber(ARGV[12]),
+    graph_max_edges = tonumber(ARGV[13]),
+    graph_summary = tonumber(ARGV[14]),
+    intern = ARGV[15] == '1',
+    granularity = tonumber(ARGV[16]),
+    contention = tonumber(ARGV[17]),
+    contention_ttl = tonumber(ARGV[18]),
+    inputs = tonumber(ARGV[19]),
+}
+-- inputs and outputs separated by an empty string, as stored in
+-- jobs:running:<id>: {'input', '', 'output'}
+local keys = {}
+for i, kk in ipairs(KEYS) do
+    if i == args.inputs + 1 then
+        table.insert(keys, '')
+    end
+    table.insert(keys, kk)
+end
+if #KEYS == args.inputs then
+    table.insert(keys, '')
+end
 local failures = {}
 local temp_failures = {}
+-- inputs that don't exist yet, which readers don't get in line for (the
+-- writer that creates them would otherwise wait behind the reader)
+local not_queued = {}
 local is_input = true
 local is_refresh = args.refresh
-local graph = args.edges
+local graph = {}
+for i = 20, #ARGV do
+    graph[#graph + 1] = ARGV[i]
+end
 local prefix = args.prefix
+local jprefix = args.jprefix
+local wake = nil
+
+-- remember the earliest time (in seconds from now) that a blocking lock expires
+local function wake_after(remaining)
+    if args.wake and remaining and remaining >= 0 and (not wake or remaining < wake) then
+        wake = remaining
+    end
+end
+local function olock_wake(kk)
+    if args.wake then
+        wake_after(redis.call('pttl', prefix .. 'olock:' .. kk) / 1000)
+    end
+end
+
+-- Fair mode: queue members are '<token>:i' for readers and '<token>:o' for
+-- writers, scored by a ticket from a server-side counter. Our ticket lives in
+-- jobs:waiting:<token> for as long as we keep trying.
+local ticket = false
+if args.token then
+    ticket = tonumber(redis.call('get', jprefix .. 'waiting:' .. args.token) or false)
+end
 
-redis.call('zremrangebyscore', prefix .. 'jobs:running', '-inf', args.now)
+-- is a live job with an earlier ticket waiting on this key? Readers only wait
+-- behind writers, writers wait behind everyone.
+local function queued(kk, role)
+    local q = jprefix .. 'queue:' .. kk
+    -- not in line yet? then everyone in line is ahead of us
+    local ahead = redis.call('zrangebyscore', q, '-inf', ticket and ('(' .. ticket) or '+inf')
+    for _, other in ipairs(ahead) do
+        if role == 'o' or string.sub(other, -1) == 'o' then
+            if redis.call('exists', jprefix .. 'waiting:' .. string.sub(other, 1, -3)) == 1 then
+                return true
+            end
+            -- the waiter gave up or died, drop it from the line
+            redis.call('zrem', q, other)
+        end
+    end
+    return false
+end
+
+-- when the earliest unexpired input lock on this key expires, if any
+local function live_reader(ilk)
+    local first = redis.call('zrangebyscore', ilk, '(' .. args.now, '+inf', 'withscores', 'limit', 0, 1)
+    return tonumber(first[2])
+end
 
 -- make sure input keys are available and output keys are not yet written
-for i, kk in ipairs(KEYS) do
+-- (read-only, expired input locks are ignored here and cleaned out below)
+for i, kk in ipairs(keys) do
     local exists = redis.call('exists', prefix .. kk) == 1
 
     local olock = redis.call('get', prefix .. 'olock:' .. kk)
     olock = olock and olock ~= args.id
 
-    -- always clean out the input lock ZSET
     local ilk = prefix .. 'ilock:' .. kk
-    redis.call('zremrangebyscore', ilk, 0, args.now)
-    local ilock = redis.call('exists', ilk) == 1
 
     if kk == '' then
         is_input = false
@@ -812,14 +2106,24 @@ for i, kk in ipairs(KEYS) do
             else
                 -- input doesn't exist, or input exists but someone is writing to it
                 table.insert(failures, {'input_missing', kk})
+                if olock then
+                    olock_wake(kk)
+                else
+                    not_queued[kk] = true
+                end
             end
 
-        elseif is_refresh and not redis.call('zscore', ilk, args.id) then
+        elseif is_refresh and (tonumber(redis.call('zscore', ilk, args.id)) or 0) <= args.now then
             -- lost our input lock, report the temp failure
             table.insert(temp_failures, {'input_lock_lost', kk})
+
+        elseif args.token and queued(kk, 'i') then
+            -- a writer got in line for this input before we did
+            table.insert(failures, {'input_queued', kk})
         end
 
     else
+        local reader = live_reader(ilk)
         if exists and not args.overwrite then
             -- exists, can't overwrite
             table.insert(failures, {'output_exists', kk})
@@ -827,33 +2131,76 @@ for i, kk in ipairs(KEYS) do
         elseif olock then
             -- the output has been locked by another process
             table.insert(failures, {'output_locked', kk})
+            olock_wake(kk)
 
-        elseif ilock then
+        elseif reader then
             -- the output file is being read by another process
             table.insert(failures, {'output_used', kk})
+            wake_after(reader - args.now)
 
         elseif is_refresh and not redis.call('get', prefix .. 'olock:' .. kk) then
             -- lost our output lock, reacquire it
             table.insert(temp_failures, {'output_lock_lost', kk})
+
+        elseif args.token and queued(kk, 'o') then
+            -- someone got in line for this output before we did
+            table.insert(failures, {'output_queued', kk})
         end
     end
 end
 
 if #failures > 0 then
-    return cjson.encode({ok=false, err=failures, temp=temp_failures})
+    if args.token then
+        -- get in line for the keys we are waiting on
+        local ttl = math.ceil(args.queue_ttl * 1000)
+        ticket = ticket or redis.call('incr', jprefix .. 'tickets')
+        for _, failure in ipairs(failures) do
+            if failure[1] ~= 'output_exists' and not (
+                    failure[1] == 'input_missing' and not_queued[failure[2]]) then
+                local q = jprefix .. 'queue:' .. failure[2]
+                redis.call('zadd', q, ticket, args.token .. ':' .. string.sub(failure[1], 1, 1))
+                if redis.call('pttl', q) < ttl then
+                    redis.call('pexpire', q, ttl)
+                end
+            end
+        end
+        redis.call('psetex', jprefix .. 'waiting:' .. args.token, ttl, ticket)
+    end
+    if args.contention > 0 and not is_refresh then
+        -- count the failures, with digits sanitized like graph history
+        local bucket = jprefix .. 'contention:' .. args.contention .. ':' ..
+            math.floor(args.now / args.contention)
+        for _, failure in ipairs(failures) do
+            local name = string.gsub(failure[2], '%d[%d%-]*', '*')
+            redis.call('zincrby', bucket, 1, failure[1] .. ' ' .. name)
+        end
+        redis.call('expire', bucket, args.contention_ttl)
+    end
+    return lock_reply(0, failures, temp_failures, wake)
+end
+if ticket then
+    -- we're done waiting, leave the line
+    for i, kk in ipairs(keys) do
+        if kk ~= '' then
+            redis.call('zrem', jprefix .. 'queue:' .. kk, args.token .. ':i', args.token .. ':o')
+        end
+    end
+    redis.call('del', jprefix .. 'waiting:' .. args.token)
 end
 if args.duration == 0 then
-    return cjson.encode({ok=true})
+    return lock_reply(1)
 end
 
 is_input = true
-for i, kk in ipairs(KEYS) do
+for i, kk in ipairs(keys) do
     if kk == '' then
         is_input = false
     elseif is_input then
         local ilock = prefix .. 'ilock:' .. kk
 
-        -- add lock for this call
+        -- we're writing to the input lock ZSET anyway, clean it out, then add
+        -- the lock for this call
+        redis.call('zremrangebyscore', ilock, 0, args.now)
         redis.call('zadd', ilock, args.now + args.duration, args.id)
         if redis.call('ttl', ilock) < args.duration then
             -- ensure that the locks last long enough
@@ -868,45 +2215,89 @@ for i, kk in ipairs(KEYS) do
     end
 end
 
-redis.call('zadd', prefix .. 'jobs:running', args.now + args.duration, args.id)
-redis.call('setex', prefix .. 'jobs:running:' .. args.id, args.duration, cjson.encode(KEYS))
+-- clean out a few expired jobs while we're writing to jobs:running anyway
+local expired = math.min(redis.call('zcount', jprefix .. 'running', '-inf', args.now), args.sweep)
+if expired > 0 then
+    redis.call('zremrangebyrank', jprefix .. 'running', 0, expired - 1)
+end
+redis.call('zadd', jprefix .. 'running', args.now + args.duration, args.id)
+redis.call('setex', jprefix .. 'running:' .. args.id, args.duration, cjson.encode(keys))
+-- lease record for _renew_job_lua(), so refreshes don't need to send KEYS
+redis.call('setex', jprefix .. 'lease:' .. args.id, args.duration,
+    cjson.encode({args.duration, args.overwrite}))
+
+-- the interned id for a graph node, see GRAPH_INTERN
+local function node(name)
+    if not args.intern then
+        return name
+    end
+    local nid = redis.call('hget', jprefix .. 'graph:names', name)
+    if not nid then
+        nid = redis.call('incr', jprefix .. 'graph:last_id')
+        redis.call('hset', jprefix .. 'graph:names', name, nid)
+        redis.call('hset', jprefix .. 'graph:ids', nid, name)
+    end
+    return nid
+end
 
 -- keep a record of our input/output graph
 if not is_refresh then
     is_input = true
     local id = table.remove(graph)
     table.remove(graph)
+    local arrow = args.intern and ':' or ' -> '
+    if #graph > 0 then
+        id = node(id)
+    end
+    local recorded = false
+    -- records the edge left -> right, unless it was already recorded in the
+    -- last GRAPH_GRANULARITY seconds
+    local function record(key, left, right)
+        local edge = left .. arrow .. right
+        if args.granularity > 0 then
+            local seen = redis.call('zscore', key, edge)
+            if seen and args.now - tonumber(seen) < args.granularity then
+                return
+            end
+        end
+        recorded = true
+        redis.call('zadd', key, args.now, edge)
+        -- adjacency sets, so traversals only read the nodes they visit
+        redis.call('zadd', jprefix .. 'graph:next:' .. left, args.now, right)
+        redis.call('zadd', jprefix .. 'graph:prev:' .. right, args.now, left)
+    end
     for i, kk in ipairs(graph) do
         if kk == '' then
             is_input = false
         elseif is_input then
-            redis.call('zadd', prefix .. 'jobs:graph:input', args.now, kk .. ' -> ' .. id)
+            record(jprefix .. 'graph:input', node(kk), id)
         else
-            redis.call('zadd', prefix .. 'jobs:graph:output', args.now, id .. ' -> ' .. kk)
+            record(jprefix .. 'graph:output', id, node(kk))
         end
     end
+    if recorded then
+        -- enforce retention a few edges at a time
+        trim_graph(jprefix, args.now, args.graph_max_age, args.graph_max_edges,
+            args.graph_summary, args.sweep)
+    end
 end
 
-if #temp_failures > 0 then
-    return cjson.encode({ok=true, temp=temp_failures})
-end
-return cjson.encode({ok=true})
-''')
+return lock_reply(1, nil, temp_failures)
+''', 'run_if_possible')
 
 _finish_job_lua = _script_load('''
 -- KEYS - list of inputs and outputs to finish the job for, same semantics as
 --        _run_if_possible_lua()
--- ARGV - {json.dumps([identifier, now, success, prefix])}
+-- ARGV - {identifier, now, success_as_0_or_1, prefix, jprefix, sweep,
+--         input_count}
 
-local args = cjson.decode(ARGV[1])
-local is_input = true
+local args = {ARGV[1], tonumber(ARGV[2]), ARGV[3] == '1', ARGV[4], ARGV[5], tonumber(ARGV[6])}
+local inputs = tonumber(ARGV[7])
 local prefix = args[4]
+local jprefix = args[5]
 
 for i, kk in ipairs(KEYS) do
-    if kk == '' then
-        is_input = false
-
-    elseif is_input then
+    if i <= inputs then
         local ilock = prefix .. 'ilock:' .. kk
         -- clean out old input locks
         redis.call('zremrangebyscore', ilock, 0, args[2])
@@ -924,29 +2315,198 @@ for i, kk in ipairs(KEYS) do
             redis.call('set', prefix .. kk, args[1])
         end
     end
+
+    -- wake up anyone waiting on this key
+    redis.call('publish', prefix .. 'jobs:release:' .. kk, args[1])
+end
+
+redis.call('zrem', jprefix .. 'running', args[1])
+-- clean out a few expired jobs while we're writing to jobs:running anyway
+local expired = math.min(redis.call('zcount', jprefix .. 'running', '-inf', args[2]), args[6])
+if expired > 0 then
+    redis.call('zremrangebyrank', jprefix .. 'running', 0, expired - 1)
+end
+redis.call('del', jprefix .. 'running:' .. args[1], jprefix .. 'lease:' .. args[1])
+''', 'finish_job')
+
+_renew_job_lua = _script_load(_LOCK_REPLY_LUA + '''
+-- Refreshes the locks for a running job, using the keys and lease stored by
+-- _run_if_possible_lua(), with the same results as a refresh. Returns the
+-- missing lease status (-1) if the lease record doesn't exist (expired, or
+-- the job was started by an older jobs.py), in which case the caller should do
+-- a full refresh.
+-- Note: the ilock:/olock: keys (and the inputs and outputs) read from
+-- jobs:running:<id> aren't declared in KEYS, which is only safe because they
+-- are in the same hash slot as the KEYS (see CLUSTER_TAGS).
+-- KEYS - {jobs:lease:<id>, jobs:running:<id>}
+-- ARGV - {identifier, now, prefix, jprefix, sweep}
+
+local id = ARGV[1]
+local now = tonumber(ARGV[2])
+local prefix = ARGV[3]
+local jprefix = ARGV[4]
+local sweep = tonumber(ARGV[5])
+local lease = redis.call('get', KEYS[1])
+local keys = redis.call('get', KEYS[2])
+if not lease or not keys then
+    return lock_reply(-1)
 end
+lease = cjson.decode(lease)
+keys = cjson.decode(keys)
+local duration = lease[1]
+local overwrite = lease[2]
+local failures = {}
+local temp_failures = {}
+local is_input = true
 
-redis.call('zrem', prefix .. 'jobs:running', args[1])
-redis.call('del', prefix .. 'jobs:running:' .. args[1])
-''')
+for i, kk in ipairs(keys) do
+    local olock = redis.call('get', prefix .. 'olock:' .. kk)
+    local ilk = prefix .. 'ilock:' .. kk
+    if kk == '' then
+        is_input = false
+
+    elseif is_input then
+        if (olock and olock ~= id) or redis.call('exists', prefix .. kk) == 0 then
+            table.insert(failures, {'input_lock_lost', kk})
+        elseif (tonumber(redis.call('zscore', ilk, id)) or 0) <= now then
+            table.insert(temp_failures, {'input_lock_lost', kk})
+        end
+
+    else
+        if not overwrite and redis.call('exists', prefix .. kk) == 1 then
+            table.insert(failures, {'output_exists', kk})
+        elseif olock and olock ~= id then
+            table.insert(failures, {'output_locked', kk})
+        elseif #redis.call('zrangebyscore', ilk, '(' .. now, '+inf', 'limit', 0, 1) > 0 then
+            -- someone has a live input lock
+            table.insert(failures, {'output_used', kk})
+        elseif not olock then
+            table.insert(temp_failures, {'output_lock_lost', kk})
+        end
+    end
+end
+
+if #failures > 0 then
+    return lock_reply(0, failures, temp_failures)
+end
+
+is_input = true
+for i, kk in ipairs(keys) do
+    if kk == '' then
+        is_input = false
+    elseif is_input then
+        local ilock = prefix .. 'ilock:' .. kk
+        redis.call('zremrangebyscore', ilock, 0, now)
+        redis.call('zadd', ilock, now + duration, id)
+        if redis.call('ttl', ilock) < duration then
+            redis.call('expire', ilock, duration)
+        end
+    else
+        redis.call('setex', prefix .. 'olock:' .. kk, duration, id)
+    end
+end
+
+-- clean out a few expired jobs while we're writing to jobs:running anyway
+local expired = math.min(redis.call('zcount', jprefix .. 'running', '-inf', now), sweep)
+if expired > 0 then
+    redis.call('zremrangebyrank', jprefix .. 'running', 0, expired - 1)
+end
+redis.call('zadd', jprefix .. 'running', now + duration, id)
+redis.call('expire', KEYS[2], duration)
+redis.call('expire', KEYS[1], duration)
+
+return lock_reply(1, nil, temp_failures)
+''', 'renew_job')
+
+_leave_queues_lua = _script_load('''
+-- KEYS - list of inputs and outputs the job was waiting on, same semantics as
+--        _run_if_possible_lua()
+-- ARGV - {token, prefix, jprefix}
+
+local args = ARGV
+local prefix = args[2]
+local jprefix = args[3]
+
+for i, kk in ipairs(KEYS) do
+    local q = jprefix .. 'queue:' .. kk
+    if redis.call('zrem', q, args[1] .. ':i', args[1] .. ':o') > 0 then
+        -- let whoever is next in line know
+        redis.call('publish', prefix .. 'jobs:release:' .. kk, args[1])
+    end
+end
+redis.call('del', jprefix .. 'waiting:' .. args[1])
+''', 'leave_queues')
 
 _get_job_info_lua = _script_load('''
--- ARGV - {json.dumps([now, prefix])}
+-- KEYS - {jobs:running}
+-- ARGV - {json.dumps([now, jprefix])}
 
 local args = cjson.decode(ARGV[1])
-local prefix = args[2]
+local jprefix = args[2]
 local jobs = {}
-local jobl = redis.call('zrangebyscore', prefix .. 'jobs:running', args[1], 'inf', 'withscores')
+local jobl = redis.call('zrangebyscore', KEYS[1], args[1], 'inf', 'withscores')
 for i=1, #jobl, 2 do
     local job = {}
     job.id = jobl[i]
     job.exptime = tonumber(jobl[i+1])
-    job.io = cjson.decode(redis.call('get', prefix .. 'jobs:running:' .. jobl[i]))
+    job.io = cjson.decode(redis.call('get', jprefix .. 'running:' .. jobl[i]))
     table.insert(jobs, job)
 end
 
 return cjson.encode(jobs)
-''')
+''', 'get_job_info')
+
+_traverse_lua = _script_load('''
+-- Breadth-first traversal of the graph history adjacency sets, see
+-- _traverse_edges().
+-- KEYS - {jobs:graph:<next or prev>:<start>}
+-- ARGV - {json.dumps([adjacency_prefix, start, downstream, depth, after,
+--                     before, limit])}
+
+local args = cjson.decode(ARGV[1])
+local adjacency = args[1]
+local out = args[3]
+local depth = args[4]
+local limit = args[7]
+local known = {[args[2]] = true}
+local level = {args[2]}
+local edges = {}
+
+-- out/downstream is all stuff leading from left to right.
+-- in/upstream is all stuff leading from right to left.
+while #level > 0 do
+    local next_level = {}
+    for _, it in ipairs(level) do
+        local neighbors = redis.call('zrangebyscore', adjacency .. it, args[5], args[6])
+        table.sort(neighbors)
+        for _, n in ipairs(neighbors) do
+            if limit > 0 and #edges >= limit then
+                return cjson.encode(edges)
+            end
+            table.insert(edges, out and {it, n} or {n, it})
+            if not known[n] then
+                known[n] = true
+                table.insert(next_level, n)
+            end
+        end
+    end
+    if depth == 0 then
+        break
+    end
+    depth = depth - 1
+    level = next_level
+end
+
+return cjson.encode(edges)
+''', 'traverse')
+
+_trim_graph_lua = _script_load(_GRAPH_TRIM_LUA + '''
+-- KEYS - {jobs:graph:input, jobs:graph:output}
+-- ARGV - {json.dumps([jprefix, now, max_age, max_edges, summary, limit])}
+
+local args = cjson.decode(ARGV[1])
+return trim_graph(args[1], args[2], args[3], args[4], args[5], args[6])
+''', 'trim_graph')
 
 
 class BullshitLog(object):
@@ -955,12 +2515,17 @@ class BullshitLog(object):
         self.level = level
     def getEffectiveLevel(self):
         return self.level
+    def isEnabledFor(self, level):
+        return self.level <= level
 
 for name in 'debug info warning error critical exception'.split():
     def maker(name):
         my_level = getattr(logging, name.upper()) if name != 'exception' else logging.ERROR
         altname = (name if name != 'exception' else 'error').upper()
         def _log(self, msg, *args, **kwargs):
+            if self.level > my_level:
+                # don't format (or repr the arguments of) dropped messages
+                return
             exc = kwargs.pop('exc_info', None) or name == 'exception'
             tb = ('\n' + traceback.format_exc().strip()) if exc else ''
             if args:
@@ -971,74 +2536,334 @@ for name in 'debug info warning error critical exception'.split():
                         "Exception raised while formatting message:\n%s\n%r",
                         msg, args)
             msg += tb
-            # todo: check level before printing
-            if self.level <= my_level:
-                print("%s %s %s"%(time.asctime(), altname, msg))
+            print("%s %s %s"%(time.asctime(), altname, msg))
         _log.__name__ = name
         return _log
 
     setattr(BullshitLog, name, maker(name))
 
+class NullLog(BullshitLog):
+    '''
+    A logger that drops every message without looking at it, for
+    ``jobs.DEFAULT_LOGGER = jobs.NullLog()``.
+    '''
+    level = logging.CRITICAL + 1
+    def setLevel(self, level):
+        pass
+    def _drop(self, msg, *args, **kwargs):
+        pass
+    debug = info = warning = error = critical = exception = _drop
+
+class MemoryMetrics(object):
+    '''
+    A metrics sink (see METRICS) that keeps counters and histograms in memory.
+
+    Arguments:
+        * buckets - upper bounds for histogram buckets of timings (in
+          seconds), an infinite bucket is always included
+        * count_buckets - upper bounds for histogram buckets of counts, an
+          infinite bucket is always included
+
+    Read the results from ``.counters``, a dictionary of ``{(name, tags):
+    count}``, and ``.histograms``, a dictionary of ``{(name, tags): [bucket
+    counts..., total count, sum]}``, where tags is a sorted tuple of
+    ``(tag, value)`` pairs. ``.bounds`` maps each histogram name to its
+    bucket upper bounds.
+    '''
+    BUCKETS = (.001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60, 300)
+    COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self, buckets=None, count_buckets=None):
+        self.buckets = tuple(sorted(buckets or self.BUCKETS)) + (float('inf'),)
+        self.count_buckets = tuple(sorted(count_buckets or self.COUNT_BUCKETS)) + (float('inf'),)
+        self.counters = defaultdict(int)
+        self.histograms = {}
+        self.bounds = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1, tags=None):
+        key = (name, tuple(sorted((tags or {}).items())))
+        with self._lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, tags=None):
+        # a timing, in seconds
+        self._record(name, value, tags, self.buckets)
+
+    def histogram(self, name, value, tags=None):
+        # a count, like the number of attempts
+        self._record(name, value, tags, self.count_buckets)
+
+    def _record(self, name, value, tags, buckets):
+        key = (name, tuple(sorted((tags or {}).items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(buckets) + 2)
+                self.bounds[name] = buckets
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += 1
+            hist[-1] += value
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.bounds.clear()
+
+class PrometheusMetrics(MemoryMetrics):
+    '''
+    Like MemoryMetrics, only ``.render()`` returns the metrics in the
+    Prometheus text exposition format, for serving from your own /metrics
+    endpoint. Metric names are prefixed with ``prefix``, with '.' replaced by
+    '_'.
+    '''
+    def __init__(self, prefix='jobs_', buckets=None, count_buckets=None):
+        MemoryMetrics.__init__(self, buckets, count_buckets)
+        self.prefix = prefix
+
+    def _name(self, name):
+        return self.prefix + name.replace('.', '_')
+
+    def _labels(self, tags, extra=()):
+        tags = list(tags) + list(extra)
+        if not tags:
+            return ''
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"')
+        return '{%s}'%','.join('%s="%s"'%(k, escape(v)) for k, v in tags)
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            bounds = dict(self.bounds)
+        out = []
+        seen = set()
+        for (name, tags), value in counters:
+            name = self._name(name) + '_total'
+            if name not in seen:
+                seen.add(name)
+                out.append('# TYPE %s counter'%(name,))
+            out.append('%s%s %s'%(name, self._labels(tags), value))
+        for (name, tags), hist in histograms:
+            buckets = bounds[name]
+            name = self._name(name)
+            if name not in seen:
+                seen.add(name)
+                out.append('# TYPE %s histogram'%(name,))
+            for bound, count in zip(buckets, hist):
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                out.append('%s_bucket%s %s'%(name, self._labels(tags, [('le', le)]), count))
+            out.append('%s_count%s %s'%(name, self._labels(tags), hist[-2]))
+            out.append('%s_sum%s %r'%(name, self._labels(tags), hist[-1]))
+        return '\n'.join(out) + '\n'
+
+class StatsdMetrics(object):
+    '''
+    A metrics sink (see METRICS) that sends counters, timings, and histograms
+    to a StatsD server over UDP, with DogStatsD-style tags. Sending never blocks, and
+    errors are ignored.
+
+    Arguments:
+        * host, port - the StatsD server
+        * prefix - prepended to every metric name
+    '''
+    def __init__(self, host='127.0.0.1', port=8125, prefix='jobs.'):
+        import socket
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+
+    def _send(self, name, value, kind, tags):
+        line = '%s%s:%s|%s'%(self.prefix, name, value, kind)
+        if tags:
+            line += '|#' + ','.join('%s:%s'%kv for kv in sorted(tags.items()))
+        try:
+            self.sock.sendto(line.encode('utf-8'), self.address)
+        except (IOError, OSError):
+            pass
+
+    def incr(self, name, value=1, tags=None):
+        self._send(name, value, 'c', tags)
+
+    def observe(self, name, value, tags=None):
+        # seconds, reported as StatsD timings in milliseconds
+        self._send(name, '%.3f'%(value * 1000,), 'ms', tags)
+
+    def histogram(self, name, value, tags=None):
+        self._send(name, value, 'h', tags)
+
+def _metric(kind, name, value, tags=None):
+    '''
+    Reports a metric to the METRICS sink, if any. Errors in the sink are logged
+    and otherwise ignored.
+    '''
+    if METRICS is None:
+        return
+    try:
+        if kind == 'histogram' and not hasattr(METRICS, kind):
+            # sinks written before histogram() was added
+            kind = 'observe'
+        getattr(METRICS, kind)(name, value, tags)
+    except Exception:
+        DEFAULT_LOGGER.warning("Failed to report metric %r", name, exc_info=True)
+
+def _start_metrics(started_at, attempts, result):
+    if METRICS is None:
+        return
+    tags = {'result': result}
+    _metric('observe', 'start.wait', time.time() - started_at, tags)
+    _metric('histogram', 'start.attempts', attempts, tags)
+
+def _failure_metrics(result):
+    '''
+    Counts the failures in a lock result, by reason and namespace.
+    '''
+    if METRICS is None:
+        return
+    for part in ('err', 'temp'):
+        for why, keys in (result.get(part) or {}).items():
+            counts = defaultdict(int)
+            for key in keys:
+                counts[_namespace(key)] += 1
+            for ns, count in counts.items():
+                _metric('incr', 'lock.failures', count, {'reason': why, 'namespace': ns})
+
 DEFAULT_LOGGER = BullshitLog()
 
-def _start_auto_refresh(job, lock=threading.Lock()):
+def _refresh_interval(job):
+    '''
+    How often an auto-refreshed job is refreshed: every third of its duration,
+    but not more than once per second.
+    '''
+    return max(job.duration / 3.0, 1)
+
+def _start_auto_refresh(job):
     '''
     Internal implementation detail; I will auto-refresh job locks in a
     background thread if you ask.
+
+    Jobs are kept in a heap ordered by when they are next due to be refreshed,
+    and all jobs due at about the same time are refreshed together with one
+    round trip to Redis (per connection).
     '''
     global REFRESH_THREAD
-    rq = AUTO_REFRESH
-    def refresh():
-        while True:
-            # find the next job to be refreshed
-            with lock:
-                job = None
-                jobs = list(rq)
-                times = [j.last_refreshed for j in jobs]
-                for i, ti in enumerate(times):
-                    if ti is not None:
-                        if job is not None:
-                            if ti < times[job]:
-                                job = ti
-                        else:
-                            job = ti
-                    else:
-                        rq.discard(jobs[i])
-
-                # no more running jobs, bail
-                if not rq:
-                    break
+    with REFRESH_COND:
+        if job.last_refreshed is None or not job.auto_refresh or job in AUTO_REFRESH:
+            return
+        _schedule_refresh(job, job.last_refreshed + _refresh_interval(job))
+        REFRESH_COND.notify()
+        if not REFRESH_THREAD or not REFRESH_THREAD.is_alive():
+            REFRESH_THREAD = threading.Thread(target=_auto_refresh_loop)
+            REFRESH_THREAD.setDaemon(1)
+            REFRESH_THREAD.start()
 
-                last = times[job]
-                job = jobs[job]
+def _schedule_refresh(job, due):
+    # call with REFRESH_COND held; older heap entries for the job are ignored
+    seq = AUTO_REFRESH[job] = next(REFRESH_SEQ)
+    heapq.heappush(REFRESH_HEAP, (due, seq, job))
 
-            # wait a little bit if necessary...
-            next = last + 1
-            wait = next - time.time()
+def _auto_refresh_loop():
+    global REFRESH_THREAD
+    while True:
+        with REFRESH_COND:
+            # drop stopped (or rescheduled) jobs
+            while REFRESH_HEAP and AUTO_REFRESH.get(REFRESH_HEAP[0][2]) != REFRESH_HEAP[0][1]:
+                heapq.heappop(REFRESH_HEAP)
+
+            # no more running jobs, bail
+            if not REFRESH_HEAP:
+                REFRESH_THREAD = None
+                return
+
+            wait = REFRESH_HEAP[0][0] - time.time()
             if wait > 0:
-                time.sleep(min(wait, .1))
-                # check again
+                REFRESH_COND.wait(wait)
                 continue
 
-            try:
-                if job.auto_refresh:
-                    # refresh as necessary
-                    job.refresh(inside_auto_refresh=True)
-            except:
-                DEFAULT_LOGGER.execption("Exception while automatically refreshing")
-
-            # remove as necessary
-            with lock:
-                if job.last_refreshed is None or not job.auto_refresh:
-                    rq.discard(job)
-
-    with lock:
-        if job.last_refreshed is not None and job.auto_refresh:
-            rq.add(job)
-        if rq and (not REFRESH_THREAD or not REFRESH_THREAD.is_alive()):
-            REFRESH_THREAD = threading.Thread(target=refresh)
-            REFRESH_THREAD.setDaemon(1)
-            REFRESH_THREAD.start()
+            # Refreshing a little early is harmless, and lets us batch jobs
+            # that started at about the same time.
+            batch = []
+            cutoff = time.time() + .1
+            while REFRESH_HEAP and REFRESH_HEAP[0][0] <= cutoff:
+                _, seq, job = heapq.heappop(REFRESH_HEAP)
+                if AUTO_REFRESH.get(job) == seq:
+                    batch.append((seq, job))
+
+        try:
+            schedule = _refresh_batch(batch)
+        except:
+            DEFAULT_LOGGER.exception("Exception while automatically refreshing")
+            # try again in a second
+            schedule = [(time.time() + 1, seq, job) for seq, job in batch]
+
+        with REFRESH_COND:
+            for due, seq, job in schedule:
+                # unless stopped (or restarted) in the meantime
+                if AUTO_REFRESH.get(job) == seq:
+                    _schedule_refresh(job, due)
+
+def _refresh_batch(batch):
+    '''
+    Refreshes a batch of ``(seq, job)`` pairs due for an auto-refresh, returning
+    ``(next_due, seq, job)`` for jobs that still need to be refreshed.
+    '''
+    schedule = []
+    locked = []
+    refreshing = []
+    calls = []
+    try:
+        for seq, job in batch:
+            if not job._lock.acquire(False):
+                # being started, stopped, or refreshed by hand, try again soon
+                schedule.append((time.time() + .1, seq, job))
+                continue
+            locked.append((seq, job))
+            if not job.is_running or not job.auto_refresh:
+                continue
+            if time.time() - job.last_refreshed < _refresh_interval(job) - .2:
+                # refreshed by hand recently
+                schedule.append((job.last_refreshed + _refresh_interval(job), seq, job))
+                continue
+            refreshing.append((seq, job))
+            for group in _slot_groups(job.inputs, job.outputs):
+                keys, args = _renew_job_args(job.conn, job.identifier, (group[0] + group[1] + [None])[0])
+                calls.append((job, group, (job.conn, (_renew_job_lua, keys, args))))
+
+        if refreshing:
+            DEFAULT_LOGGER.debug("Refreshing locks for %i jobs", len(refreshing))
+        results = [_lock_result(r) for r in
+            _script_pipeline_by_conn([call for _, _, call in calls])]
+
+        # slot groups whose lease expired need a full refresh
+        missing = [i for i, lost in enumerate(results) if lost.get('missing')]
+        if missing:
+            refresh = []
+            for i in missing:
+                job, (group_inputs, group_outputs), _ = calls[i]
+                keys, args = _refresh_job_args(job.conn, group_inputs, group_outputs,
+                    job.identifier, job.duration, job.overwrite, cache=job._io_cache)
+                refresh.append((job.conn, (_run_if_possible_lua, keys, args)))
+            for i, lost in zip(missing, _script_pipeline_by_conn(refresh)):
+                results[i] = _lock_result(lost)
+
+        by_job = defaultdict(list)
+        for (job, _, _), lost in zip(calls, results):
+            by_job[job].append(lost)
+        for seq, job in refreshing:
+            lost = _merge_results(by_job[job])
+            if lost.get('err') or lost.get('temp'):
+                DEFAULT_LOGGER.warning("Lock(s) lost due to timeout: %r", lost)
+            job.last_refreshed = time.time()
+            schedule.append((job.last_refreshed + _refresh_interval(job), seq, job))
+    finally:
+        for _, job in locked:
+            job._lock.release()
+    return schedule
 
 
 DELTA_TIMES = [
@@ -1055,15 +2880,20 @@ def _delta_to_time_string(delta):
 
     return "%.2f %s"%(max(delta, 0), name)
 
-def get_jobs(conn):
+def get_jobs(conn, namespace=None):
     '''
     Gets the list of currently running jobs, their inputs, and their outputs.
+
+    With CLUSTER_TAGS, jobs are tracked per namespace, so pass the
+    ``namespace`` to list.
     '''
-    jobs = json.loads(_get_job_info_lua(conn, keys=(), args=[json.dumps([time.time(), GLOBAL_PREFIX])]))
+    jprefix = _namespace_jobs_prefix(namespace, _client(conn).prefix)
+    jobs = json.loads(_get_job_info_lua(conn, keys=[jprefix + 'running'],
+        args=[json.dumps([time.time(), jprefix])]))
     if not jobs:
         jobs = []
     for job in jobs:
-        io = job.pop('io')
+        io = [_uncluster_key(k) for k in job.pop('io')]
         sep = io.index('')
         job['inputs'] = io[:sep]
         job['outputs'] = io[sep+1:]
@@ -1085,7 +2915,22 @@ def show_jobs(conn):
     print("]")
 
 def _fix_edge(e):
-    return EDGE_RE.sub('*', e)
+    '''
+    Sanitizes a graph node name (see EDGE_RE), remembering the most recently
+    used FIXED_EDGES_SIZE results.
+    '''
+    try:
+        fixed = FIXED_EDGES.pop(e)
+    except KeyError:
+        fixed = EDGE_RE.sub('*', e)
+        while len(FIXED_EDGES) >= FIXED_EDGES_SIZE:
+            try:
+                FIXED_EDGES.popitem(last=False)
+            except KeyError:
+                # emptied by another thread
+                break
+    FIXED_EDGES[e] = fixed
+    return fixed
 
 
 
@@ -1112,27 +2957,98 @@ def _to_ts(val):
         return (dt-EPOCH).total_seconds()
     raise Exception("Value %r is not a timestamp, datetime, or date"%(val,))
 
-def edges(conn, before=None, after=None):
+def edges(conn, before=None, after=None, namespace=None):
     '''
     Returns (inputs, outputs). Inputs are sorted by prefix, outputs are sorted
     by suffix.
 
     The `before` and `after` arguments
 
+    With CLUSTER_TAGS, history is kept per namespace, so pass the
+    ``namespace`` to read.
+
+    Note: this reads the whole history into memory, use iter_edges() for large
+    histories.
     '''
-    io = []
-    for key in ['jobs:graph:input', 'jobs:graph:output']:
-        l = '-inf' if after is None else _to_ts(after)
-        h = 'inf' if before is None else _to_ts(before)
+    return [list(sorted(set(iter_edges(conn, output, before, after, namespace))))
+        for output in (False, True)]
 
-        iol = conn.zrangebyscore(key, l, h)
-        io.append(list(sorted(set(_fix_edge(e) for e in iol))))
-    return io
+def iter_edges(conn, output=False, before=None, after=None, namespace=None,
+        chunk=1000, withscores=False):
+    '''
+    Yields the sanitized input edges (or output edges if ``output`` is true),
+    least recently seen first, reading at most ``chunk`` of them from Redis at
+    a time. Unlike edges(), memory use doesn't depend on the size of the
+    history, but edges aren't de-duplicated or sorted by name.
+
+    Arguments:
+     * output=False - whether to read the output edges instead of the inputs
+     * before/after=None - only read edges last seen before/after these times
+     * namespace=None - with CLUSTER_TAGS, the namespace to read
+     * chunk=1000 - how many edges to read from Redis at a time
+     * withscores=False - yield (edge, last_seen) pairs instead
+    '''
+    client = _client(conn)
+    jprefix = _namespace_jobs_prefix(namespace, client.prefix)
+    key = jprefix + ('graph:output' if output else 'graph:input')
+    l = '-inf' if after is None else _to_ts(after)
+    h = 'inf' if before is None else _to_ts(before)
+    # page by score instead of by offset, skipping the edges we've already
+    # seen with the last score we saw, so every page costs the same
+    skip = 0
+    while True:
+        page = client.conn.zrangebyscore(key, l, h, start=skip, num=chunk, withscores=True)
+        for edge, (_, score) in zip(_decode_edges(client, jprefix, [e for e, _ in page]), page):
+            yield (_fix_edge(edge), score) if withscores else _fix_edge(edge)
+        if len(page) < chunk:
+            break
+        last = page[-1][1]
+        same = sum(1 for _, score in page if score == last)
+        skip = same + (skip if last == l else 0)
+        l = last
+
+def _split_edge(edge):
+    '''
+    Returns the (left, right) nodes of a stored edge, interned or not.
+    '''
+    left, arrow, right = edge.partition(ARROW)
+    if not arrow:
+        # interned, see GRAPH_INTERN
+        left, _, right = edge.partition(':')
+    return left, right
 
-def get_job_io(identifier, conn=None):
-    it = (conn or CONN).get('jobs:running:' + identifier)
+def _graph_names(client, jprefix, ids):
+    '''
+    Returns the (cached, per connection pool and prefix) dictionary of
+    interned graph node ids to names, after fetching any of the provided ids
+    that we haven't seen yet. Ids are never reused, so entries never go stale.
+    '''
+    pool = getattr(client.conn, 'connection_pool', client.conn)
+    names = GRAPH_NAMES.setdefault((pool, jprefix), {})
+    missing = list(set(i for i in ids if i not in names))
+    if missing:
+        for i, name in zip(missing, client.conn.hmget(jprefix + 'graph:ids', missing)):
+            if name is not None:
+                names[i] = name.decode('latin-1') if isinstance(name, bytes) else name
+    return names
+
+def _decode_edges(client, jprefix, edges):
+    '''
+    Translates stored edges back to 'left -> right' strings.
+    '''
+    edges = [e.decode('latin-1') if isinstance(e, bytes) else e for e in edges]
+    interned = [_split_edge(e) for e in edges if ARROW not in e]
+    if not interned:
+        return edges
+    names = _graph_names(client, jprefix, [n for pair in interned for n in pair])
+    return [e if ARROW in e else ARROW.join(names.get(n, n) for n in _split_edge(e))
+        for e in edges]
+
+def get_job_io(identifier, conn=None, namespace=None):
+    client = _client(conn)
+    it = client.conn.get(_namespace_jobs_prefix(namespace, client.prefix) + 'running:' + identifier)
     if it:
-        it = json.loads(it)
+        it = [_uncluster_key(k) for k in json.loads(it)]
         inputs = it[:it.index('')]
         del it[:len(inputs) + 1]
         return inputs, it
@@ -1168,7 +3084,6 @@ def _inputs(inputs, job):
 def _outputs(outputs, job):
     return _filter_left(outputs, _fix_edge(job))
 
-ARROW = ' -> '
 
 def print_edge(left, right, s):
     if not right:
@@ -1178,49 +3093,325 @@ def print_edge(left, right, s):
     print('"%s" -> "%s"%s'%(left, right, s))
 
 
-def _traverse(out, je, s, conn=None, depth=-1, before=None, after=None):
-    inputs, outputs = edges(conn or CONN, before=before, after=after)
-    inputs.sort()
-    outputs.sort()
+def _traverse_edges(out, je, conn=None, depth=-1, before=None, after=None,
+        namespace=None, limit=None):
+    '''
+    Returns the [left, right] edges reachable downstream (``out`` is true) or
+    upstream from the provided job identifier, input, or output, in
+    breadth-first order. The traversal runs inside Redis (see
+    _traverse_lua()), so only the edges found are sent back, at most ``limit``
+    of them (TRAVERSE_LIMIT by default, 0 for no limit).
+    '''
+    if limit is None:
+        limit = TRAVERSE_LIMIT
+    je = _fix_edge(je)
+    client = _client(conn)
+    jprefix = _namespace_jobs_prefix(namespace, client.prefix)
+    if GRAPH_INTERN:
+        je = client.conn.hget(jprefix + 'graph:names', je)
+        if je is None:
+            return []
+        je = je.decode('latin-1') if isinstance(je, bytes) else je
+    adjacency = jprefix + ('graph:next:' if out else 'graph:prev:')
+    # as strings, so Lua doesn't round our timestamps
+    l = '-inf' if after is None else repr(float(_to_ts(after)))
+    h = 'inf' if before is None else repr(float(_to_ts(before)))
+    result = _traverse_lua(conn, keys=[adjacency + je],
+        args=[json.dumps([adjacency, je, bool(out), depth, l, h, limit or 0])])
+    if not isinstance(result, TEXT_TYPE):
+        result = result.decode('latin-1')
+    # an empty Lua table is encoded as {}
+    result = json.loads(result) or []
+    if GRAPH_INTERN:
+        names = _graph_names(client, jprefix, [n for pair in result for n in pair])
+        result = [[names.get(n, n) for n in pair] for pair in result]
+    return result
 
-    known = set([je])
-    q = deque([(je, depth)])
+def _traverse(out, je, s, conn=None, depth=-1, before=None, after=None, limit=None):
+    default = limit is None
+    if default:
+        limit = TRAVERSE_LIMIT
+    if GRAPH_CACHE_DIR:
+        snapshot = GraphSnapshot(conn=conn)
+        snapshot.refresh()
+        found = snapshot.traverse(out, je, depth, before, after, limit)
+    else:
+        found = _traverse_edges(out, je, conn, depth, before, after, limit=limit)
+    for left, right in found:
+        print_edge(left, right, s)
+    if default and limit and len(found) >= limit:
+        DEFAULT_LOGGER.warning("Stopped after %i edges (jobs.TRAVERSE_LIMIT), "
+            "pass --limit for more", limit)
+
+class GraphSnapshot(object):
+    '''
+    A local copy of the graph history, kept in a JSON file, for running many
+    lineage queries without reading the history from Redis each time. Edge
+    scores are when they were last seen, so refresh() only fetches the edges
+    seen since the newest one in the snapshot (the high-water mark), and
+    re-reads everything if retention removed edges in the meantime (retention
+    bumps the graph:generation counter). The file is only rewritten when
+    edges changed, and traverse() keeps its adjacency lists between calls.
 
-    # out/downstream is all stuff leading from left to right.
-    # in/upstream is all stuff leading from right to left.
-    all_edges = inputs + outputs
+    Arguments:
+        * path=None - the snapshot file (defaults to a file in GRAPH_CACHE_DIR
+            named after the Redis server and key prefix)
+        * conn=None - the Redis connection (or JobsClient) to read from
+        * namespace=None - with CLUSTER_TAGS, the namespace to read
 
-    if out:
-        # outputs, so downstream
-        while q:
-            it, d = q.popleft()
-            dm1 = d-1
-            for outp in _outputs(all_edges, it):
-                print_edge(it, outp, s)
-                if outp not in known:
-                    known.add(outp)
-                    if d:
-                        q.append((outp, dm1))
+    Usage::
 
-    else:
-        # inputs, so upstream
-        while q:
-            it, d = q.popleft()
-            dm1 = d-1
-            for inp in _inputs(all_edges, it):
-                print_edge(inp, it, s)
-                if inp not in known:
-                    known.add(inp)
-                    if d:
-                        q.append((inp, dm1))
+        snapshot = jobs.GraphSnapshot('/var/cache/jobs/graph.json')
+        snapshot.refresh()
+        for left, right in snapshot.traverse(True, 'reporting.events.*'):
+            ...
+    '''
+    # re-read edges seen this long before the high-water mark, in case of
+    # clock skew between writers, or writes in progress while we read
+    SLACK = 60
+
+    def __init__(self, path=None, conn=None, namespace=None):
+        self.client = _client(conn)
+        self.namespace = namespace
+        jprefix = _namespace_jobs_prefix(namespace, self.client.prefix)
+        if path is None:
+            kwargs = getattr(getattr(self.client.conn, 'connection_pool', None), 'connection_kwargs', {})
+            name = repr((kwargs.get('host'), kwargs.get('port'), kwargs.get('db'), jprefix))
+            path = os.path.join(GRAPH_CACHE_DIR, 'graph-%s.json'%(sha1(name.encode('utf-8')).hexdigest()[:16],))
+        self.path = path
+        self.hwm = None
+        self.generation = None
+        self.edges = [{}, {}]
+        # {(out, after, before): adjacency lists}, see traverse()
+        self._adjacency = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if data.get('prefix') == jprefix:
+            self.hwm = data['hwm']
+            self.generation = data.get('generation')
+            self.edges = [data['input'], data['output']]
+
+    def _reset(self):
+        self.hwm = None
+        self.edges = [{}, {}]
+
+    def refresh(self):
+        '''
+        Fetches the edges seen since the last refresh, and saves the snapshot
+        if any changed. Returns the number of edges fetched.
+        '''
+        jprefix = _namespace_jobs_prefix(self.namespace, self.client.prefix)
+        generation = self.client.conn.get(jprefix + 'graph:generation')
+        generation = None if generation is None else int(generation)
+        changed = generation != self.generation
+        if changed:
+            # edges were removed, start over
+            self._reset()
+            self.generation = generation
+
+        fetched = 0
+        for attempt in range(2):
+            after = None if self.hwm is None else self.hwm - self.SLACK
+            for output, edges in enumerate(self.edges):
+                for edge, score in iter_edges(self.client, bool(output), after=after,
+                        namespace=self.namespace, withscores=True):
+                    if score > edges.get(edge, float('-inf')):
+                        edges[edge] = score
+                        changed = True
+                    self.hwm = max(score, self.hwm or score)
+                    fetched += 1
+
+            # edges removed without bumping the generation (by older versions
+            # of jobs.py) leave the snapshot bigger than the history
+            pipe = self.client.conn.pipeline(False)
+            pipe.zcard(jprefix + 'graph:input')
+            pipe.zcard(jprefix + 'graph:output')
+            sizes = pipe.execute()
+            if attempt or not any(len(e) > size for e, size in zip(self.edges, sizes)):
+                break
+            self._reset()
+            fetched = 0
+
+        if changed:
+            self._adjacency.clear()
+            self.save()
+        return fetched
+
+    def save(self):
+        '''
+        Writes the snapshot to its file (atomically, where supported).
+        '''
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        temp = '%s.%s.tmp'%(self.path, binascii.hexlify(os.urandom(4)).decode('latin-1'))
+        with open(temp, 'w') as f:
+            json.dump({'prefix': _namespace_jobs_prefix(self.namespace, self.client.prefix),
+                'hwm': self.hwm, 'generation': self.generation,
+                'input': self.edges[0], 'output': self.edges[1]}, f)
+        try:
+            os.rename(temp, self.path)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(self.path)
+            os.rename(temp, self.path)
+
+    def traverse(self, out, je, depth=-1, before=None, after=None, limit=None):
+        '''
+        Returns the [left, right] edges reachable downstream (``out`` is true)
+        or upstream from the provided job identifier, input, or output, like
+        the --upstream and --downstream lineage queries.
+        '''
+        l = float('-inf') if after is None else _to_ts(after)
+        h = float('inf') if before is None else _to_ts(before)
+        key = (bool(out), l, h)
+        adjacency = self._adjacency.get(key)
+        if adjacency is None:
+            adjacency = defaultdict(list)
+            for edges in self.edges:
+                for edge, score in edges.items():
+                    if l <= score <= h:
+                        left, right = edge.split(ARROW, 1)
+                        if out:
+                            adjacency[left].append(right)
+                        else:
+                            adjacency[right].append(left)
+            for neighbors in adjacency.values():
+                neighbors.sort()
+            self._adjacency[key] = adjacency
+
+        je = _fix_edge(je)
+        known = set([je])
+        level = [je]
+        found = []
+        while level:
+            next_level = []
+            for it in level:
+                for n in adjacency.get(it, ()):
+                    if limit and len(found) >= limit:
+                        return found
+                    found.append([it, n] if out else [n, it])
+                    if n not in known:
+                        known.add(n)
+                        next_level.append(n)
+            if not depth:
+                break
+            depth -= 1
+            level = next_level
+        return found
+
+def index_graph(conn=None, namespace=None):
+    '''
+    Builds the graph:next:<node> and graph:prev:<node> adjacency sets used by
+    --upstream and --downstream from the graph:input and graph:output history,
+    for history that was recorded by older versions of jobs.py. Returns the
+    number of edges indexed.
+    '''
+    client = _client(conn)
+    jprefix = _namespace_jobs_prefix(namespace, client.prefix)
+    count = 0
+    for key in [jprefix + 'graph:input', jprefix + 'graph:output']:
+        pipe = client.conn.pipeline(False)
+        for edge, score in client.conn.zscan_iter(key):
+            left, right = _split_edge(edge.decode('latin-1'))
+            # the edge's score is when it was last seen, same as in the index
+            pipe.execute_command('ZADD', jprefix + 'graph:next:' + left, score, right)
+            pipe.execute_command('ZADD', jprefix + 'graph:prev:' + right, score, left)
+            count += 1
+            if not count % 1000:
+                pipe.execute()
+        pipe.execute()
+    return count
+
+def compact_graph(conn=None, namespace=None, max_age=None, max_edges=None,
+        summary=None, chunk=1000, summary_days=None):
+    '''
+    Enforces graph history retention, removing all edges that were last seen
+    more than ``max_age`` seconds ago, or are past the ``max_edges`` most
+    recently seen (for inputs and outputs each), ``chunk`` edges per call to
+    Redis. With ``summary``, removed edges are rolled into per-day summaries
+    kept for ``summary_days`` after their day, see daily_edges(). Defaults to
+    GRAPH_MAX_AGE, GRAPH_MAX_EDGES, GRAPH_SUMMARY, and GRAPH_SUMMARY_DAYS.
+    Returns the number of edges removed.
+    '''
+    jprefix = _namespace_jobs_prefix(namespace, _client(conn).prefix)
+    max_age = GRAPH_MAX_AGE if max_age is None else max_age
+    max_edges = GRAPH_MAX_EDGES if max_edges is None else max_edges
+    summary = GRAPH_SUMMARY if summary is None else summary
+    summary_days = GRAPH_SUMMARY_DAYS if summary_days is None else summary_days
+    removed = 0
+    while True:
+        count = _trim_graph_lua(conn, keys=[jprefix + 'graph:input', jprefix + 'graph:output'],
+            args=[json.dumps([jprefix, time.time(), max_age or 0, max_edges or 0, summary_days if summary else 0, chunk])])
+        removed += count
+        if count < chunk:
+            return removed
+
+def daily_edges(conn, day, output=False, namespace=None):
+    '''
+    Returns the sorted input edges (or output edges if ``output`` is true)
+    that were rolled into the summary for the provided day (a timestamp,
+    datetime, or date string like '2016-09-12') by graph history retention,
+    see GRAPH_SUMMARY.
+    '''
+    client = _client(conn)
+    jprefix = _namespace_jobs_prefix(namespace, client.prefix)
+    key = jprefix + 'graph:daily:%s:%i'%('output' if output else 'input', int(_to_ts(day) // 86400))
+    return sorted(_decode_edges(client, jprefix, client.conn.zrange(key, 0, -1)))
+
+def hot_keys(conn=None, window=3600, count=20, namespace=None):
+    '''
+    Returns the most contended inputs and outputs over the last ``window``
+    seconds (rounded out to whole CONTENTION_BUCKETs), as recorded with
+    CONTENTION_STATS: a list of up to ``count`` ``[reason, name, failures]``,
+    most failures first. Each start of a job counts once, however many times
+    it tried while waiting. Names are sanitized like graph history.
+    '''
+    client = _client(conn)
+    jprefix = _namespace_jobs_prefix(namespace, client.prefix)
+    now = time.time()
+    width = CONTENTION_BUCKET
+    pipe = client.conn.pipeline(False)
+    for bucket in range(int((now - window) // width), int(now // width) + 1):
+        pipe.zrange(jprefix + 'contention:%s:%s'%(width, bucket), 0, -1, withscores=True)
+    totals = defaultdict(int)
+    for counts in pipe.execute():
+        for member, score in counts:
+            if not isinstance(member, TEXT_TYPE):
+                member = member.decode('latin-1')
+            totals[member] += int(score)
+    hot = []
+    for member, failures in totals.items():
+        reason, _, name = member.partition(' ')
+        hot.append([reason, _uncluster_key(name), failures])
+    hot.sort(key=lambda x: (-x[2], x[0], x[1]))
+    return hot[:count]
 
 #-------------------------- for calling as a script --------------------------
 
 def handle_args(args):
+    global CONN
     if args.yes_history is not None:
         global GRAPH_HISTORY
         GRAPH_HISTORY = args.yes_history
 
+    if args.prefix is not None:
+        client = _client()
+        CONN = JobsClient(client.conn, args.prefix, client.graph_history)
+
+    if args.refresh:
+        print(time.asctime(), "Refreshing the job:", args.refresh)
+        result = _renew_job(CONN, args.refresh)
+        if result.get('missing'):
+            print(time.asctime(), "Job is not running.")
+        elif not result['ok'] or result.get('temp'):
+            print(time.asctime(), "Lock(s) lost:", result.get('err'), result.get('temp'))
+        else:
+            print(time.asctime(), "Refreshed.")
+
     if args.start:
         assert args.wait is not None and args.wait > 0, "--wait > 0 required when using --start"
         assert args.duration is not None and args.duration > 0, "--duration > 0 required when using --start"
@@ -1265,6 +3456,21 @@ def handle_args(args):
         _force_unlock([], args.unlock_outputs)
         print(time.asctime(), "Unlocked.")
 
+    if args.compact_graph:
+        print(time.asctime(), "Compacting graph history.")
+        removed = compact_graph(CONN, max_age=args.max_age, max_edges=args.max_edges)
+        print(time.asctime(), "Removed %i edges."%(removed,))
+
+    if args.index_graph:
+        print(time.asctime(), "Indexing graph history.")
+        print(time.asctime(), "Indexed %i edges."%(index_graph(CONN),))
+
+    if args.hot_keys is not None:
+        hot = hot_keys(CONN, args.hot_keys, args.limit or 20)
+        print(time.asctime(), "Most contended inputs and outputs, last %is:"%(args.hot_keys,))
+        for reason, name, failures in hot:
+            print("%10i  %-14s %s"%(failures, reason, name))
+
     gout = args.graphviz and (args.upstream or args.downstream or args.all)
 
     s = ''
@@ -1272,22 +3478,28 @@ def handle_args(args):
         print('digraph {\nrankdir=LR\n')
         s = ';'
 
+    if args.cache_dir:
+        global GRAPH_CACHE_DIR
+        GRAPH_CACHE_DIR = args.cache_dir
+
     if args.upstream:
-        _traverse(False, args.upstream, s, depth=args.depth, after=args.after, before=args.before)
+        _traverse(False, args.upstream, s, depth=args.depth, after=args.after,
+            before=args.before, limit=args.limit)
 
     if args.downstream:
-        _traverse(True, args.downstream, s, depth=args.depth, after=args.after, before=args.before)
+        _traverse(True, args.downstream, s, depth=args.depth, after=args.after,
+            before=args.before, limit=args.limit)
 
     skip = "copy_data.py:copy_table.*"
     if args.all:
-        inputs, outputs = edges(CONN, after=args.after, before=args.before)
-        for edge in inputs:
+        # streamed, so we don't need to hold the whole history in memory
+        for edge in iter_edges(CONN, False, after=args.after, before=args.before):
             if edge.endswith(skip):
                 continue
             print_edge(edge, None, s)
         skip += ' '
         skip2 = '/' + skip
-        for edge in outputs:
+        for edge in iter_edges(CONN, True, after=args.after, before=args.before):
             if edge.startswith(skip) or edge.startswith(skip2):
                 continue
             print_edge(edge, None, s)
@@ -1300,9 +3512,7 @@ def handle_args(args):
 
 #------------------------ set up the argument parser -------------------------
 
-parser = argparse.ArgumentParser(
-    formatter_class=argparse.RawDescriptionHelpFormatter,
-    epilog='''
+_CLI_EPILOG = '''
 This module intends to offer the ability to lock inputs and outputs in the
 context of data flows, data pipelines, etl flows, job flows, and general
 multi-locking.
@@ -1336,6 +3546,21 @@ Want to limit how deep the graph traversal goes?
 $ python {0} --upstream output --depth 5
 $ python {0} --upstream input --depth 25
 $ python {0} --upstream input --depth -1 # the default, unlimited
+$ python {0} --upstream input --limit 1000 # at most 1000 edges
+$ python {0} --upstream input --limit 0 # no limit, may block Redis for a while
+
+
+History recorded before --upstream and --downstream used the graph index? Index
+it once with:
+
+$ python {0} --index-graph
+
+
+Want to know which inputs and outputs jobs are waiting on the most (with
+jobs.CONTENTION_STATS enabled)?
+
+$ python {0} --hot-keys # the last hour
+$ python {0} --hot-keys 86400 --limit 50
 
 
 Want to limit your scan to jobs before, after, or between a timestamp, datetime,
@@ -1356,185 +3581,287 @@ Note when using --start and --yes-history:
     'blah.* -> foo.bar.*'
     'foo.bar.* -> other.*'
 
-'''.format(sys.argv[0] or 'jobs.py'))
-
-#-------------------------- what and how to output ---------------------------
-
-parser.add_argument(
-    '--graphviz',
-    action='store_true',
-    default=False,
-    help="If edges are to be output, produce them in a format meant for graphviz 'dot' command"
-)
-
-group = parser.add_mutually_exclusive_group()
-group.add_argument(
-    '--display-all-edges-ever-known',
-    '--all',
-    action='store_true',
-    dest='all',
-    default=False,
-    help="Print all input/output edges known about (useful for debugging)"
-)
-
-group.add_argument(
-    '--upstream',
-    help="Print the list of all upstream jobs and inputs from the provided job "
-         "identifier, input, or output, in a breadth-first traversal"
-)
-group.add_argument(
-    '--downstream',
-    help="Print the list of all downstream jobs and outputs from the provided "
-         "job identifier, input, or output, in a breadth-first traversal"
-)
-
-#------------------------------- job IO limits -------------------------------
-
-parser.add_argument(
-    '--depth',
-    type=int,
-    default=-1,
-    help="Sets the depth of the traversal for --upstream and --downstream "
-         "(negative numbers mean no-limit)"
-)
-
-parser.add_argument(
-    '--after',
-    help="If provided one of: timestamp ('1473825618.18592', '1473825618'), "
-         "datetime ('2016-09-12 12:14:32.234232', '2016-09-12 12:14:32', "
-         "'2016-09-12 12:14), or date ('2016-09-12'), will only produce jobs "
-         "inputs or outputs last seen after that timestamp, datetime, or date. "
-         "Note: only applies to --upstream and --downstream options, and only "
-         "the most recent run information is kept."
-)
-
-parser.add_argument(
-    '--before',
-    help="Like --after, only requires jobs to be *before* the provided timestamp "
-         "datetime, or date."
-)
-
-#--------------------------------- --refresh ---------------------------------
-
-group.add_argument(
-    '--refresh',
-    dest='refresh',
-    metavar="JOB_IDENTIFIER",
-    help="Will refresh an already-started job with the given job identifier."
-)
-
-#------------ --start - really start a job from the command-line -------------
-
-group.add_argument(
-    '--start',
-    dest='start',
-    metavar="JOB_IDENTIFIER",
-    help="Will start or refresh (if already started) the job with the given "
-         "job identifier. Note: if you want to lock inputs/outputs (the start "
-         "case, not the refresh case), you *must* provide them as --add-input "
-         "and --add-output arguments"
-)
-
-#--------------------------- --duration and --wait ---------------------------
-
-parser.add_argument(
-    '--duration',
-    type=int,
-    default=None,
-    help="How long to keep the lock for, required when using --start"
-)
-
-parser.add_argument(
-    '--wait',
-    type=int,
-    default=None,
-    help="How long to wait to acquire the lock, required when using --start"
-)
-
-#------------------------ --start inputs and outputs -------------------------
-
-parser.add_argument(
-    '--add-input',
-    action='append',
-    help="The list of inputs to lock when using --start"
-)
-
-parser.add_argument(
-    '--add-output',
-    action='append',
-    help="The list of outputs to lock/generate when using --start"
-)
-
-#------------------------------ --start history ------------------------------
-
-hgroup = parser.add_mutually_exclusive_group()
-hgroup.add_argument(
-    '--yes-history',
-    action='store_true',
-    default=None,
-    help="Will override the default history option in the system globals. Note: "
-         "only applies to --start calls that are actually starting a new job."
-)
-
-hgroup.add_argument(
-    '--no-history',
-    action='store_false',
-    dest='yes_history',
-    help="Will override the default history option in the system globals. Note: "
-         "only applies to --start calls that are actually starting a new job."
-)
-
-#------------------------- --start overwrite outputs -------------------------
-
-ogroup = parser.add_mutually_exclusive_group()
-ogroup.add_argument(
-    '--yes-overwrite',
-    action='store_true',
-    default=None,
-    help="Will pass overwrite=True when using --start"
-)
-
-ogroup.add_argument(
-    '--no-overwrite',
-    action='store_false',
-    dest='yes_overwrite',
-    help="Will pass overwrite=False when using --start"
-)
-
-#---------------------------- remaining arguments ----------------------------
-
-group.add_argument(
-    '--stop',
-    help="Unlock all inputs and outputs related to the provided job id, DO write "
-         "outputs"
-)
-group.add_argument(
-    '--stop-failed',
-    help="Unlock all inputs and outputs related to the provided job id, DO NOT "
-         "write outputs"
-)
-group.add_argument(
-    '--unlock-inputs',
-    nargs='*',
-    help="Unlocks the provided inputs"
-)
-group.add_argument(
-    '--unlock-outputs',
-    nargs='*',
-    help="Unlocks the provided outputs"
-)
-group.add_argument(
-    '--create-outputs',
-    nargs='*',
-    help="Unlocks and sets the provided outputs"
-)
+'''
+
+def _build_parser():
+    '''
+    Returns the argument parser for the command-line interface, built on
+    demand so importing jobs.py doesn't pay for it.
+    '''
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=_CLI_EPILOG.format(sys.argv[0] or 'jobs.py'))
+
+    #----------------------- --prefix - which tenant -------------------------
+
+    parser.add_argument(
+        '--prefix',
+        dest='prefix',
+        default=None,
+        help="Use this key prefix instead of the configured one, e.g. to look at "
+             "the jobs of one tenant when several share a Redis server"
+    )
+
+    #------------------------ what and how to output -------------------------
+
+    parser.add_argument(
+        '--graphviz',
+        action='store_true',
+        default=False,
+        help="If edges are to be output, produce them in a format meant for graphviz 'dot' command"
+    )
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--display-all-edges-ever-known',
+        '--all',
+        action='store_true',
+        dest='all',
+        default=False,
+        help="Print all input/output edges known about (useful for debugging)"
+    )
+
+    group.add_argument(
+        '--upstream',
+        help="Print the list of all upstream jobs and inputs from the provided job "
+             "identifier, input, or output, in a breadth-first traversal"
+    )
+    group.add_argument(
+        '--downstream',
+        help="Print the list of all downstream jobs and outputs from the provided "
+             "job identifier, input, or output, in a breadth-first traversal"
+    )
+
+    #----------------------------- job IO limits -----------------------------
+
+    parser.add_argument(
+        '--depth',
+        type=int,
+        default=-1,
+        help="Sets the depth of the traversal for --upstream and --downstream "
+             "(negative numbers mean no-limit)"
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        default=None,
+        help="Run --upstream and --downstream against a snapshot of the graph "
+             "history kept in this directory, only fetching new edges from Redis"
+    )
+
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=None,
+        help="Sets the maximum number of edges to print for --upstream and "
+             "--downstream (the default is jobs.TRAVERSE_LIMIT, 0 for no "
+             "limit), or of keys for --hot-keys"
+    )
+
+    parser.add_argument(
+        '--after',
+        help="If provided one of: timestamp ('1473825618.18592', '1473825618'), "
+             "datetime ('2016-09-12 12:14:32.234232', '2016-09-12 12:14:32', "
+             "'2016-09-12 12:14), or date ('2016-09-12'), will only produce jobs "
+             "inputs or outputs last seen after that timestamp, datetime, or date. "
+             "Note: only applies to --upstream and --downstream options, and only "
+             "the most recent run information is kept."
+    )
+
+    parser.add_argument(
+        '--before',
+        help="Like --after, only requires jobs to be *before* the provided timestamp "
+             "datetime, or date."
+    )
+
+    #----------------------------- --index-graph -----------------------------
+
+    parser.add_argument(
+        '--index-graph',
+        action='store_true',
+        default=False,
+        help="Index graph history recorded by older versions of jobs.py, so that "
+             "--upstream and --downstream can find it"
+    )
+
+    #---------------------------- --compact-graph ----------------------------
+
+    parser.add_argument(
+        '--compact-graph',
+        action='store_true',
+        default=False,
+        help="Remove (or summarize, with jobs.GRAPH_SUMMARY) graph history past "
+             "the configured retention, or the --max-age and --max-edges provided"
+    )
+
+    parser.add_argument(
+        '--max-age',
+        type=float,
+        default=None,
+        help="With --compact-graph, how long to keep graph history, in seconds"
+    )
+
+    parser.add_argument(
+        '--max-edges',
+        type=int,
+        default=None,
+        help="With --compact-graph, how many input and output edges to keep"
+    )
+
+    #------------------------------ --hot-keys -------------------------------
+
+    parser.add_argument(
+        '--hot-keys',
+        type=float,
+        nargs='?',
+        const=3600,
+        default=None,
+        metavar='SECONDS',
+        help="Show the inputs and outputs with the most failed attempts to lock "
+             "them over the last SECONDS (default 3600), recorded with "
+             "jobs.CONTENTION_STATS, up to --limit (default 20)"
+    )
+
+    #------------------------------- --refresh -------------------------------
+
+    group.add_argument(
+        '--refresh',
+        dest='refresh',
+        metavar="JOB_IDENTIFIER",
+        help="Will refresh an already-started job with the given job identifier."
+    )
+
+    #---------- --start - really start a job from the command-line -----------
+
+    group.add_argument(
+        '--start',
+        dest='start',
+        metavar="JOB_IDENTIFIER",
+        help="Will start or refresh (if already started) the job with the given "
+             "job identifier. Note: if you want to lock inputs/outputs (the start "
+             "case, not the refresh case), you *must* provide them as --add-input "
+             "and --add-output arguments"
+    )
+
+    #------------------------- --duration and --wait -------------------------
+
+    parser.add_argument(
+        '--duration',
+        type=int,
+        default=None,
+        help="How long to keep the lock for, required when using --start"
+    )
+
+    parser.add_argument(
+        '--wait',
+        type=int,
+        default=None,
+        help="How long to wait to acquire the lock, required when using --start"
+    )
+
+    #---------------------- --start inputs and outputs -----------------------
+
+    parser.add_argument(
+        '--add-input',
+        action='append',
+        help="The list of inputs to lock when using --start"
+    )
+
+    parser.add_argument(
+        '--add-output',
+        action='append',
+        help="The list of outputs to lock/generate when using --start"
+    )
+
+    #---------------------------- --start history ----------------------------
+
+    hgroup = parser.add_mutually_exclusive_group()
+    hgroup.add_argument(
+        '--yes-history',
+        action='store_true',
+        default=None,
+        help="Will override the default history option in the system globals. Note: "
+             "only applies to --start calls that are actually starting a new job."
+    )
+
+    hgroup.add_argument(
+        '--no-history',
+        action='store_false',
+        dest='yes_history',
+        help="Will override the default history option in the system globals. Note: "
+             "only applies to --start calls that are actually starting a new job."
+    )
+
+    #----------------------- --start overwrite outputs -----------------------
+
+    ogroup = parser.add_mutually_exclusive_group()
+    ogroup.add_argument(
+        '--yes-overwrite',
+        action='store_true',
+        default=None,
+        help="Will pass overwrite=True when using --start"
+    )
+
+    ogroup.add_argument(
+        '--no-overwrite',
+        action='store_false',
+        dest='yes_overwrite',
+        help="Will pass overwrite=False when using --start"
+    )
+
+    #-------------------------- remaining arguments --------------------------
+
+    group.add_argument(
+        '--stop',
+        help="Unlock all inputs and outputs related to the provided job id, DO write "
+             "outputs"
+    )
+    group.add_argument(
+        '--stop-failed',
+        help="Unlock all inputs and outputs related to the provided job id, DO NOT "
+             "write outputs"
+    )
+    group.add_argument(
+        '--unlock-inputs',
+        nargs='*',
+        help="Unlocks the provided inputs"
+    )
+    group.add_argument(
+        '--unlock-outputs',
+        nargs='*',
+        help="Unlocks the provided outputs"
+    )
+    group.add_argument(
+        '--create-outputs',
+        nargs='*',
+        help="Unlocks and sets the provided outputs"
+    )
+
+    return parser
+
 
 def main():
     global ARGS
-    ARGS = parser.parse_args()
+    ARGS = _build_parser().parse_args()
     handle_args(ARGS)
 
-__all__ = list(set(globals()) - _all)
+_ASYNC_NAMES = ('AsyncResourceManager', 'async_resource_manager')
+
+def __getattr__(name):
+    '''
+    Re-exports the asyncio API from jobs_async on first use (Python 3.7+), so
+    ``import jobs`` doesn't import asyncio.
+    '''
+    if name in _ASYNC_NAMES:
+        import jobs_async
+        return getattr(jobs_async, name)
+    raise AttributeError("module %r has no attribute %r"%(__name__, name))
+
+# the asyncio API isn't in __all__, so that ``from jobs import *`` doesn't
+# import asyncio either; import it by name
+__all__ = list(set(globals()) - _all - {'__getattr__'})
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,548 @@
+
+'''
+asyncio support for jobs.py, using ``redis.asyncio`` connections (redis-py
+4.2 or later, Python 3.7 or later).
+
+Copyright 2016 Josiah Carlson
+
+This library licensed under the GNU LGPL v2.1
+
+Offers ``AsyncResourceManager`` and ``async_resource_manager``, which have the
+same locking semantics (and use the same Lua scripts) as ``ResourceManager``
+and ``resource_manager``, but don't block the event loop. Both are re-exported
+by the ``jobs`` module, see its documentation for examples.
+'''
+
+import asyncio
+import binascii
+from collections import defaultdict
+import functools
+import os
+import sys
+import time
+
+import redis.exceptions
+
+import jobs
+
+LISTENERS = {}
+
+
+async def _call_script(conn, script, keys, args):
+    '''
+    Calls a script returned by jobs._script_load() on an asyncio connection,
+    loading the script as necessary. Like jobs._script_load(), uses FCALL
+    when jobs.USE_FUNCTIONS is true and the server supports it.
+    '''
+    client = jobs._client(conn)
+    conn = client.conn
+    keys = tuple(keys)
+    args = tuple(args)
+    if jobs.USE_FUNCTIONS and script.name and jobs.NO_FUNCTIONS not in client.scripts:
+        for attempt in range(2):
+            try:
+                return await conn.execute_command(
+                    'FCALL', jobs._functions()[0] + '_' + script.name, len(keys), *(keys + args))
+            except redis.exceptions.ResponseError as msg:
+                if attempt or not await _function_error(client, msg):
+                    raise
+            if jobs.NO_FUNCTIONS in client.scripts:
+                break
+
+    try:
+        return await conn.execute_command(
+            'EVALSHA', jobs._script_sha(script), len(keys), *(keys + args))
+    except redis.exceptions.ResponseError as msg:
+        if not any(msg.args[0].startswith(nsm) for nsm in jobs.NO_SCRIPT_MESSAGES):
+            raise
+    return await conn.execute_command(
+        'EVAL', script.script, len(keys), *(keys + args))
+
+async def _load_functions(client):
+    # like jobs.load_functions()
+    library, code = jobs._functions()
+    try:
+        await client.conn.execute_command('FUNCTION', 'LOAD', code)
+    except redis.exceptions.ResponseError as msg:
+        if jobs._unknown_command(msg):
+            client.scripts.add(jobs.NO_FUNCTIONS)
+            return False
+        if 'already exists' not in msg.args[0]:
+            raise
+    client.scripts.add(library)
+    return True
+
+async def _function_error(client, msg):
+    # like jobs._function_error()
+    if jobs._unknown_command(msg):
+        client.scripts.add(jobs.NO_FUNCTIONS)
+        return True
+    if 'function not found' in msg.args[0].lower():
+        client.scripts.discard(jobs._functions()[0])
+        await _load_functions(client)
+        return True
+    return False
+
+
+# The following mirror the internal helpers of the same names in jobs.py.
+
+async def _run_if_possible(conn, inputs, outputs, identifier, duration, overwrite, **kwargs):
+    groups = jobs._slot_groups(inputs, outputs)
+    results = []
+    for group_inputs, group_outputs in groups:
+        keys, args = jobs._run_if_possible_args(conn, group_inputs, group_outputs,
+            identifier, duration, overwrite, **kwargs)
+        results.append(jobs._lock_result(
+            await _call_script(conn, jobs._run_if_possible_lua, keys, args)))
+        if not results[-1]['ok']:
+            if duration:
+                # don't hold some of our locks while waiting for the others
+                for group_inputs, group_outputs in groups[:len(results) - 1]:
+                    await _finish_job(conn, group_inputs, group_outputs, identifier,
+                        failed=True, cache=kwargs.get('cache'))
+            break
+    return jobs._merge_results(results)
+
+async def _refresh_job(conn, inputs, outputs, identifier, duration, overwrite, cache=None):
+    results = []
+    for group_inputs, group_outputs in jobs._slot_groups(inputs, outputs):
+        keys, args = jobs._refresh_job_args(conn, group_inputs, group_outputs,
+            identifier, duration, overwrite, cache=cache)
+        results.append(jobs._lock_result(
+            await _call_script(conn, jobs._run_if_possible_lua, keys, args)))
+    return jobs._merge_results(results)
+
+async def _renew_job(conn, identifier, inputs=(), outputs=()):
+    results = []
+    for group_inputs, group_outputs in jobs._slot_groups(list(inputs), list(outputs)):
+        keys, args = jobs._renew_job_args(conn, identifier, (group_inputs + group_outputs + [None])[0])
+        results.append(jobs._lock_result(
+            await _call_script(conn, jobs._renew_job_lua, keys, args)))
+        if results[-1].get('missing'):
+            return results[-1]
+    return jobs._merge_results(results)
+
+async def _leave_queues(conn, inputs, outputs, token, cache=None):
+    for group_inputs, group_outputs in jobs._slot_groups(inputs, outputs):
+        keys, args = jobs._leave_queues_args(conn, group_inputs, group_outputs, token, cache=cache)
+        await _call_script(conn, jobs._leave_queues_lua, keys, args)
+
+async def _finish_job(conn, inputs, outputs, identifier, failed=False, cache=None):
+    for group_inputs, group_outputs in jobs._slot_groups(inputs, outputs):
+        keys, args = jobs._finish_job_args(conn, group_inputs, group_outputs, identifier,
+            failed, cache=cache)
+        await _call_script(conn, jobs._finish_job_lua, keys, args)
+
+
+def async_resource_manager(inputs, outputs, duration, wait=None, overwrite=True,
+        conn=None, graph_history=jobs._GHD, suffix=None, fair=False):
+    '''
+    Like jobs.resource_manager(), only for ``async def`` functions, which are
+    passed an AsyncResourceManager.
+
+    Arguments:
+        * inputs - the list of inputs that need to exist to start the job
+        * outputs - the list of outputs to produce
+        * duration - how long you want to lock the inputs and outputs from
+            modification from other jobs
+        * wait=None - how long to wait for inputs to be available and for
+            when overwrite=True, how long to wait for other writers to
+            finish writing
+        * overwrite=False - whether to overwrite a pre-existing output if it
+            already exists
+        * conn=None - a ``redis.asyncio`` connection (or a JobsClient wrapping
+            one) to use (provide here, or when calling .start())
+        * graph_history=True - whether to keep history of graph edges
+        * fair=False - whether to wait in line (first come, first served) with
+            other jobs using fair=True for contended inputs and outputs
+    '''
+    def wrap(fcn):
+        @functools.wraps(fcn)
+        async def call(*args, **kwargs):
+            manager = AsyncResourceManager(inputs, outputs, duration, wait,
+                overwrite, conn, graph_history, jobs._caller_name(fcn), suffix, fair)
+            ex = False
+            try:
+                return await fcn(manager, *args, **kwargs)
+            except:
+                ex = True
+                raise
+            finally:
+                await manager.stop(failed=ex)
+        return call
+    return wrap
+
+
+class AsyncResourceManager(jobs.ResourceManager):
+    '''
+    Like jobs.ResourceManager, only .start(), .refresh(), .stop(), and
+    .can_run() are coroutines, and it is used with ``async with``.
+
+    Unlike jobs.ResourceManager:
+     * ``async with`` starts the job with ``auto_refresh=True``, refreshing
+       the locks from an asyncio task (``with`` doesn't refresh at all)
+     * started jobs aren't added to jobs.LOCKED, and aren't stopped by the
+       atexit/signal handlers, which can't await .stop(); their locks are left
+       to expire
+    '''
+    def __init__(self, inputs, outputs, duration, wait=None, overwrite=True,
+            conn=None, graph_history=jobs._GHD, identifier=None, suffix=None,
+            fair=False):
+        identifier = identifier or jobs._caller_name(sys._getframe(1).f_code)
+        super(AsyncResourceManager, self).__init__(inputs, outputs, duration,
+            wait, overwrite, conn, graph_history, identifier, suffix, fair)
+        self._refresh_task = None
+        self._alock = None
+
+    @property
+    def _async_lock(self):
+        # created lazily, so managers can be created outside of an event loop
+        if self._alock is None:
+            self._alock = asyncio.Lock()
+        return self._alock
+
+    def _get_conn(self, conn):
+        self.conn = conn or self.conn
+        if not self.conn:
+            raise RuntimeError("Cannot start a job without a connection to Redis!")
+        return self.conn
+
+    async def can_run(self, conn=None):
+        '''
+        Will return whether the job can be run immediately, but does not start
+        the job.
+        '''
+        conn = conn or self.conn
+        if not conn:
+            raise RuntimeError("Cannot start a job without a connection to Redis!")
+        if self.is_running:
+            raise RuntimeError("Already started!")
+        return await _run_if_possible(conn, self.inputs, self.outputs,
+            self.identifier, 0, self.overwrite, cache=self._io_cache)
+
+    async def refresh(self, lost_lock_fail=False, **kwargs):
+        '''
+        For jobs that may take longer than the provided "duration", you should
+        .refresh() periodically to ensure that someone doesn't overwrite your
+        inputs or outputs.
+
+        Arguments:
+            * lock_lost_fail - fail if any lock was lost, and raise an exception
+
+        Note: will only refresh at most once/second.
+        '''
+        inside_auto_refresh = kwargs.get('inside_auto_refresh')
+        async with self._async_lock:
+            if self.is_running and time.time() - self.last_refreshed > 1:
+                jobs.DEFAULT_LOGGER.debug("Refreshing job locks")
+                refreshed_at = time.time()
+                lost = await _renew_job(self.conn, self.identifier, self.inputs, self.outputs)
+                if lost.get('missing'):
+                    # our lease expired, check (and reacquire) everything
+                    lost = await _refresh_job(self.conn, self.inputs, self.outputs,
+                        self.identifier, self.duration, self.overwrite, cache=self._io_cache)
+                jobs._metric('observe', 'refresh.latency', time.time() - refreshed_at)
+                jobs._failure_metrics(lost)
+
+                if lost.get('err') or lost.get('temp'):
+                    if lost_lock_fail:
+                        auto = inside_auto_refresh and self.auto_refresh
+                        await self._stop(failed=True)
+                        if not auto:
+                            raise jobs.ResourceUnavailable(lost.get('err'))
+
+                    jobs.DEFAULT_LOGGER.warning("Lock(s) lost due to timeout: %r", lost)
+
+                if self.is_running:
+                    self.last_refreshed = time.time()
+                return lost
+
+    async def start(self, conn=None, auto_refresh=None):
+        '''
+        Will attempt to start the run within self.wait seconds, see
+        jobs.ResourceManager.start(). If ``auto_refresh`` is provided, and can
+        be considered boolean ``True``, an asyncio task will refresh the locks
+        until the job is stopped.
+        '''
+        async with self._async_lock:
+            result = await self._start(conn, auto_refresh)
+        if self.is_running and self.auto_refresh and not self._refresh_task:
+            self._refresh_task = asyncio.ensure_future(self._auto_refresh())
+        return result
+
+    async def _start(self, conn, auto_refresh):
+        conn = self._get_conn(conn)
+        if self.is_running:
+            return self
+
+        if not self.identifier or not isinstance(self.identifier, (str, jobs.TYPE_NG)):
+            raise RuntimeError("Can't start job without a valid identifier")
+
+        jobs.DEFAULT_LOGGER.info("Trying to start job with inputs: %r and outputs: %r",
+            self.inputs, self.outputs)
+
+        waiter = _AsyncReleaseWaiter(conn) if jobs.PUSH_WAKEUPS and self.wait else None
+        # identifies our place in line for fair=True, unique to this .start()
+        token = binascii.hexlify(os.urandom(8)).decode('latin-1') if self.fair else None
+
+        started_at = time.time()
+        attempts = [0]
+        async def tr():
+            jobs.DEFAULT_LOGGER.debug("Trying to start job")
+            attempts[0] += 1
+            result = await _run_if_possible(conn, self.inputs, self.outputs,
+                self.identifier, self.duration, self.overwrite,
+                history=self.graph_history, wake=bool(waiter), token=token,
+                count=attempts[0] == 1, cache=self._io_cache)
+            if result['ok']:
+                jobs.DEFAULT_LOGGER.info("Starting job")
+                self.last_refreshed = time.time()
+                self.auto_refresh = bool(auto_refresh)
+                jobs._start_metrics(started_at, attempts[0], 'started')
+            else:
+                jobs.DEFAULT_LOGGER.debug("Failed to start job: %r", result)
+                jobs._failure_metrics(result)
+            return result
+
+        last_reported = time.time() - 29
+        stop_waiting = time.time() + self.wait
+        try:
+            while time.time() < stop_waiting:
+                result = await tr()
+                if result['ok']:
+                    return self
+
+                if 'output_exists' in result['err']:
+                    # can't recover without overwriting, don't bother waiting
+                    break
+
+                if time.time() - last_reported >= 30:
+                    jobs.DEFAULT_LOGGER.info("Still waiting to start job... %r", result['err'])
+                    last_reported = time.time()
+
+                remaining = max(stop_waiting - time.time(), 0)
+                if waiter and await waiter.wait(result, remaining):
+                    continue
+
+                # Wait up to 10ms between tests
+                await asyncio.sleep(min(remaining, .01))
+
+            # try one more time before bailing out...
+            result = await tr()
+            if result['ok']:
+                return self
+        finally:
+            if waiter:
+                await waiter.close()
+            if token and not self.is_running:
+                # give up our place in line
+                try:
+                    await _leave_queues(conn, self.inputs, self.outputs, token,
+                        cache=self._io_cache)
+                except redis.exceptions.RedisError:
+                    jobs.DEFAULT_LOGGER.warning("Failed to leave the line for locks",
+                        exc_info=True)
+
+        jobs.DEFAULT_LOGGER.info("Failed to start job: %r", result['err'])
+        jobs._start_metrics(started_at, attempts[0], 'failed')
+        raise jobs.ResourceUnavailable(result['err'])
+
+    async def _auto_refresh(self):
+        try:
+            while self.is_running and self.auto_refresh:
+                # same schedule as the auto-refresh thread
+                await asyncio.sleep(max(
+                    self.last_refreshed + jobs._refresh_interval(self) + .01 - time.time(), .1))
+                try:
+                    await self.refresh(inside_auto_refresh=True)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    jobs.DEFAULT_LOGGER.exception("Exception while automatically refreshing")
+        finally:
+            if self._refresh_task is asyncio.current_task():
+                self._refresh_task = None
+
+    async def stop(self, failed=False):
+        '''
+        Stops a job if running. If the optional "failed" argument is true,
+        outputs will not be set as available.
+        '''
+        if self.is_running:
+            async with self._async_lock:
+                await self._stop(failed)
+
+    async def _stop(self, failed):
+        if not self.is_running:
+            # another task could have changed the status
+            return
+        task = self._refresh_task
+        if task and task is not asyncio.current_task():
+            task.cancel()
+        self._refresh_task = None
+        jobs.DEFAULT_LOGGER.info("Stopping job failed = %r", bool(failed))
+        try:
+            finished_at = time.time()
+            await _finish_job(self.conn, self.inputs, self.outputs,
+                self.identifier, bool(failed), cache=self._io_cache)
+            jobs._metric('observe', 'finish.latency', time.time() - finished_at)
+        finally:
+            self.last_refreshed = None
+            self.auto_refresh = None
+
+    def __enter__(self):
+        raise TypeError("Use 'async with' with an AsyncResourceManager")
+
+    async def __aenter__(self):
+        # always refreshed, see the class docstring
+        return await self.start(self.conn, auto_refresh=True)
+
+    async def __aexit__(self, typ, value, tb):
+        await self.stop(bool(typ or value or tb))
+
+
+class _AsyncReleaseListener(object):
+    '''
+    Internal implementation detail; like jobs._ReleaseListener, reading with an
+    asyncio task in the event loop that created it.
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self.loop = asyncio.get_running_loop()
+        self.pubsub = None
+        self.task = None
+        self.broken = False
+        self.waiters = defaultdict(set)
+
+    async def subscribe(self, waiter, channels):
+        if self.broken:
+            raise redis.exceptions.ConnectionError("release listener failed")
+        new = [ch for ch in channels if not self.waiters[ch]]
+        for ch in channels:
+            self.waiters[ch].add(waiter)
+        if new:
+            if self.pubsub is None:
+                self.pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+            await self.pubsub.subscribe(*new)
+        if not self.task or self.task.done():
+            self.task = asyncio.ensure_future(self._listen())
+
+    async def unsubscribe(self, waiter, channels):
+        old = []
+        for ch in channels:
+            self.waiters[ch].discard(waiter)
+            if not self.waiters[ch]:
+                del self.waiters[ch]
+                old.append(ch)
+        if not self.waiters:
+            await self._stop()
+        elif old and self.pubsub is not None and not self.broken:
+            try:
+                await self.pubsub.unsubscribe(*old)
+            except redis.exceptions.RedisError:
+                pass
+
+    async def _stop(self):
+        # The last waiter left, so stop listening (and don't leave the task
+        # pending when the loop closes). The next subscribe() starts over.
+        task, self.task = self.task, None
+        pubsub, self.pubsub = self.pubsub, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if pubsub is not None:
+            try:
+                # reset() is deprecated in redis-py 5
+                await getattr(pubsub, 'aclose', pubsub.reset)()
+            except redis.exceptions.RedisError:
+                pass
+
+    async def _listen(self):
+        try:
+            while True:
+                message = await self.pubsub.get_message(timeout=1)
+                if not message:
+                    continue
+                channel = message['channel']
+                if not isinstance(channel, str):
+                    channel = channel.decode('latin-1')
+                for waiter in list(self.waiters.get(channel, ())):
+                    waiter.event.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            jobs.DEFAULT_LOGGER.warning("Release listener failed, polling for locks",
+                exc_info=True)
+            self.broken = True
+            # let everyone fall back to polling
+            for waiter in set(w for ws in self.waiters.values() for w in ws):
+                waiter.event.set()
+
+
+def _release_listener(conn):
+    if not callable(getattr(conn, 'pubsub', None)):
+        return None
+    key = getattr(conn, 'connection_pool', conn)
+    listener = LISTENERS.get(key)
+    if listener is None or listener.broken or listener.loop is not asyncio.get_running_loop():
+        listener = LISTENERS[key] = _AsyncReleaseListener(conn)
+    return listener
+
+
+class _AsyncReleaseWaiter(object):
+    '''
+    Internal implementation detail; like jobs._ReleaseWaiter, for asyncio.
+    '''
+    def __init__(self, conn):
+        client = jobs._client(conn)
+        self.listener = _release_listener(client.conn)
+        self.prefix = client.prefix
+        self.event = asyncio.Event()
+        self.channels = set()
+
+    async def wait(self, result, timeout):
+        if self.listener is None or self.listener.broken:
+            return False
+
+        err = result.get('err') or {}
+        channels = set(jobs._release_channel(key, self.prefix)
+            for why in jobs.WAIT_REASONS for key in err.get(why, ()))
+        if not channels:
+            return False
+
+        new = channels - self.channels
+        if new:
+            try:
+                await self.listener.subscribe(self, new)
+            except redis.exceptions.RedisError:
+                jobs.DEFAULT_LOGGER.warning("Release notifications unavailable, polling for locks",
+                    exc_info=True)
+                await self.close()
+                self.listener = None
+                return False
+            self.channels.update(new)
+            # A release may have happened before we subscribed, so check
+            # again before blocking.
+            return True
+
+        timeout = min(timeout, jobs.POLL_FALLBACK)
+        if result.get('wake') is not None:
+            timeout = min(timeout, result['wake'] + .001)
+
+        try:
+            await asyncio.wait_for(self.event.wait(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+        return True
+
+    async def close(self):
+        if self.listener is not None and self.channels:
+            await self.listener.unsubscribe(self, self.channels)
+        self.channels.clear()
+
+
+__all__ = ['AsyncResourceManager', 'async_resource_manager']
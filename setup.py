@@ -19,7 +19,7 @@ setup(
     author='Josiah Carlson',
     author_email='josiah.carlson@gmail.com',
     url='https://github.com/josiahcarlson/jobs',
-    py_modules=['jobs'],
+    py_modules=['jobs', 'jobs_async'],
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'License :: OSI Approved :: GNU Library or Lesser General Public License (LGPL)',
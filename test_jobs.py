@@ -2,13 +2,36 @@
 import binascii
 import os
 import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 import jobs
 
 import redis
 
+try:
+    from redis.crc import key_slot
+except ImportError:
+    # older redis-py, Redis Cluster uses CRC16/XMODEM
+    def key_slot(key):
+        key = key.encode('latin-1') if not isinstance(key, bytes) else key
+        start = key.find(b'{')
+        if start > -1:
+            end = key.find(b'}', start + 1)
+            if end > start + 1:
+                key = key[start + 1:end]
+        return binascii.crc_hqx(key, 0) % 16384
+
 jobs.CONN = CONN = redis.Redis(db=15)
 
 
@@ -20,9 +43,12 @@ def random_identifier():
 class TestJobs(unittest.TestCase):
     def setUp(self):
         CONN.mset({NG.input1:'', NG.input2:'', NG.input3:''})
+        self.prefixes = []
 
     def tearDown(self):
         kk = CONN.keys('*' + str(NG) + '*')
+        for prefix in self.prefixes:
+            kk.extend(CONN.keys(prefix + '*'))
         kk2 = CONN.keys('*test.*')
         trim = 1000000*(time.time() - 300)
         for k in kk2:
@@ -33,6 +59,12 @@ class TestJobs(unittest.TestCase):
         if kk:
             CONN.delete(*kk)
 
+    def _prefix(self, name):
+        # a unique key prefix for a JobsClient, cleaned up by tearDown()
+        prefix = '%s%s:'%(name, random_identifier().decode('latin-1'))
+        self.prefixes.append(prefix)
+        return prefix
+
     # First set of tests is meant to test the raw underlying API that does all
     # of the work.
 
@@ -88,6 +120,54 @@ class TestJobs(unittest.TestCase):
 
         jobs._finish_job(CONN, [NG.input1, NG.input3], [NG.input2], id)
 
+    def test_3_renew_job(self):
+        id = random_identifier().decode('latin-1')
+        self.assertEqual(jobs._run_if_possible(CONN, [NG.input1], [NG.output1], id, 1, False),
+                         {'ok': True})
+        self.assertEqual(jobs._renew_job(CONN, id), {'ok': True})
+        self.assertEqual(CONN.get('jobs:lease:' + id), b'[1,false]')
+
+        # lost locks are reported and reacquired, like _refresh_job()
+        CONN.delete('olock:' + str(NG.output1), 'ilock:' + str(NG.input1))
+        self.assertEqual(jobs._renew_job(CONN, id), {'ok': True, 'temp': {
+            'input_lock_lost': [NG.input1], 'output_lock_lost': [NG.output1]}})
+        self.assertEqual(CONN.get('olock:' + str(NG.output1)), id.encode('latin-1'))
+        self.assertIsNotNone(CONN.zscore('ilock:' + str(NG.input1), id))
+
+        CONN.delete(NG.input1)
+        self.assertEqual(jobs._renew_job(CONN, id),
+                         {'err': {'input_lock_lost': [NG.input1]}, 'ok': False, 'temp': {}})
+
+        # no lease, no renewal
+        jobs._finish_job(CONN, [NG.input1], [NG.output1], id)
+        self.assertEqual(jobs._renew_job(CONN, id), {'ok': False, 'missing': True})
+
+    def test_3_amortized_cleanup(self):
+        prefix = self._prefix('sweep')
+        client = jobs.JobsClient(CONN, prefix)
+        running = prefix + 'jobs:running'
+        ilock = prefix + 'ilock:' + str(NG.input1)
+        CONN.set(prefix + str(NG.input1), '')
+        CONN.execute_command('ZADD', running, 1, 'dead0', 1, 'dead1', 1, 'dead2', 1, 'dead3', 1, 'dead4')
+        CONN.execute_command('ZADD', ilock, 1, 'dead')
+        # checks that can't start the job don't write anything
+        jobs._run_if_possible(client, [], [NG.input1], random_identifier(), 5, False)
+        jobs._run_if_possible(client, [NG.input1], [], random_identifier(), 0, False)
+        self.assertEqual(CONN.zcard(running), 5)
+        self.assertEqual(CONN.zcard(ilock), 1)
+        # ... and expired input locks don't block writers
+        self.assertEqual(jobs._run_if_possible(client, [], [NG.input1], random_identifier(), 0, True),
+                         {'ok': True})
+
+        # starting jobs cleans out a few expired entries at a time
+        with mock.patch('jobs.SWEEP_LIMIT', 2):
+            id = random_identifier().decode('latin-1')
+            jobs._run_if_possible(client, [NG.input1], [], id, 5, False)
+            self.assertEqual(CONN.zcard(running), 4)
+            self.assertEqual(CONN.zrange(ilock, 0, -1), [id.encode('latin-1')])
+            jobs._finish_job(client, [NG.input1], [], id)
+            self.assertEqual(CONN.zcard(running), 1)
+
     # now test the actual resource manager that people should use
 
     def test_4_resource_manager(self):
@@ -155,5 +235,681 @@ class TestJobs(unittest.TestCase):
                 'output_lock_lost': [NG.output1], 'input_lock_lost': [NG.input1, NG.input2]
             }})
 
+    def test_5_refresh_by_id(self):
+        with jobs.ResourceManager([NG.input1, NG.input2], [NG.output1], 5) as job:
+            time.sleep(1.1)
+            with mock.patch('jobs._refresh_job', wraps=jobs._refresh_job) as refresh:
+                self.assertEqual(job.refresh(), {'ok': True})
+                # the lease was enough, no need to send the keys
+                self.assertEqual(refresh.call_count, 0)
+                time.sleep(1.1)
+                CONN.delete('jobs:lease:' + job.identifier)
+                self.assertEqual(job.refresh(), {'ok': True})
+                self.assertEqual(refresh.call_count, 1)
+
+    def _wait_for_release(self):
+        # hold NG.output1 for a while, releasing it in the background
+        id = random_identifier()
+        jobs._run_if_possible(CONN, [], [NG.output1], id, 30, True)
+        threading.Timer(.5, jobs._finish_job, (CONN, [], [NG.output1], id)).start()
+
+        with mock.patch('jobs._run_if_possible', wraps=jobs._run_if_possible) as rip:
+            with jobs.ResourceManager([], [NG.output1], 5, 15, conn=CONN):
+                pass
+        return rip.call_count
+
+    def test_6_release_wakeup(self):
+        # make sure we aren't woken up by the fallback poll
+        with mock.patch('jobs.POLL_FALLBACK', 60):
+            # a 10ms poll would have needed ~50 attempts
+            self.assertLess(self._wait_for_release(), 10)
+
+            # lock expiration wakes up waiters too
+            jobs._run_if_possible(CONN, [], [NG.output1], random_identifier(), 2, True)
+            t = time.time()
+            with jobs.ResourceManager([], [NG.output1], 5, 15, conn=CONN):
+                pass
+            self.assertGreater(time.time() - t, 1)
+            self.assertLess(time.time() - t, 10)
+
+        # outputs created outside of jobs wake up waiters
+        with mock.patch('jobs.POLL_FALLBACK', 60):
+            threading.Timer(.5, jobs._create_outputs, ([str(NG.output3)], CONN)).start()
+            t = time.time()
+            with jobs.ResourceManager([NG.output3], [], 5, 15, conn=CONN):
+                pass
+            self.assertLess(time.time() - t, 10)
+
+        # the listener lets go of its connection when nobody is waiting
+        listener = jobs.LISTENERS[CONN.connection_pool]
+        for _ in range(300):
+            if listener.thread is None:
+                break
+            time.sleep(.01)
+        self.assertIsNone(listener.thread)
+        self.assertIsNone(listener.pubsub)
+        # ... and starts over for the next waiter
+        with mock.patch('jobs.POLL_FALLBACK', 60):
+            self.assertLess(self._wait_for_release(), 10)
+
+    def test_6_polling_fallback(self):
+        with mock.patch('jobs.PUSH_WAKEUPS', False):
+            self.assertGreater(self._wait_for_release(), 10)
+
+        # pub/sub failures fall back to polling
+        with mock.patch('jobs._ReleaseListener.subscribe',
+                side_effect=redis.exceptions.ConnectionError):
+            self.assertGreater(self._wait_for_release(), 10)
+
+    def test_7_fair_queue(self):
+        id = random_identifier()
+        jobs._run_if_possible(CONN, [], [NG.output1], id, 30, True)
+
+        order = []
+        def waiter(name):
+            with jobs.ResourceManager([], [NG.output1], 5, 15, conn=CONN, fair=True):
+                order.append(name)
+
+        threads = []
+        for name in 'ab':
+            threads.append(threading.Thread(target=waiter, args=(name,)))
+            threads[-1].start()
+            # wait for the waiter to get in line
+            for _ in range(500):
+                if CONN.zcard('jobs:queue:' + str(NG.output1)) == len(threads):
+                    break
+                time.sleep(.01)
+        jobs._finish_job(CONN, [], [NG.output1], id)
+        for t in threads:
+            t.join()
+        self.assertEqual(order, ['a', 'b'])
+        # everyone left the line
+        self.assertFalse(CONN.zcard('jobs:queue:' + str(NG.output1)))
+
+    def test_7_fair_reader_missing_input(self):
+        # a fair reader waiting for an input that doesn't exist yet doesn't
+        # block the fair writer that creates it
+        started = []
+        def reader():
+            with jobs.ResourceManager([NG.output11], [], 5, 15, conn=CONN, fair=True):
+                started.append(time.time())
+        t = threading.Thread(target=reader)
+        t.start()
+        for _ in range(500):
+            if CONN.keys('jobs:waiting:*'):
+                break
+            time.sleep(.01)
+        self.assertFalse(CONN.exists('jobs:queue:' + str(NG.output11)))
+        with jobs.ResourceManager([], [NG.output11], 5, 1, conn=CONN, fair=True):
+            pass
+        t.join()
+        self.assertEqual(len(started), 1)
+
+    def test_7_fair_queue_cleanup(self):
+        id = random_identifier()
+        jobs._run_if_possible(CONN, [], [NG.output1], id, 30, True)
+        queue = 'jobs:queue:' + str(NG.output1)
+
+        # jobs that give up waiting leave the line
+        try:
+            with jobs.ResourceManager([], [NG.output1], 5, .1, conn=CONN, fair=True):
+                pass
+        except jobs.ResourceUnavailable as e:
+            self.assertEqual(e.args, ({'output_locked': [NG.output1]},))
+        self.assertFalse(CONN.zcard(queue))
+
+        # jobs that die lose their place (after 1 second here)
+        with mock.patch('jobs.POLL_FALLBACK', 0):
+            self.assertEqual(jobs._run_if_possible(CONN, [], [NG.output1], random_identifier(), 5, True, token='dead'),
+                             {'err': {'output_locked': [NG.output1]}, 'ok': False, 'temp': {}})
+        self.assertEqual(CONN.zrange(queue, 0, -1), [b'dead:o'])
+        jobs._finish_job(CONN, [], [NG.output1], id)
+        self.assertEqual(jobs._run_if_possible(CONN, [], [NG.output1], random_identifier(), 5, True, token='live'),
+                         {'err': {'output_queued': [NG.output1]}, 'ok': False, 'temp': {}})
+        time.sleep(1.5)
+        id = random_identifier()
+        self.assertEqual(jobs._run_if_possible(CONN, [], [NG.output1], id, 5, True, token='live'),
+                         {'ok': True})
+        self.assertFalse(CONN.zcard(queue))
+        jobs._finish_job(CONN, [], [NG.output1], id)
+        self.assertFalse(CONN.exists('jobs:waiting:live'))
+
+    def test_8_start_many(self):
+        id = random_identifier()
+        jobs._run_if_possible(CONN, [], [NG.output3], id, 30, True)
+        managers = [
+            jobs.ResourceManager([NG.input1], [NG.output1], 5, conn=CONN),
+            jobs.ResourceManager([NG.input1, NG.input2], [NG.output2], 5, conn=CONN),
+            jobs.ResourceManager([NG.input2], [NG.output3], 5, conn=CONN),
+        ]
+        with mock.patch('jobs._script_pipeline', wraps=jobs._script_pipeline) as pipeline:
+            self.assertEqual(jobs.start_many(managers), [
+                {'ok': True}, {'ok': True},
+                {'ok': False, 'err': {'output_locked': [NG.output3]}}])
+            # one round trip for all of them
+            self.assertEqual(pipeline.call_count, 1)
+
+        self.assertEqual([m.is_running for m in managers], [True, True, False])
+        self.assertTrue(CONN.exists('olock:' + str(NG.output2)))
+        self.assertEqual(CONN.zcard('ilock:' + str(NG.input1)), 2)
+
+        # locks are released if the arguments can't be built
+        with mock.patch('jobs._finish_job_args', side_effect=[([], []), ValueError()]):
+            self.assertRaises(ValueError, jobs.finish_many, managers)
+        def unlocked(m):
+            free = []
+            def check():
+                free.append(m._lock.acquire(False))
+                if free[0]:
+                    m._lock.release()
+            t = threading.Thread(target=check)
+            t.start()
+            t.join()
+            return free[0]
+        self.assertEqual([unlocked(m) for m in managers], [True, True, True])
+        self.assertEqual([m.is_running for m in managers], [True, True, False])
+
+        self.assertEqual(jobs.finish_many(managers), [True, True, False])
+        self.assertEqual([m.is_running for m in managers], [False, False, False])
+        self.assertFalse(CONN.exists('olock:' + str(NG.output2)))
+        self.assertFalse(CONN.exists('ilock:' + str(NG.input1)))
+        self.assertTrue(CONN.exists(NG.output1))
+        self.assertTrue(CONN.exists(NG.output2))
+
+        # fair jobs get in line, and leave it when they give up
+        fair = [jobs.ResourceManager([], [NG.output3], 5, .2, fair=True, conn=CONN)]
+        self.assertEqual(jobs.start_many(fair), [{'ok': False, 'err': {'output_locked': [NG.output3]}}])
+        self.assertFalse(CONN.keys('jobs:waiting:*'))
+        self.assertFalse(CONN.exists('jobs:queue:' + str(NG.output3)))
+        jobs._finish_job(CONN, [], [NG.output3], id)
+
+        # waiting jobs wake up on release instead of polling
+        waiting = [jobs.ResourceManager([NG.input5], [NG.output4], 5, 5, conn=CONN)]
+        threading.Timer(.5, jobs._create_outputs, ([str(NG.input5)], CONN)).start()
+        with mock.patch('jobs._script_pipeline', wraps=jobs._script_pipeline) as pipeline:
+            self.assertEqual(jobs.start_many(waiting), [{'ok': True}])
+            self.assertLess(pipeline.call_count, 10)
+        jobs.finish_many(waiting)
+
+        # errors are per job, and the jobs that got their locks are started
+        real = jobs._script_pipeline_by_conn
+        def flaky(calls, raise_on_error=True):
+            return real(calls[:1], raise_on_error) + [redis.exceptions.ConnectionError()]
+        managers = [jobs.ResourceManager([], [NG.output5], 5, conn=CONN),
+                    jobs.ResourceManager([], [NG.output6], 5, conn=CONN)]
+        with mock.patch('jobs._script_pipeline_by_conn', side_effect=flaky):
+            self.assertRaises(redis.exceptions.ConnectionError, jobs.start_many, managers)
+        self.assertEqual([m.is_running for m in managers], [True, False])
+        self.assertTrue(CONN.exists('olock:' + str(NG.output5)))
+        self.assertEqual(jobs.finish_many(managers), [True, False])
+
+    def test_9_auto_refresh(self):
+        managers = [
+            jobs.ResourceManager([NG.input1], [NG.output1], 3, conn=CONN),
+            jobs.ResourceManager([NG.input2], [NG.output2], 3, conn=CONN),
+            jobs.ResourceManager([NG.input3], [NG.output3], 30, conn=CONN),
+        ]
+        jobs.start_many(managers, auto_refresh=True)
+        with mock.patch('jobs._script_pipeline', wraps=jobs._script_pipeline) as pipeline:
+            time.sleep(1.5)
+            # both short jobs were refreshed together, the long one wasn't due
+            self.assertEqual(pipeline.call_count, 1)
+            self.assertEqual(len(pipeline.call_args[0][1]), 2)
+            time.sleep(1.5)
+            self.assertEqual(pipeline.call_count, 2)
+        # still locked after their original duration
+        self.assertTrue(CONN.exists('olock:' + str(NG.output1)))
+        self.assertTrue(CONN.exists('olock:' + str(NG.output2)))
+
+        jobs.finish_many(managers)
+        self.assertFalse(jobs.AUTO_REFRESH)
+        time.sleep(1.2)
+        # the refresh thread exits when there is nothing left to refresh
+        self.assertIsNone(jobs.REFRESH_THREAD)
+
+    def test_9_cluster_tags(self):
+        a = 'ca' + random_identifier().decode('latin-1')
+        b = 'cb' + random_identifier().decode('latin-1')
+        try:
+            with mock.patch('jobs.CLUSTER_TAGS', True):
+                CONN.set('{%s}.input1'%a, '')
+                # everything in one namespace is locked in one slot
+                with jobs.ResourceManager([a + '.input1'], [a + '.output1'], 5, conn=CONN):
+                    self.assertTrue(CONN.exists('olock:{%s}.output1'%a))
+                    self.assertTrue(CONN.exists('ilock:{%s}.input1'%a))
+                    self.assertEqual(jobs.get_jobs(CONN, a)[0]['outputs'], [a + '.output1'])
+                    self.assertNotIn([a + '.output1'], [j['outputs'] for j in jobs.get_jobs(CONN)])
+                self.assertTrue(CONN.exists('{%s}.output1'%a))
+
+                # namespaces are locked in order, and released if we can't
+                # get them all
+                id = random_identifier()
+                jobs._run_if_possible(CONN, [], [b + '.output1'], id, 30, True)
+                self.assertEqual(jobs._run_if_possible(CONN, [a + '.input1'], [b + '.output1', a + '.output2'], random_identifier(), 5, True),
+                                 {'err': {'output_locked': [b + '.output1']}, 'ok': False, 'temp': {}})
+                self.assertFalse(CONN.exists('olock:{%s}.output2'%a))
+                self.assertFalse(CONN.exists('ilock:{%s}.input1'%a))
+                jobs._finish_job(CONN, [], [b + '.output1'], id)
+
+                with jobs.ResourceManager([a + '.input1'], [b + '.output1', a + '.output2'], 5, conn=CONN) as job:
+                    self.assertTrue(CONN.exists('{%s}jobs:lease:%s'%(a, job.identifier)))
+                    self.assertTrue(CONN.exists('{%s}jobs:lease:%s'%(b, job.identifier)))
+                    time.sleep(1.1)
+                    self.assertEqual(job.refresh(), {'ok': True})
+                self.assertTrue(CONN.exists('{%s}.output2'%a))
+                self.assertFalse(CONN.exists('olock:{%s}.output1'%b))
+
+                # every KEYS entry of a slot group hashes to the same slot
+                for inputs, outputs in [([a + '.input1'], [a + '.output1']), ([a + '.input1'], []), ([], [a + '.output1'])]:
+                    id = random_identifier()
+                    for keys, args in [
+                            jobs._run_if_possible_args(CONN, inputs, outputs, id, 5, True, history=True),
+                            jobs._refresh_job_args(CONN, inputs, outputs, id, 5, True),
+                            jobs._leave_queues_args(CONN, inputs, outputs, 'token'),
+                            jobs._finish_job_args(CONN, inputs, outputs, id),
+                            jobs._renew_job_args(CONN, id, (inputs + outputs)[0])]:
+                        self.assertNotIn('', keys)
+                        self.assertEqual(set(map(key_slot, keys)), {key_slot('{%s}'%a)})
+        finally:
+            kk = CONN.keys('*' + a + '*') + CONN.keys('*' + b + '*')
+            if kk:
+                CONN.delete(*kk)
+
+    def test_9_jobs_client(self):
+        prefix = self._prefix('client')
+        t1 = jobs.JobsClient(CONN, prefix + 't1:')
+        t2 = jobs.JobsClient(CONN, prefix + 't2:', graph_history=False)
+        # tenants don't see each other's locks or outputs
+        with jobs.ResourceManager([], [NG.output1], 5, conn=t1) as job1:
+            with jobs.ResourceManager([], [NG.output1], 5, conn=t2) as job2:
+                self.assertFalse(job2.graph_history)
+                self.assertTrue(CONN.exists(prefix + 't1:olock:' + str(NG.output1)))
+                self.assertTrue(CONN.exists(prefix + 't2:olock:' + str(NG.output1)))
+                self.assertEqual([j['id'] for j in jobs.get_jobs(t1)], [job1.identifier])
+                self.assertEqual([j['id'] for j in jobs.get_jobs(t2)], [job2.identifier])
+        self.assertFalse(CONN.exists(NG.output1))
+        self.assertTrue(CONN.exists(prefix + 't1:' + str(NG.output1)))
+        self.assertTrue(CONN.exists(prefix + 't2:' + str(NG.output1)))
+        self.assertEqual(jobs.get_jobs(t1), [])
+        # scripts are tracked per client
+        self.assertIn(jobs._run_if_possible_lua.sha, t1.scripts)
+
+        jobs._create_outputs([str(NG.input4)], t1)
+        self.assertTrue(CONN.exists(prefix + 't1:' + str(NG.input4)))
+        # plain connections keep using the keys as given
+        with mock.patch('jobs.GLOBAL_PREFIX', prefix):
+            jobs._create_outputs([str(NG.input4)], CONN)
+        self.assertTrue(CONN.exists(NG.input4))
+        CONN.delete(NG.input4)
+
+    def test_9_graph_traversal(self):
+        prefix = self._prefix('graph')
+        client = jobs.JobsClient(CONN, prefix)
+        CONN.set(prefix + 'lineage.raw', '')
+        for inp, job, out in [('lineage.raw', 'lineage.clean_job', 'lineage.clean'),
+                              ('lineage.clean', 'lineage.report_job', 'lineage.report')]:
+            jobs._run_if_possible(client, [inp], [out], job, 5, True, history=True)
+            jobs._finish_job(client, [inp], [out], job)
+        chain = [['lineage.raw', 'lineage.clean_job'], ['lineage.clean_job', 'lineage.clean'],
+                 ['lineage.clean', 'lineage.report_job'], ['lineage.report_job', 'lineage.report']]
+
+        self.assertEqual(jobs._traverse_edges(True, 'lineage.raw', client), chain)
+        self.assertEqual(jobs._traverse_edges(True, 'lineage.raw', client, depth=1), chain[:2])
+        self.assertEqual(jobs._traverse_edges(True, 'lineage.raw', client, limit=3), chain[:3])
+        # capped by default, so one call can't block Redis for long
+        with mock.patch('jobs.TRAVERSE_LIMIT', 2):
+            self.assertEqual(jobs._traverse_edges(True, 'lineage.raw', client), chain[:2])
+            self.assertEqual(jobs._traverse_edges(True, 'lineage.raw', client, limit=0), chain)
+        self.assertEqual(jobs._traverse_edges(False, 'lineage.report', client), chain[::-1])
+        self.assertEqual(jobs._traverse_edges(True, 'lineage.raw', client, before=1), [])
+        self.assertEqual(jobs._traverse_edges(True, 'lineage.raw', client, after=time.time() - 60), chain)
+
+        # history without the adjacency sets can be indexed
+        CONN.delete(*CONN.keys(prefix + 'jobs:graph:next:*'))
+        CONN.delete(*CONN.keys(prefix + 'jobs:graph:prev:*'))
+        self.assertEqual(jobs._traverse_edges(True, 'lineage.raw', client), [])
+        self.assertEqual(jobs.index_graph(client), 4)
+        self.assertEqual(jobs._traverse_edges(False, 'lineage.report', client), chain[::-1])
+
+    def test_9_iter_edges(self):
+        prefix = self._prefix('edges')
+        client = jobs.JobsClient(CONN, prefix)
+        # pages split between edges with the same score too
+        CONN.execute_command('ZADD', prefix + 'jobs:graph:input', 1, 'a -> j', 1, 'b -> j',
+            1, 'c -> j', 2, 'd -> j', 3, 'e -> j', 3, 'f.123 -> j')
+        for chunk in (1, 2, 3, 1000):
+            self.assertEqual(list(jobs.iter_edges(client, chunk=chunk)),
+                             ['a -> j', 'b -> j', 'c -> j', 'd -> j', 'e -> j', 'f.* -> j'])
+        self.assertEqual(list(jobs.iter_edges(client, after=2, before=3, chunk=1)), ['d -> j', 'e -> j', 'f.* -> j'])
+        self.assertEqual(list(jobs.iter_edges(client, True)), [])
+        self.assertEqual(jobs.edges(client, after=3), [['e -> j', 'f.* -> j'], []])
+
+    def test_9_graph_retention(self):
+        prefix = self._prefix('retention')
+        client = jobs.JobsClient(CONN, prefix)
+        now = time.time()
+        day = 86400 * (int(now // 86400) - 3)
+        CONN.execute_command('ZADD', prefix + 'jobs:graph:input', day, 'a -> j', day + 86400, 'b -> j',
+            now, 'c -> j')
+        CONN.execute_command('ZADD', prefix + 'jobs:graph:output', day, 'j -> x', now, 'j -> y')
+        jobs.index_graph(client)
+
+        self.assertEqual(jobs.compact_graph(client, max_age=3600, summary=True, chunk=1), 3)
+        self.assertEqual(jobs.edges(client), [['c -> j'], ['j -> y']])
+        self.assertEqual(jobs._traverse_edges(True, 'j', client), [['j', 'y']])
+        self.assertEqual(jobs._traverse_edges(False, 'j', client), [['c', 'j']])
+        self.assertEqual(jobs.daily_edges(client, day), ['a -> j'])
+        self.assertEqual(jobs.daily_edges(client, day, True), ['j -> x'])
+        # summaries expire GRAPH_SUMMARY_DAYS after their day
+        ttl = CONN.ttl(prefix + 'jobs:graph:daily:input:%i'%(day // 86400))
+        self.assertAlmostEqual(ttl, day + 86400 * (1 + jobs.GRAPH_SUMMARY_DAYS) - now, delta=5)
+        # ... and summaries past that are dropped
+        CONN.execute_command('ZADD', prefix + 'jobs:graph:input', 86400, 'old -> j')
+        self.assertEqual(jobs.compact_graph(client, max_age=3600, summary=True, summary_days=1), 1)
+        self.assertEqual(jobs.daily_edges(client, 86400), [])
+
+        # jobs that record history enforce retention as they go
+        CONN.set(prefix + 'retention.in', '')
+        with mock.patch('jobs.GRAPH_MAX_EDGES', 1):
+            for job in ('retention.first', 'retention.second'):
+                jobs._run_if_possible(client, ['retention.in'], [job + '_out'], job, 5, True, history=True)
+                jobs._finish_job(client, ['retention.in'], [job + '_out'], job)
+                time.sleep(.01)
+        self.assertEqual(jobs.edges(client), [['retention.in -> retention.second'],
+                                              ['retention.second -> retention.second_out']])
+        self.assertEqual(jobs._traverse_edges(True, 'retention.in', client),
+                         [['retention.in', 'retention.second'], ['retention.second', 'retention.second_out']])
+
+    def test_9_graph_granularity(self):
+        prefix = self._prefix('granularity')
+        client = jobs.JobsClient(CONN, prefix)
+        def run(job):
+            jobs._run_if_possible(client, ['granularity.in'], ['granularity.out'], job, 5, True, history=True)
+            jobs._finish_job(client, ['granularity.in'], ['granularity.out'], job)
+            return [CONN.zscore(prefix + 'jobs:graph:input', 'granularity.in -> ' + job),
+                    CONN.zscore(prefix + 'jobs:graph:next:granularity.in', job)]
+        CONN.set(prefix + 'granularity.in', '')
+        with mock.patch('jobs.GRAPH_GRANULARITY', 60):
+            first = run('granularity.job')
+            time.sleep(.01)
+            # recorded recently, not rewritten
+            self.assertEqual(run('granularity.job'), first)
+        time.sleep(.01)
+        second = run('granularity.job')
+        self.assertGreater(second[0], first[0])
+        self.assertEqual(second[0], second[1])
+
+    def test_9_graph_intern(self):
+        prefix = self._prefix('intern')
+        client = jobs.JobsClient(CONN, prefix)
+        CONN.set(prefix + 'interned.raw', '')
+        with mock.patch('jobs.GRAPH_INTERN', True):
+            for inp, job, out in [('interned.raw', 'interned.clean_job', 'interned.clean'),
+                                  ('interned.clean', 'interned.report_job', 'interned.report')]:
+                jobs._run_if_possible(client, [inp], [out], job, 5, True, history=True)
+                jobs._finish_job(client, [inp], [out], job)
+
+            # edges are stored as pairs of ids
+            self.assertEqual(CONN.zrange(prefix + 'jobs:graph:input', 0, -1), [b'2:1', b'3:4'])
+            self.assertEqual(CONN.hget(prefix + 'jobs:graph:ids', 1), b'interned.clean_job')
+            self.assertEqual(jobs.edges(client), [
+                ['interned.clean -> interned.report_job', 'interned.raw -> interned.clean_job'],
+                ['interned.clean_job -> interned.clean', 'interned.report_job -> interned.report']])
+            self.assertEqual(jobs._traverse_edges(False, 'interned.report', client), [
+                ['interned.report_job', 'interned.report'], ['interned.clean', 'interned.report_job'],
+                ['interned.clean_job', 'interned.clean'], ['interned.raw', 'interned.clean_job']])
+            self.assertEqual(jobs._traverse_edges(True, 'interned.missing', client), [])
+
+            # names are cached
+            with mock.patch.object(CONN, 'hmget') as hmget:
+                self.assertEqual(list(jobs.iter_edges(client, True, chunk=1)),
+                    ['interned.clean_job -> interned.clean', 'interned.report_job -> interned.report'])
+                self.assertEqual(hmget.call_count, 0)
+
+            self.assertEqual(jobs.compact_graph(client, max_edges=1, summary=True), 2)
+            self.assertEqual(jobs.daily_edges(client, time.time()), ['interned.raw -> interned.clean_job'])
+            self.assertEqual(jobs._traverse_edges(True, 'interned.raw', client), [])
+
+    def test_9_graph_snapshot(self):
+        prefix = self._prefix('snapshot')
+        client = jobs.JobsClient(CONN, prefix)
+        path = os.path.join(tempfile.mkdtemp(), 'graph.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        def run(job):
+            jobs._run_if_possible(client, ['snapshot.raw'], [job + '_out'], job, 5, True, history=True)
+            jobs._finish_job(client, ['snapshot.raw'], [job + '_out'], job)
+            time.sleep(.01)
+        CONN.set(prefix + 'snapshot.raw', '')
+        run('snapshot.first')
+        run('snapshot.second')
+        snapshot = jobs.GraphSnapshot(path, client)
+        self.assertEqual(snapshot.refresh(), 4)
+        self.assertEqual(snapshot.traverse(True, 'snapshot.raw'),
+                         jobs._traverse_edges(True, 'snapshot.raw', client))
+        self.assertEqual(snapshot.traverse(True, 'snapshot.raw', depth=0, limit=1),
+                         [['snapshot.raw', 'snapshot.first']])
+
+        # only edges seen since the last refresh are fetched
+        run('snapshot.third')
+        snapshot = jobs.GraphSnapshot(path, client)
+        self.assertEqual(len(snapshot.edges[0]), 2)
+        with mock.patch.object(jobs.GraphSnapshot, 'SLACK', 0):
+            # ... and the ones seen at the high-water mark
+            self.assertEqual(snapshot.refresh(), 4)
+        self.assertEqual(snapshot.traverse(False, 'snapshot.third_out'),
+                         [['snapshot.third', 'snapshot.third_out'], ['snapshot.raw', 'snapshot.third']])
+
+        # start over when edges are removed
+        jobs.compact_graph(client, max_edges=1)
+        self.assertEqual(snapshot.refresh(), 2)
+        self.assertEqual(snapshot.traverse(True, 'snapshot.raw'),
+                         [['snapshot.raw', 'snapshot.third'], ['snapshot.third', 'snapshot.third_out']])
+
+        # ... even when new edges arrived since
+        run('snapshot.fourth')
+        jobs.compact_graph(client, max_edges=1)
+        run('snapshot.fifth')
+        snapshot.refresh()
+        self.assertEqual(snapshot.traverse(True, 'snapshot.raw'),
+                         jobs._traverse_edges(True, 'snapshot.raw', client))
+        self.assertNotIn('snapshot.raw -> snapshot.third', snapshot.edges[0])
+
+        # the file is only rewritten when edges changed
+        with mock.patch.object(jobs.GraphSnapshot, 'save') as save:
+            snapshot.refresh()
+            self.assertFalse(save.called)
+
+        with mock.patch('jobs.GRAPH_CACHE_DIR', os.path.dirname(path)):
+            self.assertTrue(jobs.GraphSnapshot(conn=client).path.startswith(os.path.dirname(path)))
+
+    def test_9_io_cache(self):
+        with mock.patch('jobs._prepare_io', wraps=jobs._prepare_io) as prepare:
+            job = jobs.ResourceManager([NG.input1], [NG.output5], 5)
+            for i in range(3):
+                self.assertTrue(job.can_run()['ok'])
+            self.assertEqual(prepare.call_count, 1)
+            # the suffix is part of the identifier
+            job.suffix = 'later'
+            self.assertTrue(job.can_run()['ok'])
+            self.assertEqual(prepare.call_count, 2)
+            job.add_inputs(NG.input2)
+            with job:
+                job.refresh()
+                job.refresh()
+            # start (with history), then refresh and finish (without)
+            self.assertEqual(prepare.call_count, 4)
+            self.assertEqual(prepare.call_args[0][0], [NG.input1, NG.input2])
+        self.assertTrue(CONN.exists(NG.output5))
+
+        with mock.patch('jobs.FIXED_EDGES_SIZE', 2), \
+                mock.patch('jobs.FIXED_EDGES', jobs.OrderedDict()) as fixed:
+            self.assertEqual(jobs._fix_edge('a.1'), 'a.*')
+            self.assertEqual(jobs._fix_edge('b.2-3'), 'b.*')
+            self.assertEqual(jobs._fix_edge('a.1'), 'a.*')
+            self.assertEqual(jobs._fix_edge('c.4'), 'c.*')
+            self.assertEqual(list(fixed), ['a.1', 'c.4'])
+
+    def test_9_lock_result(self):
+        self.assertEqual(jobs._lock_result([1, None, [], []]), {'ok': True})
+        self.assertEqual(jobs._lock_result([-1, None, [], []]), {'ok': False, 'missing': True})
+        self.assertEqual(jobs._lock_result([0, b'1.5', [b'output_locked', b'a', b'output_locked', b'b'], []]),
+                         {'ok': False, 'err': {'output_locked': ['a', 'b']}, 'temp': {}, 'wake': 1.5})
+
+        id = random_identifier()
+        self.assertTrue(jobs._run_if_possible(CONN, [], [NG.output6], id, 5, True)['ok'])
+        try:
+            result = jobs._run_if_possible(CONN, [NG.input1], [NG.output6], 'other', 0, True, wake=True)
+            self.assertEqual(result['err'], {'output_locked': [str(NG.output6)]})
+            self.assertTrue(0 < result['wake'] <= 5, result)
+            self.assertEqual(jobs._refresh_job(CONN, [], [NG.output6], id, 5, True), {'ok': True})
+        finally:
+            jobs._finish_job(CONN, [], [NG.output6], id, failed=True)
+
+    def test_9_import_side_effects(self):
+        # importing jobs.py doesn't build the CLI, hash scripts, or install handlers
+        # or import asyncio (newer redis-py imports it on its own)
+        check = (
+            "import signal, sys, redis; a = 'asyncio' in sys.modules; import jobs; "
+            "print(repr(['argparse' in sys.modules, jobs._run_if_possible_lua.sha, "
+            "jobs.ATEXIT_SET, signal.getsignal(signal.SIGTERM) == signal.SIG_DFL, "
+            "'asyncio' in sys.modules and not a, 'jobs_async' in sys.modules]))")
+        out = subprocess.check_output([sys.executable, '-c', check],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        result = eval(out.decode('latin-1'))
+        self.assertEqual(result, [False, None, False, True, False, False])
+
+        # same for ``from jobs import *``, as in the README's myjobs.py
+        check = (
+            "import sys, redis; a = 'asyncio' in sys.modules; from jobs import *; "
+            "print(repr(['asyncio' in sys.modules and not a, 'jobs_async' in sys.modules]))")
+        out = subprocess.check_output([sys.executable, '-c', check],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(eval(out.decode('latin-1')), [False, False])
+
+        # ... until the first job starts
+        with jobs.ResourceManager([NG.input1], [NG.output7], 5):
+            self.assertTrue(jobs.ATEXIT_SET)
+            self.assertIs(signal.getsignal(signal.SIGTERM), jobs._signal_handler)
+
+    def test_9_logging(self):
+        class Keys(list):
+            reprs = 0
+            def __repr__(self):
+                Keys.reprs += 1
+                return list.__repr__(self)
+
+        log = jobs.BullshitLog()
+        log.setLevel(jobs.logging.WARNING)
+        with mock.patch('jobs.print', create=True) as printed:
+            log.debug("Failed to start job: %r", Keys())
+            log.info("Trying to start job with inputs: %r", Keys())
+            self.assertEqual((Keys.reprs, printed.call_count), (0, 0))
+            log.warning("Lock(s) lost due to timeout: %r", Keys())
+            self.assertEqual((Keys.reprs, printed.call_count), (1, 1))
+            self.assertTrue(log.isEnabledFor(jobs.logging.ERROR))
+
+            with mock.patch('jobs.DEFAULT_LOGGER', jobs.NullLog()):
+                self.assertFalse(jobs.DEFAULT_LOGGER.isEnabledFor(jobs.logging.CRITICAL))
+                with jobs.ResourceManager(Keys([NG.input1]), Keys([NG.output8]), 5):
+                    pass
+                jobs.DEFAULT_LOGGER.exception("Exception %r", Keys())
+            self.assertEqual((Keys.reprs, printed.call_count), (1, 1))
+
+    def test_9_metrics(self):
+        metrics = jobs.PrometheusMetrics()
+        with mock.patch('jobs.METRICS', metrics):
+            with jobs.ResourceManager([NG.input1], [NG.output9], 5) as job:
+                job.last_refreshed -= 2
+                job.refresh()
+                self.assertRaises(jobs.ResourceUnavailable,
+                    jobs.ResourceManager([], [NG.output9], 5, .05).start)
+
+        counters = dict(metrics.counters)
+        self.assertGreater(counters[('lock.failures', (('namespace', 'test'), ('reason', 'output_locked')))], 1)
+        started = metrics.histograms[('start.attempts', (('result', 'started'),))]
+        self.assertEqual((started[-2], started[-1]), (1, 1))
+        failed = metrics.histograms[('start.attempts', (('result', 'failed'),))]
+        self.assertGreater(failed[-1], 1)
+        for name in ('start.wait', 'refresh.latency', 'finish.latency'):
+            self.assertTrue(any(key[0] == name for key in metrics.histograms), name)
+
+        text = metrics.render()
+        self.assertIn('# TYPE jobs_lock_failures_total counter', text)
+        self.assertIn('jobs_start_wait_bucket{result="started",le="+Inf"} 1', text)
+        self.assertIn('jobs_finish_latency_count 1', text)
+        # attempts are counts, not seconds
+        self.assertIn('jobs_start_attempts_bucket{result="started",le="1"} 1', text)
+        self.assertNotIn('jobs_start_attempts_bucket{result="started",le="0.001"}', text)
+
+        # StatsD over UDP
+        import socket
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            statsd = jobs.StatsdMetrics(*server.getsockname())
+            statsd.incr('lock.failures', 2, {'reason': 'output_used'})
+            statsd.observe('start.wait', .25)
+            self.assertEqual(server.recv(1024), b'jobs.lock.failures:2|c|#reason:output_used')
+            self.assertEqual(server.recv(1024), b'jobs.start.wait:250.000|ms')
+            with mock.patch('jobs.METRICS', statsd):
+                jobs._start_metrics(time.time(), 1, 'started')
+            self.assertTrue(server.recv(1024).endswith(b'|ms|#result:started'))
+            self.assertEqual(server.recv(1024), b'jobs.start.attempts:1|h|#result:started')
+        finally:
+            server.close()
+
+        # broken sinks don't break jobs
+        with mock.patch('jobs.METRICS', object()):
+            with jobs.ResourceManager([NG.input1], [NG.output10], 5):
+                pass
+
+    def test_9_hot_keys(self):
+        prefix = self._prefix('hot')
+        client = jobs.JobsClient(CONN, prefix)
+        with mock.patch('jobs.CONTENTION_STATS', True):
+            jobs._run_if_possible(client, [], ['hot.out.2016-01-01'], 'holder', 5, True)
+            for i in range(3):
+                jobs._run_if_possible(client, ['hot.in.1'], ['hot.out.2016-01-01'], 'waiter', 5, True)
+            # refreshes aren't counted
+            jobs._refresh_job(client, ['hot.in.1'], [], 'holder', 5, True)
+            # a waiting job is counted once per start, not once per attempt
+            job = jobs.ResourceManager(['hot.in.2'], [], 5, .3, conn=client)
+            self.assertRaises(jobs.ResourceUnavailable, job.start)
+        # nor is anything with the stats off
+        jobs._run_if_possible(client, ['hot.in.1'], [], 'waiter', 5, True)
+
+        self.assertEqual(jobs.hot_keys(client),
+                         [['input_missing', 'hot.in.*', 4], ['output_locked', 'hot.out.*', 3]])
+        self.assertEqual(jobs.hot_keys(client, count=1), [['input_missing', 'hot.in.*', 4]])
+        bucket = CONN.keys(prefix + 'jobs:contention:*')
+        self.assertEqual(len(bucket), 1)
+        self.assertGreater(CONN.ttl(bucket[0]), 86400)
+
+    def test_9_functions(self):
+        library, code = jobs._functions()
+        self.assertTrue(code.startswith('#!lua name=' + library))
+        for script in jobs.SCRIPTS:
+            self.assertIn("register_function('%s_%s'"%(library, script.name), code)
+
+        # servers without Redis Functions fall back to EVALSHA
+        client = jobs.JobsClient(CONN)
+        with mock.patch('jobs.USE_FUNCTIONS', True):
+            if not jobs.load_functions(client):
+                self.assertIn(jobs.NO_FUNCTIONS, client.scripts)
+            with jobs.ResourceManager([NG.input1], [NG.output1], 5, conn=client):
+                self.assertTrue(CONN.exists('olock:' + str(NG.output1)))
+            managers = [jobs.ResourceManager([NG.input1], [NG.output2], 5, conn=client)]
+            self.assertEqual(jobs.start_many(managers), [{'ok': True}])
+            self.assertEqual(jobs.finish_many(managers), [True])
+        self.assertTrue(CONN.exists(NG.output1))
+        self.assertTrue(CONN.exists(NG.output2))
+
+        # what we know about one server doesn't leak to connections to another
+        old, other = redis.Redis(db=15), redis.Redis(db=14)
+        jobs._client(old).scripts.add(jobs.NO_FUNCTIONS)
+        self.assertIs(jobs._client(old).scripts, jobs._client(old).scripts)
+        self.assertNotIn(jobs.NO_FUNCTIONS, jobs._client(other).scripts)
+
 if __name__ == '__main__':
     unittest.main()
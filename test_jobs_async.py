@@ -0,0 +1,107 @@
+
+import asyncio
+import binascii
+import os
+import random
+import time
+import unittest
+from unittest import mock
+
+import jobs
+
+try:
+    import redis.asyncio
+except ImportError:
+    redis = None
+
+NG = jobs.NG.test[int(time.time())*1000000 + random.randrange(1000000)]
+
+def random_identifier():
+    return binascii.hexlify(os.urandom(8))
+
+@unittest.skipIf(redis is None or not hasattr(jobs, 'AsyncResourceManager'),
+    "requires redis.asyncio")
+class TestAsyncJobs(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.conn = redis.asyncio.Redis(db=15)
+        await self.conn.mset({str(NG.input1):'', str(NG.input2):''})
+
+    async def asyncTearDown(self):
+        kk = await self.conn.keys('*' + str(NG) + '*')
+        if kk:
+            await self.conn.delete(*kk)
+        await self.conn.aclose()
+
+    async def test_1_async_resource_manager(self):
+        async with jobs.AsyncResourceManager([NG.input1, NG.input2], [NG.output1], 5, conn=self.conn) as job:
+            self.assertTrue(job.is_running)
+            # always refreshed, and left out of the (sync) shutdown handling
+            self.assertTrue(job.auto_refresh)
+            self.assertNotIn(job, jobs.LOCKED)
+            self.assertTrue(await self.conn.exists('ilock:' + str(NG.input1)))
+            self.assertTrue(await self.conn.exists('olock:' + str(NG.output1)))
+            self.assertEqual(await jobs.AsyncResourceManager([], [NG.output1], 5, conn=self.conn).can_run(),
+                             {'err': {'output_locked': [NG.output1]}, 'ok': False, 'temp': {}})
+        self.assertFalse(job.is_running)
+        self.assertFalse(await self.conn.exists('ilock:' + str(NG.input1)))
+        self.assertTrue(await self.conn.exists(str(NG.output1)))
+
+        with self.assertRaises(jobs.ResourceUnavailable) as e:
+            async with jobs.AsyncResourceManager([NG.input3], [], 5, .1, conn=self.conn):
+                pass
+        self.assertEqual(e.exception.args, ({'input_missing': [NG.input3]},))
+
+        with self.assertRaises(TypeError):
+            with jobs.AsyncResourceManager([NG.input1], [], 5, conn=self.conn):
+                pass
+
+    async def test_2_async_wait_and_refresh(self):
+        # hold the output from another job, released in the background
+        id = random_identifier()
+        holder = jobs.AsyncResourceManager([], [NG.output2], 30, conn=self.conn, identifier=id)
+        await holder.start()
+        async def release():
+            await asyncio.sleep(.5)
+            await holder.stop()
+        task = asyncio.ensure_future(release())
+
+        t = time.time()
+        with mock.patch('jobs.POLL_FALLBACK', 60):
+            async with jobs.AsyncResourceManager([], [NG.output2], 2, 15, conn=self.conn) as job:
+                # woken up by the release, not by the fallback poll
+                self.assertLess(time.time() - t, 5)
+                await task
+                # the refresh task keeps our locks alive
+                await asyncio.sleep(2.5)
+                self.assertGreater(await self.conn.pttl('olock:' + str(NG.output2)), 0)
+                self.assertIsNotNone(job._refresh_task)
+        self.assertIsNone(job._refresh_task)
+        # the release listener stops when nobody is waiting
+        import jobs_async
+        self.assertIsNone(jobs_async.LISTENERS[self.conn.connection_pool].task)
+
+    async def test_3_async_decorator(self):
+        @jobs.async_resource_manager([NG.input1], [NG.output3], 5, conn=self.conn)
+        async def some_job(job, fail):
+            await job.start()
+            if fail:
+                raise ValueError(fail)
+            return job.identifier
+
+        with self.assertRaises(ValueError):
+            await some_job(True)
+        self.assertFalse(await self.conn.exists(str(NG.output3)))
+        self.assertIn(':some_job.', await some_job(False))
+        self.assertTrue(await self.conn.exists(str(NG.output3)))
+
+    async def test_4_async_functions(self):
+        # FCALL, or EVALSHA on servers without Redis Functions
+        client = jobs.JobsClient(self.conn)
+        with mock.patch('jobs.USE_FUNCTIONS', True):
+            async with jobs.AsyncResourceManager([NG.input1], [NG.output4], 5, conn=client):
+                self.assertTrue(await self.conn.exists('olock:' + str(NG.output4)))
+        self.assertTrue(jobs.NO_FUNCTIONS in client.scripts or jobs._functions()[0] in client.scripts)
+        self.assertTrue(await self.conn.exists(str(NG.output4)))
+
+if __name__ == '__main__':
+    unittest.main()